@@ -1,17 +1,37 @@
 import os
+import asyncio
+import heapq
+import itertools
 import sqlite3
 import json
 import time
 import threading
 import random
 import re
-import threading
+import queue
+import sys
 import requests
 import pylint.lint
-from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import Union
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 # Загружаем конфигурацию из config.json
 def load_config():
@@ -37,25 +57,649 @@ GRAND_DEVELOPER_USERNAME = CONFIG['grand_developer']['username']
 VK_TOKEN = TOKEN
 VK_GROUP_ID = GROUP_ID
 GRAND_MANAGER_ID = None
-ROULETTE_TIMERS = {}
-CRASH_TIMERS = {}
-DICE_TIMERS = {}
-PIAR_TIMERS = {}
 
-class Database:
+# Минимальный уровень прав для команд по умолчанию (в беседе можно изменить через /editcmd).
+# Если команда есть в нескольких группах, действует первая.
+COMMAND_LEVEL_GROUPS = [
+    (20, ['helper']),  # Помощник
+    (20, ['kick', 'warn', 'unwarn', 'getwarn', 'warnhistory', 'warnlist', 'mutelist', 'mute', 'unmute', 'getban', 'setnick', 'removenick', 'getbynick', 'nicknames', 'nonames', 'zov', 'roles']),  # Помощник - базовые команды модерации
+    (40, ['role', 'removerole', 'ban', 'unban', 'banlist', 'gkick', 'silence', 'logs', 'gsetnick', 'gremovenick', 'delete', 'gzov', 'newrole', 'delrole']),  # Модератор - расширенные команды администрирования
+    (60, ['admin', 'moder', 'gm', 'gms', 'gban', 'gunban', 'filter', 'settings', 'pin', 'unpin', 'rr', 'gsetrole', 'welcome']),  # Администратор - глобальное управление и настройки
+    (80, ['gdelrole', 'setrules', 'inactive']),  # Спец.Администратор
+    (100, ['owner', 'initadmin', 'checknicks', 'editcmd', 'pull', 'newpull', 'wipe', 'piar']),  # Создатель
+    (100, ['add']),  # Команда add доступна только создателю
+]
+COMMAND_LEVELS = {command: level for level, commands in reversed(COMMAND_LEVEL_GROUPS) for command in commands}
+
+# Системные команды: права проверяются внутри самих команд
+SYSTEM_COMMANDS = {'ahelp', 'sysadmins', 'tickets', 'giveagent', 'giveadm', 'null', 'sysban', 'unsysban', 'sysrole', 'perf', 'reload'}
+
+# Красные числа рулетки
+ROULETTE_RED_NUMBERS = (1, 3, 5, 7, 9, 12, 14, 16, 18, 19, 21, 23, 25, 27, 30, 32, 34, 36)
+
+# Множители выплат рулетки по типу ставки
+ROULETTE_PAYOUTS = {'число': 36, 'чет': 2, 'нечет': 2, 'красное': 2, 'черное': 2}
+
+# Распределения множителей: (накопленная вероятность, от, до)
+# Большинство крашей происходят рано, в Дрим множители выше
+CRASH_MULTIPLIER_TIERS = (
+    (0.40, 1.01, 1.50),
+    (0.70, 1.50, 3.00),
+    (0.85, 3.00, 10.00),
+    (0.95, 10.00, 50.00),
+    (0.99, 50.00, 200.00),
+    (1.00, 200.00, 1500.00),
+)
+DREAM_MULTIPLIER_TIERS = (
+    (0.50, 1.01, 2.0),
+    (0.80, 2.0, 5.0),
+    (0.95, 5.0, 10.0),
+    (0.99, 10.0, 50.0),
+    (1.00, 50.0, 100.0),
+)
+
+# Ежечасный бонус: диапазон суммы и интервал между получениями
+BONUS_AMOUNT_RANGE = (1000000, 5000000)
+BONUS_INTERVAL_HOURS = 1
+
+# Результаты изменения баланса через журнал
+LEDGER_APPLIED = 'applied'
+LEDGER_DUPLICATE = 'duplicate'
+LEDGER_INSUFFICIENT = 'insufficient'
+# Ставка не принята: игра уже не ждет ставок или игроков (ничего не списано)
+LEDGER_CLOSED = 'closed'
+
+# Версионные миграции схемы: (версия, описание, SQL). Применяются по порядку,
+# номер последней примененной хранится в PRAGMA user_version
+SCHEMA_MIGRATIONS = (
+    (1, 'составные и частичные индексы под горячие запросы', (
+        # remove_mute / set_mute: поиск действующего мута пользователя в чате
+        'CREATE INDEX IF NOT EXISTS idx_mutes_user_chat_active ON mutes(user_id, chat_id, mute_until) WHERE is_active = 1',
+        # get_user_ban_in_chat / remove_chat_ban
+        'CREATE INDEX IF NOT EXISTS idx_chat_bans_user_chat_active ON chat_bans(user_id, chat_id, created_at) WHERE is_active = 1',
+        # remove_system_ban и загрузка системных банов
+        'CREATE INDEX IF NOT EXISTS idx_system_bans_user_active ON system_bans(user_id, banned_until) WHERE is_active = 1',
+        # get_user_by_nickname в беседе
+        'CREATE INDEX IF NOT EXISTS idx_chat_nicknames_chat_nick ON chat_nicknames(chat_id, nickname) WHERE is_active = 1',
+        # get_warn_history
+        'CREATE INDEX IF NOT EXISTS idx_warnings_user_created ON warnings(user_id, created_at)',
+        # Топы: сортировка берется из индекса, без временного B-дерева
+        'CREATE INDEX IF NOT EXISTS idx_users_message_count ON users(message_count DESC, username)',
+        'CREATE INDEX IF NOT EXISTS idx_user_balances_top ON user_balances(balance DESC) WHERE balance > 0',
+        # Перекрыты составными индексами с тем же префиксом
+        'DROP INDEX IF EXISTS idx_warnings_chat_id',
+        'DROP INDEX IF EXISTS idx_chat_roles_chat_id',
+    )),
+    (2, 'покрывающий индекс для ChatRoleRoster', (
+        # get_chat_permissions: роли беседы читаются из индекса уже в порядке user_id
+        'CREATE INDEX IF NOT EXISTS idx_chat_roles_roster ON chat_roles(chat_id, user_id, role_level, role_name) WHERE is_active = 1',
+    )),
+    (3, 'индекс очереди доставки рассылок', (
+        # get_due_broadcast_peers / get_next_broadcast_retry: ожидающие получатели задания по времени повтора
+        'CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status ON broadcast_deliveries(job_id, status, next_attempt_at)',
+    )),
+)
+
+# Формы горячих запросов для проверки планов: (название, SQL, параметры).
+# Полный проход по таблице или сортировка во временном B-дереве считаются регрессией
+QUERY_PLAN_CHECKS = (
+    ('remove_mute', 'UPDATE mutes SET is_active = 0 WHERE user_id = ? AND chat_id = ? AND is_active = 1', (1, 1)),
+    ('get_timed_mutes', 'SELECT * FROM mutes WHERE is_active = 1 AND mute_until IS NOT NULL ORDER BY mute_until', ()),
+    ('get_user_ban_in_chat',
+     'SELECT * FROM chat_bans WHERE user_id = ? AND chat_id = ? AND is_active = 1 ORDER BY created_at DESC LIMIT 1', (1, 1)),
+    ('remove_system_ban', 'UPDATE system_bans SET is_active = 0 WHERE user_id = ? AND is_active = 1', (1,)),
+    ('remove_filtered_word', 'DELETE FROM filtered_words WHERE chat_id = ? AND word = ?', (1, 'x')),
+    ('get_user_by_nickname', 'SELECT * FROM chat_nicknames WHERE nickname = ? AND chat_id = ? AND is_active = 1', ('x', 1)),
+    ('get_warn_history',
+     'SELECT w.*, u.username as warned_by_name FROM warnings w LEFT JOIN users u ON w.warned_by = u.user_id '
+     'WHERE w.user_id = ? ORDER BY w.created_at DESC LIMIT ?', (1, 10)),
+    ('get_top_users', 'SELECT user_id, username, message_count FROM users ORDER BY message_count DESC LIMIT ?', (10,)),
+    ('get_top_users_by_balance',
+     'SELECT ub.user_id, u.username, ub.balance FROM user_balances ub LEFT JOIN users u ON ub.user_id = u.user_id '
+     'WHERE ub.balance > 0 ORDER BY ub.balance DESC LIMIT ?', (10,)),
+    ('get_warned_users_page',
+     'SELECT w.user_id, COUNT(*) FROM warnings w WHERE w.chat_id = ? AND (w.user_id) > (?) '
+     'GROUP BY w.user_id ORDER BY w.user_id ASC LIMIT ?', (1, 0, 21)),
+    ('get_chat_staff_page',
+     'SELECT cr.id FROM chat_roles cr WHERE cr.chat_id = ? AND cr.is_active = 1 AND cr.role_level >= 10 '
+     'ORDER BY cr.role_level DESC, cr.id DESC LIMIT ?', (1, 21)),
+    ('get_chat_permissions',
+     'SELECT user_id, role_level, role_name FROM chat_roles WHERE chat_id = ? AND is_active = 1 ORDER BY user_id', (1,)),
+    ('get_due_broadcast_peers',
+     "SELECT peer_id, attempts FROM broadcast_deliveries WHERE job_id = ? AND status = 'pending' "
+     'AND (next_attempt_at IS NULL OR next_attempt_at <= ?) LIMIT ?', (1, 0, 100)),
+)
+
+def sample_multiplier(tiers):
+    """Выбирает множитель по таблице (накопленная вероятность, от, до)"""
+    rand = random.random()
+    for threshold, low, high in tiers:
+        if rand < threshold:
+            return random.uniform(low, high)
+    return random.uniform(tiers[-1][1], tiers[-1][2])
+
+def parse_db_datetime(value):
+    """Разбирает дату из БД (isoformat или формат SQLite), None если даты нет"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+# Латинские буквы и цифры, похожие на кириллицу: при нормализации приводятся к кириллице
+FILTER_HOMOGLYPHS = str.maketrans({
+    'a': 'а', 'b': 'в', 'c': 'с', 'e': 'е', 'h': 'н', 'k': 'к', 'm': 'м', 'o': 'о',
+    'p': 'р', 't': 'т', 'u': 'и', 'x': 'х', 'y': 'у', '0': 'о', '3': 'з', '4': 'ч',
+    '6': 'б', 'ё': 'е', '@': 'а', '$': 'с'
+})
+
+def normalize_filter_text(text, homoglyphs=False):
+    """Приводит текст к виду для проверки фильтром: нижний регистр и, по желанию, замена похожих символов"""
+    text = text.lower()
+    if homoglyphs:
+        text = text.translate(FILTER_HOMOGLYPHS)
+    return text
+
+class WordFilterMatcher:
+    """Автомат Ахо-Корасик: находит все запрещенные слова за один проход по сообщению"""
+
+    def __init__(self, words, homoglyphs=False):
+        self.words = list(words)
+        self.homoglyphs = homoglyphs
+        self.transitions = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+
+        for index, word in enumerate(self.words):
+            pattern = normalize_filter_text(word, homoglyphs)
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][char] = next_state
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                state = next_state
+            self.outputs[state].append(index)
+
+        # Ссылки неудач строим обходом в ширину
+        pending = list(self.transitions[0].values())
+        while pending:
+            current = []
+            for state in pending:
+                for char, next_state in self.transitions[state].items():
+                    fallback = self.fail[state]
+                    while fallback and char not in self.transitions[fallback]:
+                        fallback = self.fail[fallback]
+                    target = self.transitions[fallback].get(char, 0)
+                    self.fail[next_state] = target if target != next_state else 0
+                    self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+                    current.append(next_state)
+            pending = current
+
+    def find_all(self, text):
+        """Возвращает все найденные слова в порядке их появления в тексте"""
+        found = []
+        seen = set()
+        state = 0
+        transitions = self.transitions
+        fail = self.fail
+        for char in normalize_filter_text(text, self.homoglyphs):
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            for index in self.outputs[state]:
+                if index not in seen:
+                    seen.add(index)
+                    found.append(self.words[index])
+        return found
+
+class ModerationIndex:
+    """Копия активных мутов, системных банов и фильтров в памяти для проверки каждого сообщения"""
+
     def __init__(self):
-        self.db_path = CONFIG.get('database_path', 'bot_lox.sqlite')
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.mutes = {}
+        self.mute_keys = {}
+        self.system_bans = {}
+        self.filters = {}
+        self.matchers = {}
+        self.filter_homoglyphs = CONFIG.get('filter_homoglyphs', False)
+
+    def load(self, conn):
+        """Загружает состояние из БД при старте"""
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM mutes WHERE is_active = 1 ORDER BY created_at ASC, id ASC')
+        mutes = cursor.fetchall()
+        cursor.execute('SELECT * FROM system_bans WHERE is_active = 1 ORDER BY created_at ASC, id ASC')
+        bans = cursor.fetchall()
+        cursor.execute('SELECT chat_id, word FROM filtered_words ORDER BY word ASC')
+        words = cursor.fetchall()
+
+        with self.lock:
+            self.mutes.clear()
+            self.mute_keys.clear()
+            self.system_bans.clear()
+            self.filters.clear()
+            self.matchers.clear()
+        for mute in mutes:
+            self.set_mute(mute)
+        for ban in bans:
+            self.set_system_ban(ban)
+        with self.lock:
+            for row in words:
+                self.filters.setdefault(row['chat_id'], []).append(row['word'])
+            for chat_id in self.filters:
+                self._rebuild_matcher(chat_id)
+
+    def set_mute(self, row):
+        """Сохраняет мут; возвращает замененный мут того же пользователя в чате"""
+        mute = dict(row)
+        key = (mute['user_id'], mute['chat_id'])
+        with self.lock:
+            old = self.mutes.get(key)
+            if old:
+                self.mute_keys.pop(old[0]['id'], None)
+            self.mutes[key] = (mute, parse_db_datetime(mute['mute_until']))
+            self.mute_keys[mute['id']] = key
+        return old[0] if old else None
+
+    def get_mute(self, user_id, chat_id):
+        item = self.mutes.get((user_id, chat_id))
+        if not item:
+            return None
+        mute, mute_until = item
+        if mute_until is None or mute_until <= datetime.now():
+            return None
+        return mute
+
+    def get_mute_by_id(self, mute_id):
+        key = self.mute_keys.get(mute_id)
+        item = self.mutes.get(key) if key else None
+        return item[0] if item else None
+
+    def remove_mute(self, user_id, chat_id):
+        with self.lock:
+            item = self.mutes.pop((user_id, chat_id), None)
+            if item:
+                self.mute_keys.pop(item[0]['id'], None)
+        return item[0] if item else None
+
+    def remove_mute_by_id(self, mute_id):
+        with self.lock:
+            key = self.mute_keys.pop(mute_id, None)
+            item = self.mutes.pop(key, None) if key else None
+        return item[0] if item else None
+
+    def set_system_ban(self, row):
+        ban = dict(row)
+        with self.lock:
+            self.system_bans[ban['user_id']] = (ban, parse_db_datetime(ban['banned_until']))
+
+    def get_system_ban(self, user_id):
+        item = self.system_bans.get(user_id)
+        if not item:
+            return None
+        ban, banned_until = item
+        if ban['banned_until'] and (banned_until is None or banned_until <= datetime.now()):
+            return None
+        return ban
+
+    def remove_system_ban(self, user_id):
+        with self.lock:
+            self.system_bans.pop(user_id, None)
+
+    def _rebuild_matcher(self, chat_id):
+        words = self.filters.get(chat_id)
+        if words:
+            self.matchers[chat_id] = WordFilterMatcher(words, self.filter_homoglyphs)
+        else:
+            self.matchers.pop(chat_id, None)
+
+    def add_filtered_word(self, chat_id, word):
+        with self.lock:
+            words = set(self.filters.get(chat_id, []))
+            words.add(word)
+            self.filters[chat_id] = sorted(words)
+            self._rebuild_matcher(chat_id)
+
+    def remove_filtered_word(self, chat_id, word):
+        with self.lock:
+            words = [w for w in self.filters.get(chat_id, []) if w != word]
+            if words:
+                self.filters[chat_id] = words
+            else:
+                self.filters.pop(chat_id, None)
+            self._rebuild_matcher(chat_id)
+
+    def get_filtered_words(self, chat_id):
+        return list(self.filters.get(chat_id, []))
+
+    def find_filtered_words(self, chat_id, text):
+        matcher = self.matchers.get(chat_id)
+        if not matcher:
+            return []
+        return matcher.find_all(text)
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, сообщающий время выполнения запросов в on_query (для трассировки).
+
+    SQLite выполняет запрос по мере чтения строк, поэтому замеряется и выборка: fetch* и итерация."""
+
+    on_query = None
+
+    def _timed(self, call, *args):
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            self.on_query(time.perf_counter() - started)
+
+    def execute(self, *args):
+        return self._timed(super().execute, *args)
+
+    def executemany(self, *args):
+        return self._timed(super().executemany, *args)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение, курсоры которого замеряют запросы; conn.execute тоже идет через них"""
+
+    on_query = None
+
+    def cursor(self, factory=TimedCursor):
+        cursor = super().cursor(factory)
+        cursor.on_query = self.on_query
+        return cursor
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def _timed(self, call, *args):
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            self.on_query(time.perf_counter() - started)
+
+    def commit(self):
+        self._timed(super().commit)
+
+    def rollback(self):
+        self._timed(super().rollback)
+
+    def __exit__(self, *exc_info):
+        # with conn: фиксирует транзакцию в C-коде, минуя commit() выше
+        return self._timed(super().__exit__, *exc_info)
+
+class SQLiteConnectionManager:
+    """Выдает каждому потоку собственное соединение SQLite в режиме WAL"""
+
+    def __init__(self, path, busy_timeout=5000, cache_size=-16000, synchronous='NORMAL', on_query=None):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.cache_size = cache_size
+        self.synchronous = synchronous
+        # Колбэк on_query(seconds) получает время каждого запроса; без него соединения обычные
+        self.on_query = on_query
+        self.local = threading.local()
+        self.connections = {}
+        self.lock = threading.Lock()
+        # База в памяти существует только внутри одного соединения
+        self.shared = None
+        if path == ':memory:':
+            self.shared = self._connect()
+
+    def _connect(self):
+        if self.on_query is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000, check_same_thread=False,
+                                   factory=TimedConnection)
+            conn.on_query = self.on_query
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+        conn.execute(f'PRAGMA cache_size = {int(self.cache_size)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def get(self):
+        """Соединение текущего потока, создается при первом обращении"""
+        if self.shared is not None:
+            return self.shared
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self.local.conn = conn
+            with self.lock:
+                self.connections[threading.get_ident()] = conn
+                self._prune()
+        return conn
+
+    def _prune(self):
+        """Закрывает соединения потоков, которые уже завершились"""
+        alive = {thread.ident for thread in threading.enumerate()}
+        for ident in [ident for ident in self.connections if ident not in alive]:
+            try:
+                self.connections.pop(ident).close()
+            except Exception:
+                pass
+
+    def close_all(self):
+        with self.lock:
+            for conn in self.connections.values():
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self.connections.clear()
+        if self.shared is not None:
+            self.shared.close()
+
+class MessageCountBuffer:
+    """Копит приращения счетчиков сообщений и пишет их в БД пачкой"""
+
+    def __init__(self, db, flush_interval=2.0, max_events=500):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.pending = {}
+        self.events = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, daemon=True, name="message-counts")
+        self.thread.start()
+
+    def add(self, user_id, count=1):
+        with self.lock:
+            self.pending[user_id] = self.pending.get(user_id, 0) + count
+            self.events += 1
+            if self.events >= self.max_events:
+                self.wakeup.set()
+
+    def get(self, user_id):
+        """Еще не записанное в БД приращение для пользователя"""
+        with self.lock:
+            return self.pending.get(user_id, 0)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.pending)
+
+    def flush(self):
+        """Записывает накопленные приращения одной транзакцией"""
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                batch = list(self.pending.items())
+                self.pending = {}
+                self.events = 0
+
+            try:
+                conn = self.db.conn
+                conn.executemany('''
+                    INSERT INTO users (user_id, message_count) VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET message_count = message_count + excluded.message_count
+                ''', batch)
+                conn.commit()
+            except Exception as e:
+                # Возвращаем приращения обратно, чтобы не потерять их
+                with self.lock:
+                    for user_id, count in batch:
+                        self.pending[user_id] = self.pending.get(user_id, 0) + count
+                print(f"Ошибка записи счетчиков сообщений: {e}")
+                return 0
+            return len(batch)
+
+    def _loop(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        """Останавливает фоновую запись и сбрасывает остаток в БД"""
+        self.running = False
+        self.wakeup.set()
+        self.thread.join(5.0)
+        self.flush()
+
+class ChatRoleRecord:
+    """Роль участника из ChatRoleRoster; читается как строка БД: record['role_level'], dict(record)"""
+    __slots__ = ('user_id', 'chat_id', 'role_level', 'role_name')
+
+    def __init__(self, user_id, chat_id, role_level, role_name):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.role_level = role_level
+        self.role_name = role_name
+
+    def keys(self):
+        return self.__slots__
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+class ChatRoleRoster:
+    """Роли беседы в параллельных массивах, отсортированных по user_id.
+
+    Вместо словаря на каждую строку chat_roles хранится 8 байт id, 8 байт уровня и 2 байта
+    на индекс названия роли (названия повторяются, их хранится по одному экземпляру).
+    Поиск роли — бинарный, соединение с составом беседы — слиянием отсортированных id."""
+    __slots__ = ('chat_id', 'user_ids', 'levels', 'name_ids', 'names')
+
+    def __init__(self, chat_id, rows=()):
+        """rows — пары (user_id, role_level, role_name), отсортированные по user_id"""
+        self.chat_id = chat_id
+        self.user_ids = array('q')
+        self.levels = array('q')
+        self.name_ids = array('H')
+        self.names = []
+        name_index = {}
+        for user_id, role_level, role_name in rows:
+            name_id = name_index.get(role_name)
+            if name_id is None:
+                name_id = name_index[role_name] = len(self.names)
+                self.names.append(role_name)
+            self.user_ids.append(user_id)
+            self.levels.append(role_level)
+            self.name_ids.append(name_id)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def _index(self, user_id):
+        position = bisect_left(self.user_ids, user_id)
+        if position < len(self.user_ids) and self.user_ids[position] == user_id:
+            return position
+        return -1
+
+    def _record(self, position):
+        return ChatRoleRecord(self.user_ids[position], self.chat_id,
+                              self.levels[position], self.names[self.name_ids[position]])
+
+    def get(self, user_id, default=None):
+        position = self._index(user_id)
+        return self._record(position) if position >= 0 else default
+
+    def join_levels(self, member_ids):
+        """Уровни ролей для отсортированных member_ids (0 — без роли), слиянием за один проход"""
+        levels = array('q', bytes(8 * len(member_ids)))
+        user_ids = self.user_ids
+        position, total = 0, len(user_ids)
+        for index, member_id in enumerate(member_ids):
+            while position < total and user_ids[position] < member_id:
+                position += 1
+            if position == total:
+                break
+            if user_ids[position] == member_id:
+                levels[index] = self.levels[position]
+        return levels
+
+    def count_at_least(self, min_level, member_ids=None):
+        """Сколько ролей не ниже min_level; с member_ids — только среди этих участников"""
+        levels = self.levels if member_ids is None else self.join_levels(member_ids)
+        return sum(1 for level in levels if level >= min_level)
+
+class Database:
+    def __init__(self, db_path=None, on_query=None):
+        self.db_path = db_path or CONFIG.get('database_path', 'bot_lox.sqlite')
+        self.connections = SQLiteConnectionManager(
+            self.db_path,
+            busy_timeout=CONFIG.get('database_busy_timeout_ms', 5000),
+            cache_size=CONFIG.get('database_cache_size', -16000),
+            on_query=on_query
+        )
         self.initialize_tables()
+        if CONFIG.get('check_query_plans', True):
+            for name, detail in self.check_query_plans():
+                print(f"⚠️ Запрос {name} не использует индекс: {detail}")
+        self.moderation = ModerationIndex()
+        self.moderation.load(self.conn)
+        self.mute_listeners = []
+        self.permission_snapshots = {}
+        self.permission_generation = 0
+        self.permission_lock = threading.Lock()
+        self.message_counts = MessageCountBuffer(
+            self,
+            flush_interval=CONFIG.get('message_count_flush_ms', 2000) / 1000,
+            max_events=CONFIG.get('message_count_flush_events', 500)
+        )
         print("Подключение к SQLite базе данных успешно.")
 
     def initialize_tables(self):
         cursor = self.conn.cursor()
 
-        # Создаем индексы для оптимизации запросов по чатам
-        self.create_chat_specific_indexes()
-
         # Таблица пользователей
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -169,6 +813,20 @@ class Database:
             )
         ''')
 
+        # Журнал изменений баланса (только добавление записей)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS balance_ledger (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                reason TEXT,
+                reference TEXT,
+                batch_id TEXT,
+                idempotency_key TEXT UNIQUE,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
         # Таблица ролей в чатах
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS chat_roles (
@@ -229,9 +887,11 @@ class Database:
             CREATE TABLE IF NOT EXISTS roulette_games (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 chat_id INTEGER,
+                peer_id INTEGER,
                 status TEXT DEFAULT 'active',
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                 ended_at DATETIME,
+                settle_at REAL,
                 winning_number INTEGER,
                 is_active BOOLEAN DEFAULT 1
             )
@@ -257,9 +917,12 @@ class Database:
             CREATE TABLE IF NOT EXISTS crash_games (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 chat_id INTEGER,
+                peer_id INTEGER,
+                game_type TEXT DEFAULT 'crash',
                 status TEXT DEFAULT 'active',
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                 ended_at DATETIME,
+                settle_at REAL,
                 crash_multiplier REAL,
                 is_active BOOLEAN DEFAULT 1
             )
@@ -284,6 +947,7 @@ class Database:
             CREATE TABLE IF NOT EXISTS dice_games (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 chat_id INTEGER,
+                peer_id INTEGER,
                 creator_id INTEGER,
                 creator_username TEXT,
                 bet_amount INTEGER,
@@ -309,6 +973,20 @@ class Database:
             )
         ''')
 
+        # Колонки состояния игровых раундов (миграция для существующих БД)
+        for table, column, definition in (
+            ('roulette_games', 'peer_id', 'INTEGER'),
+            ('roulette_games', 'settle_at', 'REAL'),
+            ('crash_games', 'peer_id', 'INTEGER'),
+            ('crash_games', 'game_type', "TEXT DEFAULT 'crash'"),
+            ('crash_games', 'settle_at', 'REAL'),
+            ('dice_games', 'peer_id', 'INTEGER'),
+        ):
+            try:
+                cursor.execute(f'SELECT {column} FROM {table} LIMIT 1')
+            except sqlite3.OperationalError:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
         # Таблица зарегистрированных бесед
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS registered_chats (
@@ -381,11 +1059,51 @@ class Database:
             )
         ''')
 
+        # Таблица отложенных задач планировщика (переживают перезапуск)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                job_key TEXT PRIMARY KEY,
+                method TEXT NOT NULL,
+                args TEXT,
+                due_at REAL NOT NULL,
+                interval REAL
+            )
+        ''')
+
+        # Задания рассылки и журнал доставки по каждому получателю
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_by INTEGER,
+                reply_peer_id INTEGER,
+                message TEXT NOT NULL,
+                status TEXT DEFAULT 'running',
+                total INTEGER DEFAULT 0,
+                started_at REAL,
+                finished_at REAL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                job_id INTEGER NOT NULL,
+                peer_id INTEGER NOT NULL,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL,
+                delivered_at REAL,
+                error TEXT,
+                PRIMARY KEY (job_id, peer_id)
+            ) WITHOUT ROWID
+        ''')
+
         self.conn.commit()
         print("Таблицы базы данных инициализированы.")
 
         # Создаем индексы после создания таблиц
         self.create_chat_specific_indexes()
+        self.apply_schema_migrations()
 
     def create_chat_specific_indexes(self):
         """Создает индексы для оптимизации запросов по чатам"""
@@ -393,16 +1111,20 @@ class Database:
 
         # Индексы для ускорения поиска по чатам
         indexes = [
-            'CREATE INDEX IF NOT EXISTS idx_chat_roles_chat_id ON chat_roles(chat_id)',
             'CREATE INDEX IF NOT EXISTS idx_chat_roles_user_chat ON chat_roles(user_id, chat_id)',
+            'CREATE INDEX IF NOT EXISTS idx_chat_roles_staff ON chat_roles(chat_id, role_level)',
+            'CREATE INDEX IF NOT EXISTS idx_chat_nicknames_chat_id ON chat_nicknames(chat_id)',
             'CREATE INDEX IF NOT EXISTS idx_custom_role_definitions_chat ON custom_role_definitions(chat_id, role_level)',
-            'CREATE INDEX IF NOT EXISTS idx_warnings_chat_id ON warnings(chat_id)',
+            'CREATE INDEX IF NOT EXISTS idx_warnings_chat_user ON warnings(chat_id, user_id)',
             'CREATE INDEX IF NOT EXISTS idx_mutes_chat_id ON mutes(chat_id)',
+            'CREATE INDEX IF NOT EXISTS idx_mutes_active_until ON mutes(mute_until) WHERE is_active = 1 AND mute_until IS NOT NULL',
             'CREATE INDEX IF NOT EXISTS idx_chat_bans_chat_id ON chat_bans(chat_id)',
             'CREATE INDEX IF NOT EXISTS idx_roulette_games_chat_id ON roulette_games(chat_id)',
             'CREATE INDEX IF NOT EXISTS idx_crash_games_chat_id ON crash_games(chat_id)',
             'CREATE INDEX IF NOT EXISTS idx_dice_games_chat_id ON dice_games(chat_id)',
-            'CREATE INDEX IF NOT EXISTS idx_dice_players_game_id ON dice_players(game_id)'
+            'CREATE INDEX IF NOT EXISTS idx_dice_players_game_id ON dice_players(game_id)',
+            'CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger(user_id, id)',
+            'CREATE INDEX IF NOT EXISTS idx_balance_ledger_batch ON balance_ledger(batch_id) WHERE batch_id IS NOT NULL'
         ]
 
         for index_sql in indexes:
@@ -414,6 +1136,41 @@ class Database:
         self.conn.commit()
         print("Индексы для чат-специфичных данных созданы.")
 
+    def apply_schema_migrations(self):
+        """Применяет миграции из SCHEMA_MIGRATIONS новее PRAGMA user_version, каждую в своей транзакции"""
+        conn = self.conn
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        for version, description, statements in SCHEMA_MIGRATIONS:
+            if version <= current:
+                continue
+            try:
+                with conn:
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute(f'PRAGMA user_version = {int(version)}')
+            except sqlite3.Error as e:
+                print(f"❌ Ошибка миграции схемы v{version} ({description}): {e}")
+                return
+            current = version
+            print(f"Миграция схемы v{version} применена: {description}")
+
+        # Обновляет статистику планировщика запросов, если она устарела
+        conn.execute('PRAGMA optimize')
+
+    def check_query_plans(self):
+        """Проверяет планы горячих запросов (QUERY_PLAN_CHECKS) через EXPLAIN QUERY PLAN.
+
+        Возвращает список (название, строка плана) для полных проходов по таблицам и сортировок
+        без индекса; пустой список — регрессий нет."""
+        problems = []
+        for name, sql, params in QUERY_PLAN_CHECKS:
+            for row in self.conn.execute(f'EXPLAIN QUERY PLAN {sql}', params):
+                detail = row['detail']
+                full_scan = detail.startswith('SCAN ') and ' INDEX ' not in detail
+                if full_scan or 'USE TEMP B-TREE' in detail:
+                    problems.append((name, detail))
+        return problems
+
     def get_chat_custom_roles(self, chat_id):
         """Получает все кастомные роли для конкретного чата"""
         cursor = self.conn.cursor()
@@ -464,13 +1221,16 @@ class Database:
         )
         self.conn.commit()
 
+        cursor.execute('SELECT * FROM mutes WHERE id = ?', (cursor.lastrowid,))
+        mute = cursor.fetchone()
+        replaced = self.moderation.set_mute(mute)
+        if replaced:
+            self.notify_mute_listeners(replaced, False)
+        self.notify_mute_listeners(dict(mute), True)
+
     def get_active_mute_in_chat(self, user_id, chat_id):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'SELECT * FROM mutes WHERE user_id = ? AND chat_id = ? AND is_active = 1 AND mute_until > datetime("now") ORDER BY created_at DESC LIMIT 1',
-            (user_id, chat_id)
-        )
-        return cursor.fetchone()
+        # Читаем из индекса в памяти, без запроса к БД
+        return self.moderation.get_mute(user_id, chat_id)
 
     def remove_mute(self, user_id, chat_id):
         cursor = self.conn.cursor()
@@ -479,6 +1239,20 @@ class Database:
             (user_id, chat_id)
         )
         self.conn.commit()
+        removed = self.moderation.remove_mute(user_id, chat_id)
+        if removed:
+            self.notify_mute_listeners(removed, False)
+
+    def add_mute_listener(self, callback):
+        """Подписаться на изменения мутов: callback(mute, active)"""
+        self.mute_listeners.append(callback)
+
+    def notify_mute_listeners(self, mute, active):
+        for callback in self.mute_listeners:
+            try:
+                callback(mute, active)
+            except Exception as e:
+                print(f"Ошибка обработчика изменения мута: {e}")
 
     def add_chat_ban(self, user_id, chat_id, reason, banned_by):
         cursor = self.conn.cursor()
@@ -510,18 +1284,98 @@ class Database:
         )
         self.conn.commit()
 
+    def add_chat_bans(self, user_id, chat_ids, reason, banned_by):
+        """Банит пользователя сразу в нескольких чатах одной транзакцией"""
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE chat_bans SET is_active = 0 WHERE user_id = ? AND chat_id = ?',
+                [(user_id, chat_id) for chat_id in chat_ids]
+            )
+            self.conn.executemany(
+                'INSERT INTO chat_bans (user_id, chat_id, reason, banned_by) VALUES (?, ?, ?, ?)',
+                [(user_id, chat_id, reason, banned_by) for chat_id in chat_ids]
+            )
+
+    def remove_chat_bans(self, user_id, chat_ids):
+        """Снимает баны пользователя в нескольких чатах одной транзакцией, возвращает чаты, где бан был"""
+        if not chat_ids:
+            return []
+        placeholders = ','.join('?' * len(chat_ids))
+        with self.conn:
+            banned = [row['chat_id'] for row in self.conn.execute(
+                f'SELECT DISTINCT chat_id FROM chat_bans WHERE user_id = ? AND is_active = 1 AND chat_id IN ({placeholders})',
+                (user_id, *chat_ids)
+            )]
+            self.conn.execute(
+                f'UPDATE chat_bans SET is_active = 0 WHERE user_id = ? AND is_active = 1 AND chat_id IN ({placeholders})',
+                (user_id, *chat_ids)
+            )
+        return banned
+
+    def get_chat_union(self, chat_id):
+        """Объединение, в которое входит чат"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT cu.id, cu.union_name
+            FROM chat_unions cu
+            JOIN union_chats uc ON cu.id = uc.union_id
+            WHERE uc.chat_id = ?
+        ''', (chat_id,))
+        return cursor.fetchone()
+
+    def get_union_chat_ids(self, union_id):
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT chat_id FROM union_chats WHERE union_id = ? ORDER BY chat_id', (union_id,))
+        return [row['chat_id'] for row in cursor.fetchall()]
+
     def get_system_admin(self, user_id):
         cursor = self.conn.cursor()
         cursor.execute('SELECT * FROM system_admins WHERE user_id = ?', (user_id,))
         return cursor.fetchone()
 
-    def get_chat_role(self, user_id, chat_id):
+    def get_chat_permissions(self, chat_id):
+        """Снимок прав беседы: роли участников (ChatRoleRoster), кастомные названия ролей и уровни команд.
+
+        Строится один раз и живет до invalidate_chat_permissions.
+        """
+        snapshot = self.permission_snapshots.get(chat_id)
+        if snapshot is not None:
+            return snapshot
+
+        generation = self.permission_generation
         cursor = self.conn.cursor()
+        # Роли читаются курсором прямо в массивы, без промежуточного списка строк
         cursor.execute(
-            'SELECT * FROM chat_roles WHERE user_id = ? AND chat_id = ? AND is_active = 1',
-            (user_id, chat_id)
+            'SELECT user_id, role_level, role_name FROM chat_roles WHERE chat_id = ? AND is_active = 1 ORDER BY user_id',
+            (chat_id,)
         )
-        return cursor.fetchone()
+        roles = ChatRoleRoster(chat_id, cursor)
+        cursor.execute(
+            'SELECT role_level, role_name FROM custom_role_definitions WHERE chat_id = ? AND is_active = 1',
+            (chat_id,)
+        )
+        custom_roles = {row['role_level']: row['role_name'] for row in cursor.fetchall()}
+        cursor.execute('SELECT command, required_level FROM command_permissions WHERE chat_id = ?', (chat_id,))
+        commands = {row['command']: row['required_level'] for row in cursor.fetchall()}
+
+        snapshot = {'roles': roles, 'custom_roles': custom_roles, 'commands': commands}
+        with self.permission_lock:
+            # Если права успели измениться во время чтения, снимок не сохраняем
+            if generation == self.permission_generation:
+                self.permission_snapshots[chat_id] = snapshot
+        return snapshot
+
+    def invalidate_chat_permissions(self, chat_id=None):
+        """Сбрасывает снимок прав беседы (или всех бесед, если chat_id не указан)"""
+        with self.permission_lock:
+            self.permission_generation += 1
+            if chat_id is None:
+                self.permission_snapshots.clear()
+            else:
+                self.permission_snapshots.pop(chat_id, None)
+
+    def get_chat_role(self, user_id, chat_id):
+        return self.get_chat_permissions(chat_id)['roles'].get(user_id)
 
     def set_chat_role(self, user_id, chat_id, role_level, role_name, granted_by):
         cursor = self.conn.cursor()
@@ -531,6 +1385,7 @@ class Database:
             VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, 1)
         ''', (user_id, chat_id, role_level, role_name, granted_by))
         self.conn.commit()
+        self.invalidate_chat_permissions(chat_id)
 
     def get_immunity(self, user_id, chat_id=None):
         cursor = self.conn.cursor()
@@ -566,85 +1421,144 @@ class Database:
         return dict(result)
 
     def set_user_balance(self, user_id, amount):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'INSERT OR IGNORE INTO user_balances (user_id) VALUES (?)',
-            (user_id,)
-        )
-        cursor.execute(
-            'UPDATE user_balances SET balance = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?',
-            (amount, user_id)
-        )
-        self.conn.commit()
+        """Устанавливает баланс; в журнал пишется разница со старым значением"""
+        conn = self.conn
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO user_balances (user_id) VALUES (?)', (user_id,))
+            current = conn.execute('SELECT balance FROM user_balances WHERE user_id = ?', (user_id,)).fetchone()
+            delta = amount - (current['balance'] or 0)
+            if delta:
+                self._apply_balance_change(conn, user_id, delta, 'set')
 
     def can_afford_bet(self, user_id, amount):
         balance = self.get_user_balance(user_id)
         return balance and balance['balance'] >= amount
 
-    def claim_bonus(self, user_id):
+    def debit_balance(self, user_id, amount, reason, reference=None, idempotency_key=None):
+        """Атомарно списывает сумму, только если на балансе достаточно средств.
+
+        Возвращает LEDGER_APPLIED, LEDGER_INSUFFICIENT или LEDGER_DUPLICATE (операция с этим ключом уже была)."""
+        conn = self.conn
+        with conn:
+            result = self._apply_balance_change(conn, user_id, -amount, reason, reference, idempotency_key,
+                                                require_funds=True)
+            if result == LEDGER_INSUFFICIENT:
+                conn.rollback()
+        return result
+
+    def credit_balance(self, user_id, amount, reason, reference=None, idempotency_key=None):
+        """Начисляет сумму (отрицательная сумма списывает без проверки остатка)"""
+        conn = self.conn
+        with conn:
+            return self._apply_balance_change(conn, user_id, amount, reason, reference, idempotency_key)
+
+    def get_balance_ledger(self, user_id, limit=20):
+        """Последние записи журнала баланса пользователя"""
         cursor = self.conn.cursor()
         cursor.execute(
-            'UPDATE user_balances SET last_bonus_claim = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?',
-            (user_id,)
+            'SELECT * FROM balance_ledger WHERE user_id = ? ORDER BY id DESC LIMIT ?',
+            (user_id, limit)
         )
-        self.conn.commit()
-
-    def can_claim_bonus(self, user_id):
-        balance_data = self.get_user_balance(user_id)
-        if not balance_data:
-            return True  # Если пользователя нет, то бонус можно получить
-
-        last_claim_time = balance_data['last_bonus_claim']
-        if not last_claim_time or last_claim_time == datetime.min:
-            return True
-
-        # Ensure last_claim_time is a datetime object for comparison
-        if isinstance(last_claim_time, str):
-            try:
-                last_claim_time = datetime.fromisoformat(last_claim_time)
-            except ValueError:
-                return True # If parsing fails, allow bonus claim
-
-        # Если прошел час с последнего получения бонуса
-        return datetime.now() >= last_claim_time + timedelta(hours=1)
+        return cursor.fetchall()
 
-    def get_all_users_with_nicknames(self, chat_id=None):
-        cursor = self.conn.cursor()
-        if chat_id:
-            cursor.execute(
-                'SELECT user_id, nickname FROM chat_nicknames WHERE chat_id = ? AND is_active = 1',
-                (chat_id,)
+    def _apply_balance_change(self, conn, user_id, amount, reason, reference=None, idempotency_key=None,
+                              require_funds=False):
+        """Пишет запись в журнал и меняет баланс внутри уже открытой транзакции"""
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO balance_ledger (user_id, amount, reason, reference, idempotency_key) VALUES (?, ?, ?, ?, ?)',
+            (user_id, amount, reason, reference, idempotency_key)
+        )
+        if cursor.rowcount == 0:
+            return LEDGER_DUPLICATE
+
+        conn.execute('INSERT OR IGNORE INTO user_balances (user_id) VALUES (?)', (user_id,))
+        if require_funds:
+            # Проверка остатка и списание одним оператором: параллельные списания не уведут баланс в минус
+            cursor = conn.execute(
+                'UPDATE user_balances SET balance = balance + ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ? AND balance >= ?',
+                (amount, user_id, -amount)
             )
         else:
-            cursor.execute(
-                'SELECT user_id, username, nickname FROM users WHERE nickname IS NOT NULL AND nickname != ""'
+            cursor = conn.execute(
+                'UPDATE user_balances SET balance = balance + ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?',
+                (amount, user_id)
             )
-        return cursor.fetchall()
-
-    def get_all_users_without_nicknames(self, chat_id=None):
-        cursor = self.conn.cursor()
-        if chat_id:
-            # Получаем пользователей из чата без никнеймов
-            cursor.execute('''
-                SELECT cr.user_id, u.username 
-                FROM chat_roles cr
-                LEFT JOIN chat_nicknames cn ON cr.user_id = cn.user_id AND cr.chat_id = cn.chat_id AND cn.is_active = 1
-                LEFT JOIN users u ON cr.user_id = u.user_id
-                WHERE cr.chat_id = ? AND cr.is_active = 1 AND cn.id IS NULL
-            ''', (chat_id,))
-        else:
-            cursor.execute(
-                'SELECT user_id, username FROM users WHERE nickname IS NULL OR nickname = ""'
+        return LEDGER_APPLIED if cursor.rowcount == 1 else LEDGER_INSUFFICIENT
+
+    def claim_bonus(self, user_id, amount):
+        """Отмечает получение бонуса и начисляет его одной транзакцией; False - интервал еще не прошел.
+
+        Отметка ставится условным UPDATE: из параллельных запросов (в том числе из разных процессов)
+        его проходит ровно один, и начисляет только он."""
+        conn = self.conn
+        with conn:
+            # Новый пользователь получает бонус сразу, а не через интервал после создания строки
+            conn.execute('INSERT OR IGNORE INTO user_balances (user_id, last_bonus_claim) VALUES (?, NULL)', (user_id,))
+            cursor = conn.execute(
+                '''UPDATE user_balances SET last_bonus_claim = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                   WHERE user_id = ? AND (last_bonus_claim IS NULL OR last_bonus_claim <= datetime('now', ?))''',
+                (user_id, f'-{BONUS_INTERVAL_HOURS} hours')
             )
-        return cursor.fetchall()
+            if cursor.rowcount != 1:
+                return False
+            self._apply_balance_change(conn, user_id, amount, 'bonus')
+        return True
 
-    def get_all_active_chat_bans(self, chat_id):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'SELECT * FROM chat_bans WHERE chat_id = ? AND is_active = 1 ORDER BY created_at DESC',
-            (chat_id,)
+    def _keyset_page(self, query, params, keys, descending=False, cursor=None, backward=False, limit=20):
+        """Страница выборки по ключу (keyset) без OFFSET: читает limit + 1 строк после курсора.
+
+        query содержит {keyset} (дополнительное условие WHERE) и {order}; keys — пары
+        (SQL-выражение, колонка результата), вместе однозначно упорядочивающие строки.
+        backward=True читает страницу перед курсором. Возвращает строки страницы и курсоры
+        соседних страниц (None, если страницы нет)."""
+        reverse = descending != backward
+        keyset = ''
+        args = list(params)
+        if cursor is not None:
+            keyset = (f" AND ({', '.join(expr for expr, _ in keys)}) {'<' if reverse else '>'} "
+                      f"({', '.join('?' for _ in keys)})")
+            args.extend(cursor)
+        order = ', '.join(f"{expr} {'DESC' if reverse else 'ASC'}" for expr, _ in keys)
+        rows = self.conn.execute(query.format(keyset=keyset, order=order) + ' LIMIT ?', args + [limit + 1]).fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+
+        def key_of(row):
+            return [row[column] for _, column in keys]
+
+        has_prev, has_next = (has_more, cursor is not None) if backward else (cursor is not None, has_more)
+        return {
+            'items': rows,
+            'prev': key_of(rows[0]) if rows and has_prev else None,
+            'next': key_of(rows[-1]) if rows and has_next else None,
+        }
+
+    def get_chat_nicknames_page(self, chat_id, cursor=None, backward=False, limit=20):
+        return self._keyset_page(
+            'SELECT id, user_id, nickname FROM chat_nicknames WHERE chat_id = ? AND is_active = 1{keyset} ORDER BY {order}',
+            (chat_id,), [('id', 'id')], cursor=cursor, backward=backward, limit=limit
+        )
+
+    def get_users_without_nicknames_page(self, chat_id, cursor=None, backward=False, limit=20):
+        """Участники с ролью в чате, у которых нет активного никнейма"""
+        return self._keyset_page('''
+            SELECT cr.id AS role_id, cr.user_id, u.username
+            FROM chat_roles cr
+            LEFT JOIN chat_nicknames cn ON cr.user_id = cn.user_id AND cr.chat_id = cn.chat_id AND cn.is_active = 1
+            LEFT JOIN users u ON cr.user_id = u.user_id
+            WHERE cr.chat_id = ? AND cr.is_active = 1 AND cn.id IS NULL{keyset}
+            ORDER BY {order}
+        ''', (chat_id,), [('cr.id', 'role_id')], cursor=cursor, backward=backward, limit=limit)
+
+    def get_chat_bans_page(self, chat_id, cursor=None, backward=False, limit=20):
+        """Активные баны чата, новые первыми"""
+        return self._keyset_page(
+            'SELECT * FROM chat_bans WHERE chat_id = ? AND is_active = 1{keyset} ORDER BY {order}',
+            (chat_id,), [('id', 'id')], descending=True, cursor=cursor, backward=backward, limit=limit
         )
-        return cursor.fetchall()
 
     def remove_warning(self, user_id):
         cursor = self.conn.cursor()
@@ -705,6 +1619,7 @@ class Database:
             (user_id, chat_id)
         )
         self.conn.commit()
+        self.invalidate_chat_permissions(chat_id)
 
     def get_user_by_nickname(self, nickname, chat_id=None):
         cursor = self.conn.cursor()
@@ -749,7 +1664,28 @@ class Database:
             'SELECT user_id, username, message_count FROM users ORDER BY message_count DESC LIMIT ?',
             (limit,)
         )
-        return cursor.fetchall()
+        top = {row['user_id']: dict(row) for row in cursor.fetchall()}
+
+        # Учитываем приращения, которые еще не записаны в БД
+        pending = self.message_counts.snapshot()
+        if not pending:
+            return list(top.values())
+
+        missing = [user_id for user_id in pending if user_id not in top]
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            cursor.execute(
+                f'SELECT user_id, username, message_count FROM users WHERE user_id IN ({",".join("?" * len(chunk))})',
+                chunk
+            )
+            for row in cursor.fetchall():
+                top[row['user_id']] = dict(row)
+
+        for user_id, count in pending.items():
+            user = top.setdefault(user_id, {'user_id': user_id, 'username': None, 'message_count': 0})
+            user['message_count'] = (user['message_count'] or 0) + count
+
+        return sorted(top.values(), key=lambda user: user['message_count'], reverse=True)[:limit]
 
     def get_top_users_by_balance(self, limit=10):
         cursor = self.conn.cursor()
@@ -764,17 +1700,16 @@ class Database:
         return cursor.fetchall()
 
     def increment_message_count(self, user_id):
+        # Запись в БД идет пачкой через MessageCountBuffer
+        self.message_counts.add(user_id)
+
+    def get_message_count(self, user_id):
+        """Количество сообщений с учетом еще не записанных приращений"""
         cursor = self.conn.cursor()
-        cursor.execute(
-            'UPDATE users SET message_count = message_count + 1 WHERE user_id = ?',
-            (user_id,)
-        )
-        if cursor.rowcount == 0:
-            cursor.execute(
-                'INSERT INTO users (user_id, message_count) VALUES (?, 1)',
-                (user_id,)
-            )
-        self.conn.commit()
+        cursor.execute('SELECT message_count FROM users WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        stored = (row['message_count'] or 0) if row else 0
+        return stored + self.message_counts.get(user_id)
 
     def answer_ticket(self, ticket_id, answer, answered_by):
         cursor = self.conn.cursor()
@@ -784,14 +1719,6 @@ class Database:
         )
         self.conn.commit()
 
-    def get_all_chat_roles(self, chat_id):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'SELECT cr.*, u.username FROM chat_roles cr LEFT JOIN users u ON cr.user_id = u.user_id WHERE cr.chat_id = ? AND cr.is_active = 1 ORDER BY cr.role_level DESC',
-            (chat_id,)
-        )
-        return cursor.fetchall()
-
     def get_warn_history(self, user_id, limit=10):
         cursor = self.conn.cursor()
         cursor.execute(
@@ -814,55 +1741,59 @@ class Database:
             )
         return cursor.fetchall()
 
-    def get_users_with_warnings(self, chat_id):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT 
+    def get_warned_users_page(self, chat_id, cursor=None, backward=False, limit=20):
+        """Пользователи с предупреждениями в чате и их количество.
+
+        Страницы идут по user_id: индекс (chat_id, user_id) позволяет считать только
+        предупреждения пользователей текущей страницы."""
+        return self._keyset_page('''
+            SELECT
                 w.user_id,
                 u.username as user_name,
                 COUNT(*) as warning_count
             FROM warnings w
             LEFT JOIN users u ON w.user_id = u.user_id
-            WHERE w.chat_id = ?
+            WHERE w.chat_id = ?{keyset}
             GROUP BY w.user_id
-            ORDER BY warning_count DESC, w.user_id
-        ''', (chat_id,))
-        return cursor.fetchall()
-
-    def get_users_with_active_mutes(self, chat_id):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT 
+            ORDER BY {order}
+        ''', (chat_id,), [('w.user_id', 'user_id')], cursor=cursor, backward=backward, limit=limit)
+
+    def get_muted_users_page(self, chat_id, cursor=None, backward=False, limit=20):
+        """Действующие муты чата, новые первыми (mute_until хранится как локальное время в isoformat)"""
+        return self._keyset_page('''
+            SELECT
+                m.id AS mute_id,
                 m.user_id,
                 u.username as user_name,
                 m.mute_until,
                 m.reason
             FROM mutes m
             LEFT JOIN users u ON m.user_id = u.user_id
-            WHERE m.chat_id = ? 
-            AND m.is_active = 1 
-            AND (m.mute_until IS NULL OR m.mute_until > datetime("now"))
-            ORDER BY m.mute_until DESC
-        ''', (chat_id,))
-        return cursor.fetchall()
-
-    def update_user_balance(self, user_id, amount):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'INSERT OR IGNORE INTO user_balances (user_id) VALUES (?)',
-            (user_id,)
-        )
-        cursor.execute(
-            'UPDATE user_balances SET balance = balance + ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?',
-            (amount, user_id)
-        )
-        self.conn.commit()
-
-    def create_roulette_game(self, chat_id):
+            WHERE m.chat_id = ?
+            AND m.is_active = 1
+            AND (m.mute_until IS NULL OR m.mute_until > ?){keyset}
+            ORDER BY {order}
+        ''', (chat_id, datetime.now().isoformat()), [('m.id', 'mute_id')], descending=True, cursor=cursor, backward=backward, limit=limit)
+
+    def get_chat_staff_page(self, chat_id, cursor=None, backward=False, limit=20):
+        """Администрация чата (роли от 10 уровня, без сообществ) по убыванию уровня"""
+        return self._keyset_page('''
+            SELECT cr.id AS role_id, cr.user_id, cr.role_name, cr.role_level, u.username
+            FROM chat_roles cr
+            LEFT JOIN users u ON cr.user_id = u.user_id
+            WHERE cr.chat_id = ? AND cr.is_active = 1 AND cr.role_level >= 10 AND cr.user_id > 0{keyset}
+            ORDER BY {order}
+        ''', (chat_id,), [('cr.role_level', 'role_level'), ('cr.id', 'role_id')], descending=True,
+            cursor=cursor, backward=backward, limit=limit)
+
+    def update_user_balance(self, user_id, amount, reason='adjustment', reference=None):
+        self.credit_balance(user_id, amount, reason, reference)
+
+    def create_roulette_game(self, chat_id, peer_id=None):
         cursor = self.conn.cursor()
         cursor.execute(
-            'INSERT INTO roulette_games (chat_id) VALUES (?)',
-            (chat_id,)
+            'INSERT INTO roulette_games (chat_id, peer_id) VALUES (?, ?)',
+            (chat_id, peer_id)
         )
         self.conn.commit()
         return cursor.lastrowid
@@ -870,18 +1801,93 @@ class Database:
     def get_active_roulette_game(self, chat_id):
         cursor = self.conn.cursor()
         cursor.execute(
-            'SELECT * FROM roulette_games WHERE chat_id = ? AND is_active = 1 ORDER BY created_at DESC LIMIT 1',
+            "SELECT * FROM roulette_games WHERE chat_id = ? AND is_active = 1 AND status = 'active' ORDER BY created_at DESC LIMIT 1",
             (chat_id,)
         )
         return cursor.fetchone()
 
-    def add_roulette_bet(self, game_id, user_id, username, bet_type, bet_target, bet_amount):
+    def place_roulette_bet(self, chat_id, peer_id, user_id, username, bet_type, bet_target, bet_amount,
+                           idempotency_key=None):
+        """Списывает ставку и записывает ее в открытый раунд беседы; см. _place_round_bet"""
+        return self._place_round_bet('roulette_games', 'roulette_bets', chat_id, peer_id, {},
+                                     {'username': username, 'bet_type': bet_type, 'bet_target': bet_target},
+                                     user_id, bet_amount, 'roulette_bet', idempotency_key)
+
+    def _place_round_bet(self, games_table, bets_table, chat_id, peer_id, game_values, bet_values,
+                         user_id, amount, reason, idempotency_key=None):
+        """Списывает ставку, находит или создает открытый раунд беседы и записывает ставку одной транзакцией.
+
+        Списание идет первым и берет блокировку записи, поэтому найденный раунд не закроется до коммита,
+        а между списанием и записью ставки нет ни одного запроса к VK. При неуспехе не меняется ничего.
+        Возвращает (LEDGER_APPLIED / LEDGER_INSUFFICIENT / LEDGER_DUPLICATE, game_id, создан ли раунд)."""
+        conn = self.conn
+        with conn:
+            result = self._apply_balance_change(conn, user_id, -amount, reason, None, idempotency_key,
+                                                require_funds=True)
+            if result != LEDGER_APPLIED:
+                if result == LEDGER_INSUFFICIENT:
+                    conn.rollback()
+                return result, None, False
+
+            game = conn.execute(
+                f"SELECT id FROM {games_table} WHERE chat_id = ? AND is_active = 1 AND status = 'active' "
+                "ORDER BY created_at DESC LIMIT 1",
+                (chat_id,)
+            ).fetchone()
+            created = game is None
+            if created:
+                columns = {'chat_id': chat_id, 'peer_id': peer_id, **game_values}
+                game_id = conn.execute(
+                    f"INSERT INTO {games_table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                    tuple(columns.values())
+                ).lastrowid
+            else:
+                game_id = game['id']
+
+            columns = {'game_id': game_id, 'user_id': user_id, **bet_values, 'bet_amount': amount}
+            conn.execute(
+                f"INSERT INTO {bets_table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                tuple(columns.values())
+            )
+        return LEDGER_APPLIED, game_id, created
+
+    def set_roulette_round(self, game_id, settle_at):
+        """Сдвигает время закрытия приема ставок"""
+        return self._schedule_game('roulette_games', game_id, settle_at)
+
+    def close_roulette_game(self, game_id, settle_at):
+        """Закрывает прием ставок; итоги подводятся в settle_at"""
+        return self._close_game('roulette_games', game_id, settle_at)
+
+    def settle_roulette_round(self, game_id, winning_number):
+        """Фиксирует результат раунда рулетки и выплаты одной транзакцией; None, если раунд уже рассчитан"""
+        win_amount = '''bet_amount * CASE
+            WHEN bet_type = 'число' AND CAST(bet_target AS INTEGER) = :number THEN :pay_number
+            WHEN bet_type = 'чет' AND :number > 0 AND :number % 2 = 0 THEN :pay_even
+            WHEN bet_type = 'нечет' AND :number > 0 AND :number % 2 = 1 THEN :pay_odd
+            WHEN bet_type = 'красное' AND :red THEN :pay_red
+            WHEN bet_type = 'черное' AND :number != 0 AND NOT :red THEN :pay_black
+            ELSE 0
+        END'''
+        params = {
+            'number': winning_number,
+            'red': int(winning_number in ROULETTE_RED_NUMBERS),
+            'pay_number': ROULETTE_PAYOUTS['число'],
+            'pay_even': ROULETTE_PAYOUTS['чет'],
+            'pay_odd': ROULETTE_PAYOUTS['нечет'],
+            'pay_red': ROULETTE_PAYOUTS['красное'],
+            'pay_black': ROULETTE_PAYOUTS['черное'],
+        }
+        return self._settle_round('roulette_games', 'roulette_bets', game_id,
+                                  {'winning_number': winning_number}, win_amount, params, 'bet_type, bet_target')
+
+    def refund_roulette_game(self, game_id):
+        return self._refund_game('roulette_games', 'roulette_bets', game_id)
+
+    def get_unsettled_roulette_games(self):
         cursor = self.conn.cursor()
-        cursor.execute(
-            'INSERT INTO roulette_bets (game_id, user_id, username, bet_type, bet_target, bet_amount) VALUES (?, ?, ?, ?, ?, ?)',
-            (game_id, user_id, username, bet_type, bet_target, bet_amount)
-        )
-        self.conn.commit()
+        cursor.execute('SELECT * FROM roulette_games WHERE is_active = 1 ORDER BY id')
+        return cursor.fetchall()
 
     def get_game_bets(self, game_id):
         cursor = self.conn.cursor()
@@ -899,11 +1905,11 @@ class Database:
         )
         self.conn.commit()
 
-    def create_crash_game(self, chat_id):
+    def create_crash_game(self, chat_id, peer_id=None, game_type='crash'):
         cursor = self.conn.cursor()
         cursor.execute(
-            'INSERT INTO crash_games (chat_id) VALUES (?)',
-            (chat_id,)
+            'INSERT INTO crash_games (chat_id, peer_id, game_type) VALUES (?, ?, ?)',
+            (chat_id, peer_id, game_type)
         )
         self.conn.commit()
         return cursor.lastrowid
@@ -911,72 +1917,229 @@ class Database:
     def get_active_crash_game(self, chat_id):
         cursor = self.conn.cursor()
         cursor.execute(
-            'SELECT * FROM crash_games WHERE chat_id = ? AND is_active = 1 ORDER BY created_at DESC LIMIT 1',
+            "SELECT * FROM crash_games WHERE chat_id = ? AND is_active = 1 AND status = 'active' ORDER BY created_at DESC LIMIT 1",
             (chat_id,)
         )
         return cursor.fetchone()
 
-    def add_crash_bet(self, game_id, user_id, username, bet_amount, target_multiplier):
+    def place_crash_bet(self, chat_id, peer_id, user_id, username, bet_amount, target_multiplier, game_type='crash',
+                        idempotency_key=None):
+        """Списывает ставку и записывает ее в открытый раунд Crash/Дрим беседы; см. _place_round_bet.
+
+        game_type задает тип только нового раунда: Дрим и краш делят открытый раунд беседы."""
+        return self._place_round_bet('crash_games', 'crash_bets', chat_id, peer_id, {'game_type': game_type},
+                                     {'username': username, 'target_multiplier': target_multiplier},
+                                     user_id, bet_amount, f'{game_type}_bet', idempotency_key)
+
+    def set_crash_round(self, game_id, game_type, settle_at):
+        """Сдвигает время закрытия приема ставок; game_type решает, как подводить итоги (краш или дрим)"""
+        return self._schedule_game('crash_games', game_id, settle_at, game_type=game_type)
+
+    def close_crash_game(self, game_id, settle_at):
+        """Закрывает прием ставок; итоги подводятся в settle_at"""
+        return self._close_game('crash_games', game_id, settle_at)
+
+    def settle_crash_round(self, game_id, crash_multiplier):
+        """Фиксирует результат раунда Crash/Дрим и выплаты одной транзакцией; None, если раунд уже рассчитан"""
+        win_amount = '''CASE WHEN target_multiplier <= :multiplier
+            THEN CAST(bet_amount * target_multiplier AS INTEGER) ELSE 0 END'''
+        return self._settle_round('crash_games', 'crash_bets', game_id, {'crash_multiplier': crash_multiplier},
+                                  win_amount, {'multiplier': crash_multiplier}, 'target_multiplier')
+
+    def refund_crash_game(self, game_id):
+        return self._refund_game('crash_games', 'crash_bets', game_id)
+
+    def get_unsettled_crash_games(self):
         cursor = self.conn.cursor()
-        cursor.execute(
-            'INSERT INTO crash_bets (game_id, user_id, username, bet_amount, target_multiplier) VALUES (?, ?, ?, ?, ?)',
-            (game_id, user_id, username, bet_amount, target_multiplier)
-        )
-        self.conn.commit()
+        cursor.execute('SELECT * FROM crash_games WHERE is_active = 1 ORDER BY id')
+        return cursor.fetchall()
 
-    def get_crash_game_bets(self, game_id):
+    def _schedule_game(self, table, game_id, settle_at, **fields):
+        assignments = ''.join(f', {column} = ?' for column in fields)
         cursor = self.conn.cursor()
         cursor.execute(
-            'SELECT * FROM crash_bets WHERE game_id = ? ORDER BY created_at ASC',
-            (game_id,)
+            f"UPDATE {table} SET settle_at = ?{assignments} WHERE id = ? AND status = 'active'",
+            (settle_at, *fields.values(), game_id)
         )
-        return cursor.fetchall()
+        self.conn.commit()
+        return cursor.rowcount == 1
 
-    def end_crash_game(self, game_id, crash_multiplier):
+    def _close_game(self, table, game_id, settle_at):
         cursor = self.conn.cursor()
         cursor.execute(
-            'UPDATE crash_games SET status = ?, ended_at = CURRENT_TIMESTAMP, crash_multiplier = ?, is_active = 0 WHERE id = ?',
-            ('ended', crash_multiplier, game_id)
+            f"UPDATE {table} SET status = 'closed', settle_at = ? WHERE id = ? AND status = 'active'",
+            (settle_at, game_id)
         )
         self.conn.commit()
+        return cursor.rowcount == 1
+
+    def _settle_round(self, table, bets_table, game_id, result, win_amount, params, columns):
+        """Рассчитывает раунд по ставкам в SQL: выигрыш каждой ставки задает выражение win_amount.
+
+        Выплаты суммируются по игрокам одним GROUP BY и начисляются пакетом в той же транзакции,
+        что и закрытие раунда. Возвращает компактный итог для сообщения: выигравшие ставки,
+        число ставок и сумму проигрыша."""
+        assignments = ''.join(f', {column} = :{column}' for column in result)
+        params = {**params, **result, 'game_id': game_id}
+        bets = f'SELECT *, {win_amount} AS win_amount FROM {bets_table} WHERE game_id = :game_id'
+        conn = self.conn
+        with conn:
+            cursor = conn.execute(
+                f"UPDATE {table} SET status = 'ended', ended_at = CURRENT_TIMESTAMP, is_active = 0{assignments} "
+                f"WHERE id = :game_id AND is_active = 1",
+                params
+            )
+            if cursor.rowcount != 1:
+                return None
 
-    def transfer_balance(self, sender_id, receiver_id, amount):
-        """
-        Переводит баланс от отправителя к получателю.
-        Возвращает (True, "Сообщение") в случае успеха, (False, "Ошибка") в случае неудачи.
-        """
-        sender_balance_data = self.get_user_balance(sender_id)
-        receiver_balance_data = self.get_user_balance(receiver_id)
+            winners = conn.execute(
+                f'SELECT user_id, username, bet_amount, win_amount, {columns} '
+                f'FROM ({bets}) WHERE win_amount > 0 ORDER BY id',
+                params
+            ).fetchall()
+            totals = conn.execute(
+                f'SELECT COUNT(*) AS bets_count, '
+                f'COALESCE(SUM(CASE WHEN win_amount > 0 THEN 0 ELSE bet_amount END), 0) AS total_lost FROM ({bets})',
+                params
+            ).fetchone()
+            payouts = conn.execute(
+                f'SELECT user_id, SUM(win_amount) FROM ({bets}) WHERE win_amount > 0 GROUP BY user_id',
+                params
+            ).fetchall()
+            self._credit_balances(conn, [tuple(row) for row in payouts], 'payout', f'{table}:{game_id}')
+
+        return {
+            **result,
+            'game_id': game_id,
+            'winners': [dict(row) for row in winners],
+            'bets_count': totals['bets_count'],
+            'total_lost': totals['total_lost'],
+        }
 
-        if sender_balance_data['balance'] < amount:
-            return False, f"Недостаточно средств! Ваш баланс: {sender_balance_data['balance']:,} $"
+    def _settle_game(self, table, game_id, result, payouts, status='ended'):
+        """Завершает игру и начисляет выигрыши одной транзакцией; False, если игра уже рассчитана"""
+        assignments = ''.join(f', {column} = ?' for column in result)
+        conn = self.conn
+        with conn:
+            cursor = conn.execute(
+                f'UPDATE {table} SET status = ?, ended_at = CURRENT_TIMESTAMP, is_active = 0{assignments} '
+                f'WHERE id = ? AND is_active = 1',
+                (status, *result.values(), game_id)
+            )
+            if cursor.rowcount != 1:
+                return False
+            self._credit_balances(conn, payouts, 'payout', f'{table}:{game_id}')
+        return True
 
+    def _refund_game(self, table, bets_table, game_id):
+        """Отменяет раунд и возвращает все ставки одной транзакцией; возвращает список возвратов"""
+        conn = self.conn
+        with conn:
+            cursor = conn.execute(
+                f"UPDATE {table} SET status = 'refunded', ended_at = CURRENT_TIMESTAMP, is_active = 0 "
+                f"WHERE id = ? AND is_active = 1",
+                (game_id,)
+            )
+            if cursor.rowcount != 1:
+                return []
+            refunds = [tuple(row) for row in conn.execute(
+                f'SELECT user_id, SUM(bet_amount) FROM {bets_table} WHERE game_id = ? GROUP BY user_id',
+                (game_id,)
+            )]
+            self._credit_balances(conn, refunds, 'refund', f'{table}:{game_id}')
+        return refunds
+
+    def _credit_balances(self, conn, payouts, reason, reference):
+        """Начисляет суммы на балансы внутри уже открытой транзакции.
+
+        Записи журнала получают ключ reference:reason:user_id, так что повторное начисление
+        по тому же раунду игнорируется; все балансы пакета обновляются одним UPDATE."""
+        totals = {}
+        for user_id, amount in payouts:
+            if amount:
+                totals[user_id] = totals.get(user_id, 0) + amount
+        if not totals:
+            return
+
+        batch_id = f'{reference}:{reason}:{time.time_ns()}'
+        conn.executemany(
+            'INSERT OR IGNORE INTO balance_ledger (user_id, amount, reason, reference, batch_id, idempotency_key) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [(user_id, amount, reason, reference, batch_id, f'{reference}:{reason}:{user_id}')
+             for user_id, amount in totals.items()]
+        )
+        conn.executemany('INSERT OR IGNORE INTO user_balances (user_id) VALUES (?)',
+                         [(user_id,) for user_id in totals])
+        conn.execute('''
+            UPDATE user_balances
+            SET balance = balance + (
+                    SELECT SUM(amount) FROM balance_ledger
+                    WHERE batch_id = ? AND balance_ledger.user_id = user_balances.user_id
+                ),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id IN (SELECT user_id FROM balance_ledger WHERE batch_id = ?)
+        ''', (batch_id, batch_id))
+
+    def get_crash_game_bets(self, game_id):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'SELECT * FROM crash_bets WHERE game_id = ? ORDER BY created_at ASC',
+            (game_id,)
+        )
+        return cursor.fetchall()
+
+    def end_crash_game(self, game_id, crash_multiplier):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'UPDATE crash_games SET status = ?, ended_at = CURRENT_TIMESTAMP, crash_multiplier = ?, is_active = 0 WHERE id = ?',
+            ('ended', crash_multiplier, game_id)
+        )
+        self.conn.commit()
+
+    def transfer_balance(self, sender_id, receiver_id, amount, idempotency_key=None):
+        """
+        Переводит баланс от отправителя к получателю.
+        Возвращает (True, "Сообщение") в случае успеха, (False, "Ошибка") в случае неудачи.
+        """
         if amount <= 0:
             return False, "Сумма перевода должна быть положительной."
 
-        # Начинаем транзакцию
-        self.conn.execute('BEGIN')
+        # Условное списание и зачисление в одной транзакции на соединении текущего потока
+        conn = self.conn
         try:
-            # Уменьшаем баланс отправителя
-            self.update_user_balance(sender_id, -amount)
-            # Увеличиваем баланс получателя
-            self.update_user_balance(receiver_id, amount)
-
-            self.conn.commit()
+            with conn:
+                result = self._apply_balance_change(conn, sender_id, -amount, 'transfer_out', f'user:{receiver_id}',
+                                                    idempotency_key, require_funds=True)
+                if result == LEDGER_INSUFFICIENT:
+                    conn.rollback()
+                    sender_balance_data = self.get_user_balance(sender_id)
+                    return False, f"Недостаточно средств! Ваш баланс: {sender_balance_data['balance']:,} $"
+                if result == LEDGER_APPLIED:
+                    self._apply_balance_change(conn, receiver_id, amount, 'transfer_in', f'user:{sender_id}',
+                                               f'{idempotency_key}:in' if idempotency_key else None)
             return True, "Перевод успешно выполнен."
         except Exception as e:
-            self.conn.execute('ROLLBACK')
             print(f"Ошибка транзакции перевода: {e}")
             return False, "Произошла ошибка при переводе средств. Попробуйте позже."
 
-    def create_dice_game(self, chat_id, creator_id, creator_username, bet_amount, max_players=2):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'INSERT INTO dice_games (chat_id, creator_id, creator_username, bet_amount, max_players) VALUES (?, ?, ?, ?, ?)',
-            (chat_id, creator_id, creator_username, bet_amount, max_players)
-        )
-        self.conn.commit()
-        return cursor.lastrowid
+    def create_dice_game(self, chat_id, creator_id, creator_username, bet_amount, max_players=2, peer_id=None,
+                         idempotency_key=None):
+        """Списывает ставку создателя и создает игру одной транзакцией.
+
+        Возвращает (LEDGER_APPLIED / LEDGER_INSUFFICIENT / LEDGER_DUPLICATE, game_id)."""
+        conn = self.conn
+        with conn:
+            result = self._apply_balance_change(conn, creator_id, -bet_amount, 'dice_bet', None, idempotency_key,
+                                                require_funds=True)
+            if result != LEDGER_APPLIED:
+                if result == LEDGER_INSUFFICIENT:
+                    conn.rollback()
+                return result, None
+            cursor = conn.execute(
+                'INSERT INTO dice_games (chat_id, peer_id, creator_id, creator_username, bet_amount, max_players) VALUES (?, ?, ?, ?, ?, ?)',
+                (chat_id, peer_id, creator_id, creator_username, bet_amount, max_players)
+            )
+        return LEDGER_APPLIED, cursor.lastrowid
 
     def get_active_dice_games(self, chat_id, limit=5):
         cursor = self.conn.cursor()
@@ -994,13 +2157,40 @@ class Database:
         )
         return cursor.fetchone()
 
-    def join_dice_game(self, game_id, user_id, username):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'INSERT INTO dice_players (game_id, user_id, username) VALUES (?, ?, ?)',
-            (game_id, user_id, username)
-        )
-        self.conn.commit()
+    def join_dice_game(self, game_id, user_id, username, idempotency_key=None):
+        """Списывает ставку и добавляет игрока одной транзакцией.
+
+        Игрок добавляется, только пока игра ждет игроков, есть свободное место и его еще нет в игре;
+        иначе списание откатывается. Возвращает (результат LEDGER_* или LEDGER_CLOSED, число игроков
+        после входа) — число считается под блокировкой, поэтому заполнившего игру видит ровно один вход."""
+        conn = self.conn
+        game = conn.execute('SELECT bet_amount FROM dice_games WHERE id = ?', (game_id,)).fetchone()
+        if not game:
+            return LEDGER_CLOSED, 0
+
+        with conn:
+            result = self._apply_balance_change(conn, user_id, -game['bet_amount'], 'dice_bet', f'dice_games:{game_id}',
+                                                idempotency_key, require_funds=True)
+            if result != LEDGER_APPLIED:
+                if result == LEDGER_INSUFFICIENT:
+                    conn.rollback()
+                return result, 0
+
+            cursor = conn.execute(
+                '''INSERT INTO dice_players (game_id, user_id, username)
+                   SELECT g.id, ?, ? FROM dice_games g
+                   WHERE g.id = ? AND g.is_active = 1 AND g.status = 'waiting'
+                     AND (SELECT COUNT(*) FROM dice_players WHERE game_id = g.id) < g.max_players
+                     AND NOT EXISTS (SELECT 1 FROM dice_players WHERE game_id = g.id AND user_id = ?)''',
+                (user_id, username, game_id, user_id)
+            )
+            if cursor.rowcount != 1:
+                conn.rollback()
+                return LEDGER_CLOSED, 0
+            players_count = conn.execute(
+                'SELECT COUNT(*) AS count FROM dice_players WHERE game_id = ?', (game_id,)
+            ).fetchone()['count']
+        return LEDGER_APPLIED, players_count
 
     def get_dice_players(self, game_id):
         cursor = self.conn.cursor()
@@ -1050,6 +2240,45 @@ class Database:
         )
         self.conn.commit()
 
+    def set_dice_game_rolling(self, game_id):
+        """Переводит игру в состояние броска; False, если игра уже завершена или отменена"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "UPDATE dice_games SET status = 'rolling' WHERE id = ? AND is_active = 1 AND status IN ('waiting', 'rolling')",
+            (game_id,)
+        )
+        self.conn.commit()
+        return cursor.rowcount == 1
+
+    def settle_dice_game(self, game_id, winner_id, bank):
+        """Фиксирует победителя и выплачивает банк одной транзакцией"""
+        return self._settle_game('dice_games', game_id, {'winner_id': winner_id}, [(winner_id, bank)], status='finished')
+
+    def refund_dice_game(self, game_id, statuses=('waiting',)):
+        """Отменяет игру и возвращает ставки создателю и игрокам одной транзакцией; None, если игра уже не в statuses"""
+        conn = self.conn
+        placeholders = ', '.join('?' for _ in statuses)
+        with conn:
+            game = conn.execute('SELECT * FROM dice_games WHERE id = ? AND is_active = 1', (game_id,)).fetchone()
+            if not game:
+                return None
+            cursor = conn.execute(
+                f"UPDATE dice_games SET status = 'cancelled', is_active = 0 WHERE id = ? AND is_active = 1 AND status IN ({placeholders})",
+                (game_id, *statuses)
+            )
+            if cursor.rowcount != 1:
+                return None
+            players = conn.execute('SELECT user_id FROM dice_players WHERE game_id = ?', (game_id,)).fetchall()
+            self._credit_balances(conn, [(game['creator_id'], game['bet_amount'])] +
+                                  [(player['user_id'], game['bet_amount']) for player in players],
+                                  'refund', f'dice_games:{game_id}')
+        return game
+
+    def get_unsettled_dice_games(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT * FROM dice_games WHERE is_active = 1 AND status IN ('waiting', 'rolling') ORDER BY id")
+        return cursor.fetchall()
+
     # Методы для работы с зарегистрированными беседами
     def get_registered_chat(self, chat_id):
         """Получить информацию о зарегистрированной беседе"""
@@ -1117,15 +2346,12 @@ class Database:
         ''', (user_id, reason, banned_by, banned_until))
         self.conn.commit()
 
+        cursor.execute('SELECT * FROM system_bans WHERE id = ?', (cursor.lastrowid,))
+        self.moderation.set_system_ban(cursor.fetchone())
+
     def get_system_ban(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT * FROM system_bans 
-            WHERE user_id = ? AND is_active = 1 
-            AND (banned_until IS NULL OR banned_until > datetime("now"))
-            ORDER BY created_at DESC LIMIT 1
-        ''', (user_id,))
-        return cursor.fetchone()
+        # Читаем из индекса в памяти, без запроса к БД
+        return self.moderation.get_system_ban(user_id)
 
     def remove_system_ban(self, user_id):
         cursor = self.conn.cursor()
@@ -1135,6 +2361,7 @@ class Database:
             WHERE user_id = ? AND is_active = 1
         ''', (user_id,))
         self.conn.commit()
+        self.moderation.remove_system_ban(user_id)
 
     def is_system_banned(self, user_id):
         ban = self.get_system_ban(user_id)
@@ -1171,6 +2398,7 @@ class Database:
                 (chat_id, word.lower(), added_by)
             )
             self.conn.commit()
+            self.moderation.add_filtered_word(chat_id, word.lower())
             return True
         except sqlite3.IntegrityError:
             return False
@@ -1183,40 +2411,37 @@ class Database:
             (chat_id, word.lower())
         )
         self.conn.commit()
+        self.moderation.remove_filtered_word(chat_id, word.lower())
         return cursor.rowcount > 0
 
     def get_filtered_words(self, chat_id):
         """Получить список всех запрещенных слов для чата"""
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'SELECT word FROM filtered_words WHERE chat_id = ? ORDER BY word ASC',
-            (chat_id,)
-        )
-        return [row['word'] for row in cursor.fetchall()]
+        return self.moderation.get_filtered_words(chat_id)
+
+    def find_filtered_words(self, chat_id, message_text):
+        """Найти все запрещенные слова в сообщении за один проход"""
+        return self.moderation.find_filtered_words(chat_id, message_text)
 
     def check_message_for_filtered_words(self, chat_id, message_text):
         """Проверить сообщение на наличие запрещенных слов"""
-        filtered_words = self.get_filtered_words(chat_id)
-        if not filtered_words:
-            return None
-
-        message_lower = message_text.lower()
-        for word in filtered_words:
-            if word in message_lower:
-                return word
-        return None
+        found = self.find_filtered_words(chat_id, message_text)
+        return found[0] if found else None
 
-    def get_expired_mutes(self):
-        """Получить все истекшие муты"""
+    def get_timed_mutes(self):
+        """Получить все активные муты со сроком окончания (частичный индекс idx_mutes_active_until)"""
         cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT * FROM mutes 
-            WHERE is_active = 1 
-            AND mute_until IS NOT NULL 
-            AND datetime(mute_until) <= datetime('now')
+            SELECT * FROM mutes
+            WHERE is_active = 1
+            AND mute_until IS NOT NULL
+            ORDER BY mute_until
         ''')
         return cursor.fetchall()
 
+    def get_active_mute_by_id(self, mute_id):
+        """Получить активный мут по ID из индекса в памяти"""
+        return self.moderation.get_mute_by_id(mute_id)
+
     def remove_mute_by_id(self, mute_id):
         """Снять мут по ID"""
         cursor = self.conn.cursor()
@@ -1226,23 +2451,1555 @@ class Database:
             WHERE id = ?
         ''', (mute_id,))
         self.conn.commit()
+        removed = self.moderation.remove_mute_by_id(mute_id)
+        if removed:
+            self.notify_mute_listeners(removed, False)
+
+    def save_scheduled_job(self, job_key, method, args, due_at, interval=None):
+        """Сохранить отложенную задачу планировщика"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO scheduled_jobs (job_key, method, args, due_at, interval)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (job_key, method, json.dumps(list(args)), due_at, interval))
+        self.conn.commit()
+
+    def delete_scheduled_job(self, job_key):
+        """Удалить отложенную задачу планировщика"""
+        cursor = self.conn.cursor()
+        cursor.execute('DELETE FROM scheduled_jobs WHERE job_key = ?', (job_key,))
+        self.conn.commit()
+
+    def get_scheduled_jobs(self):
+        """Получить все сохраненные задачи планировщика"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT * FROM scheduled_jobs ORDER BY due_at')
+        return cursor.fetchall()
+
+    def create_broadcast_job(self, created_by, reply_peer_id, message, peer_ids):
+        """Создает задание рассылки и строки журнала для всех получателей одной транзакцией"""
+        peer_ids = list(dict.fromkeys(peer_ids))
+        with self.conn:
+            cursor = self.conn.execute(
+                'INSERT INTO broadcast_jobs (created_by, reply_peer_id, message, total, started_at) VALUES (?, ?, ?, ?, ?)',
+                (created_by, reply_peer_id, message, len(peer_ids), time.time())
+            )
+            job_id = cursor.lastrowid
+            self.conn.executemany(
+                'INSERT INTO broadcast_deliveries (job_id, peer_id) VALUES (?, ?)',
+                [(job_id, peer_id) for peer_id in peer_ids]
+            )
+        return job_id
+
+    def get_broadcast_job(self, job_id):
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT * FROM broadcast_jobs WHERE id = ?', (job_id,))
+        return cursor.fetchone()
+
+    def get_latest_broadcast_job(self):
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT 1')
+        return cursor.fetchone()
+
+    def get_running_broadcast_jobs(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+        return cursor.fetchall()
+
+    def get_due_broadcast_peers(self, job_id, now, limit):
+        """Получатели, которым пора отправлять: новые и те, у кого подошло время повтора"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT peer_id, attempts FROM broadcast_deliveries
+            WHERE job_id = ? AND status = 'pending' AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+            LIMIT ?
+        ''', (job_id, now, limit))
+        return cursor.fetchall()
+
+    def get_next_broadcast_retry(self, job_id):
+        """Ближайшее время повтора среди ожидающих получателей (None, если ждать нечего)"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT MIN(COALESCE(next_attempt_at, 0)) AS due_at, COUNT(*) AS pending "
+            "FROM broadcast_deliveries WHERE job_id = ? AND status = 'pending'",
+            (job_id,)
+        )
+        row = cursor.fetchone()
+        return row['due_at'] if row['pending'] else None
+
+    def record_broadcast_results(self, job_id, delivered, retries, failed):
+        """Записывает в журнал итог пачки одной транзакцией.
+
+        delivered — peer_id доставленных, retries — (peer_id, ошибка, время повтора),
+        failed — (peer_id, ошибка) окончательно не доставленных."""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE broadcast_deliveries SET status = 'sent', attempts = attempts + 1, delivered_at = ?, error = NULL "
+                "WHERE job_id = ? AND peer_id = ?",
+                [(now, job_id, peer_id) for peer_id in delivered]
+            )
+            self.conn.executemany(
+                "UPDATE broadcast_deliveries SET attempts = attempts + 1, error = ?, next_attempt_at = ? "
+                "WHERE job_id = ? AND peer_id = ?",
+                [(error, retry_at, job_id, peer_id) for peer_id, error, retry_at in retries]
+            )
+            self.conn.executemany(
+                "UPDATE broadcast_deliveries SET status = 'failed', attempts = attempts + 1, error = ? "
+                "WHERE job_id = ? AND peer_id = ?",
+                [(error, job_id, peer_id) for peer_id, error in failed]
+            )
+
+    def get_broadcast_stats(self, job_id):
+        """Число получателей по статусам доставки"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'SELECT status, COUNT(*) AS count FROM broadcast_deliveries WHERE job_id = ? GROUP BY status',
+            (job_id,)
+        )
+        stats = {'pending': 0, 'sent': 0, 'failed': 0}
+        for row in cursor.fetchall():
+            stats[row['status']] = row['count']
+        return stats
+
+    def finish_broadcast_job(self, job_id, status='finished'):
+        """Завершает задание; False, если оно уже не выполняется"""
+        with self.conn:
+            cursor = self.conn.execute(
+                "UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+                (status, time.time(), job_id)
+            )
+        return cursor.rowcount == 1
+
+    @property
+    def conn(self):
+        """Соединение с БД для текущего потока"""
+        return self.connections.get()
 
     def close(self):
-        self.conn.close()
+        self.message_counts.stop()
+        self.connections.close_all()
+
+class UserProfileCache:
+    """LRU-кэш профилей пользователей с TTL и негативным кэшированием"""
+
+    def __init__(self, max_size=10000, ttl=3600, negative_ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Возвращает (найдено, профиль); профиль None означает закэшированное отсутствие"""
+        key = str(user_id)
+        now = time.time()
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[0] < now:
+                if item is not None:
+                    del self.items[key]
+                self.misses += 1
+                return False, None
+
+            self.items.move_to_end(key)
+            self.hits += 1
+            return True, item[1]
+
+    def put(self, user_id, info):
+        ttl = self.ttl if info is not None else self.negative_ttl
+        with self.lock:
+            self.items[str(user_id)] = (time.time() + ttl, info)
+            self.items.move_to_end(str(user_id))
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.items.pop(str(user_id), None)
+
+    def get_stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            }
+
+class ChatMemberRoster:
+    """Состав беседы в параллельных массивах, отсортированных по member_id.
+
+    На участника уходит ~25 байт (id, пригласивший, дата входа, флаги) вместо словаря из ответа VK,
+    профили не хранятся — они уже лежат в кэше профилей. Состав не меняется на месте:
+    правки по событиям создают новый экземпляр, поэтому читатели работают с целостным снимком."""
+    __slots__ = ('count', 'member_ids', 'invited_by', 'join_dates', 'flags')
+
+    OWNER = 1
+    ADMIN = 2
+    ONLINE = 4
+
+    def __init__(self, count=0, member_ids=None, invited_by=None, join_dates=None, flags=None):
+        self.count = count
+        self.member_ids = member_ids if member_ids is not None else array('q')
+        self.invited_by = invited_by if invited_by is not None else array('q')
+        self.join_dates = join_dates if join_dates is not None else array('q')
+        self.flags = flags if flags is not None else bytearray()
+
+    @classmethod
+    def from_response(cls, response):
+        """Состав из ответа messages.getConversationMembers"""
+        online = {profile['id'] for profile in response.get('profiles', []) if profile.get('online')}
+        items = sorted((item for item in response['items'] if item.get('member_id')), key=lambda item: item['member_id'])
+        roster = cls(response.get('count', len(items)))
+        for item in items:
+            member_id = item['member_id']
+            roster.member_ids.append(member_id)
+            roster.invited_by.append(item.get('invited_by') or 0)
+            roster.join_dates.append(item.get('join_date') or 0)
+            roster.flags.append((cls.OWNER if item.get('is_owner') else 0)
+                                | (cls.ADMIN if item.get('is_admin') else 0)
+                                | (cls.ONLINE if member_id in online else 0))
+        return roster
+
+    def __len__(self):
+        return len(self.member_ids)
+
+    def _index(self, member_id):
+        position = bisect_left(self.member_ids, member_id)
+        if position < len(self.member_ids) and self.member_ids[position] == member_id:
+            return position
+        return -1
+
+    def flags_of(self, member_id):
+        position = self._index(member_id)
+        return self.flags[position] if position >= 0 else 0
+
+    def is_owner(self, member_id):
+        return bool(self.flags_of(member_id) & self.OWNER)
+
+    def is_admin(self, member_id):
+        """Администратор или владелец беседы"""
+        return bool(self.flags_of(member_id) & (self.OWNER | self.ADMIN))
+
+    def user_ids(self):
+        """Участники-пользователи (у сообществ id отрицательные)"""
+        return self.member_ids[bisect_left(self.member_ids, 1):]
+
+    def owner_id(self):
+        for position in range(bisect_left(self.member_ids, 1), len(self.member_ids)):
+            if self.flags[position] & self.OWNER:
+                return self.member_ids[position]
+        return None
+
+    def admins(self):
+        """Пары (member_id, is_owner) для администраторов-пользователей"""
+        return [(self.member_ids[position], bool(self.flags[position] & self.OWNER))
+                for position in range(bisect_left(self.member_ids, 1), len(self.member_ids))
+                if self.flags[position] & (self.OWNER | self.ADMIN)]
+
+    def online_ids(self):
+        return [self.member_ids[position] for position, flags in enumerate(self.flags)
+                if flags & self.ONLINE and self.member_ids[position] > 0]
+
+    def online_count(self):
+        return sum(1 for flags in self.flags if flags & self.ONLINE)
+
+    def with_member(self, member_id, invited_by=None, join_date=None, flags=0):
+        """Новый состав с добавленным участником (или тот же, если он уже есть)"""
+        position = bisect_left(self.member_ids, member_id)
+        if position < len(self.member_ids) and self.member_ids[position] == member_id:
+            return self
+        roster = ChatMemberRoster(self.count + 1, array('q', self.member_ids), array('q', self.invited_by),
+                                  array('q', self.join_dates), bytearray(self.flags))
+        roster.member_ids.insert(position, member_id)
+        roster.invited_by.insert(position, invited_by or 0)
+        roster.join_dates.insert(position, join_date or int(time.time()))
+        roster.flags.insert(position, flags)
+        return roster
+
+    def without_member(self, member_id):
+        """Новый состав без участника (или тот же, если его не было)"""
+        position = self._index(member_id)
+        if position < 0:
+            return self
+        roster = ChatMemberRoster(self.count - 1, array('q', self.member_ids), array('q', self.invited_by),
+                                  array('q', self.join_dates), bytearray(self.flags))
+        for column in (roster.member_ids, roster.invited_by, roster.join_dates, roster.flags):
+            del column[position]
+        return roster
+
+class ConversationMemberCache:
+    """Кэш участников бесед (ChatMemberRoster по ответам messages.getConversationMembers) по chat_id.
+
+    Состав с флагами админов и онлайн-статус хранятся вместе, но у каждого свой TTL:
+    онлайн устаревает быстрее, а состав между обновлениями правится событиями входа и выхода.
+    Одновременные промахи по одной беседе приводят к одному запросу."""
+
+    def __init__(self, fetch, admin_ttl=60, online_ttl=30, max_chats=1000):
+        self.fetch = fetch
+        self.admin_ttl = admin_ttl
+        self.online_ttl = online_ttl
+        self.max_chats = max_chats
+        self.chats = OrderedDict()
+        self.fetch_locks = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _is_fresh(self, entry, online, now):
+        if entry is None or now - entry['members_at'] >= self.admin_ttl:
+            return False
+        return not online or now - entry['online_at'] < self.online_ttl
+
+    def get(self, chat_id, online=False, refresh=False):
+        """Состав беседы; online=True требует свежего онлайн-статуса, refresh=True — нового запроса"""
+        requested_at = time.time()
+        with self.lock:
+            entry = self.chats.get(chat_id)
+            if not refresh and self._is_fresh(entry, online, requested_at):
+                self.chats.move_to_end(chat_id)
+                self.hits += 1
+                return entry['roster']
+            self.misses += 1
+            fetch_lock = self.fetch_locks.setdefault(chat_id, threading.Lock())
+
+        with fetch_lock:
+            # Пока ждали, беседу мог обновить другой поток
+            with self.lock:
+                entry = self.chats.get(chat_id)
+                if entry and entry['online_at'] >= requested_at:
+                    return entry['roster']
+                if not refresh and self._is_fresh(entry, online, time.time()):
+                    return entry['roster']
+
+            response = self.fetch(chat_id)
+            if not response or 'items' not in response:
+                # При ошибке API отдаем устаревшие данные, если они есть
+                with self.lock:
+                    entry = self.chats.get(chat_id)
+                    return entry['roster'] if entry else None
+
+            roster = ChatMemberRoster.from_response(response)
+            with self.lock:
+                now = time.time()
+                self.chats[chat_id] = {'roster': roster, 'members_at': now, 'online_at': now}
+                self.chats.move_to_end(chat_id)
+                while len(self.chats) > self.max_chats:
+                    evicted, _ = self.chats.popitem(last=False)
+                    self.fetch_locks.pop(evicted, None)
+                return roster
+
+    def add_member(self, chat_id, member_id, invited_by=None):
+        """Правит состав по событию chat_invite_user, не дожидаясь истечения TTL"""
+        with self.lock:
+            entry = self.chats.get(chat_id)
+            if entry is not None:
+                entry['roster'] = entry['roster'].with_member(member_id, invited_by)
+
+    def remove_member(self, chat_id, member_id):
+        """Правит состав по событию chat_kick_user"""
+        with self.lock:
+            entry = self.chats.get(chat_id)
+            if entry is not None:
+                entry['roster'] = entry['roster'].without_member(member_id)
+
+    def invalidate(self, chat_id):
+        with self.lock:
+            self.chats.pop(chat_id, None)
+
+    def get_stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'chats': len(self.chats),
+                'members': sum(len(entry['roster']) for entry in self.chats.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            }
+
+# Ошибки VK, после которых запрос стоит повторить: 6 — слишком много запросов в секунду, 9 — флуд-контроль
+VK_RETRY_ERROR_CODES = (6, 9)
+
+class VKAPIError(Exception):
+    """Ошибка, которую вернул VK API"""
+
+    def __init__(self, error):
+        self.code = error.get('error_code')
+        self.msg = error.get('error_msg', '')
+        self.method = error.get('method')
+        super().__init__(f"[{self.code}] {self.msg}")
+
+class TokenBucketRateLimiter:
+    """Ограничитель частоты запросов к VK: ведро на токен и отдельные ведра на методы"""
+
+    def __init__(self, rate=19, burst=None, method_rates=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.method_rates = method_rates or {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.waited = 0.0
+        self.penalties = 0
+
+    def _take(self, key, rate, burst, now):
+        """Резервирует токен в ведре и возвращает время ожидания"""
+        tokens, updated = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate) - 1
+        self.buckets[key] = (tokens, now)
+        return -tokens / rate if tokens < 0 else 0.0
+
+    def reserve(self, token, method):
+        """Резервирует место под запрос и возвращает, сколько секунд нужно подождать"""
+        now = time.monotonic()
+        with self.lock:
+            delay = self._take(token, self.rate, self.burst, now)
+            method_rate = self.method_rates.get(method)
+            if method_rate:
+                delay = max(delay, self._take((token, method), float(method_rate), float(method_rate), now))
+            self.waited += delay
+            return delay
+
+    def acquire(self, token, method):
+        delay = self.reserve(token, method)
+        if delay > 0:
+            time.sleep(delay)
+
+    def penalize(self, token, method, seconds=1.0):
+        """После ошибки 6/9 опустошает ведра, чтобы сбросить темп"""
+        now = time.monotonic()
+        with self.lock:
+            self.penalties += 1
+            self.buckets[token] = (-self.rate * seconds, now)
+            if (token, method) in self.buckets:
+                self.buckets[(token, method)] = (-float(self.method_rates[method]) * seconds, now)
+
+class VKExecuteBatcher:
+    """Собирает одиночные вызовы VK API в запросы execute (до 25 вызовов в одном)"""
+
+    MAX_CALLS = 25
+
+    def __init__(self, raw_call, flush_interval=0.05, log=print):
+        self.raw_call = raw_call
+        self.flush_interval = flush_interval
+        self.log = log
+        self.pending = []
+        self.condition = threading.Condition()
+        self.running = True
+        self.batches = 0
+        self.calls = 0
+        self.thread = threading.Thread(target=self._loop, daemon=True, name="vk-execute")
+        self.thread.start()
+
+    def submit(self, method, params=None):
+        """Ставит вызов в очередь, результат или VKAPIError придет в Future"""
+        future = Future()
+        with self.condition:
+            if not self.running:
+                future.set_exception(RuntimeError("Батчер остановлен"))
+                return future
+            self.pending.append((method, dict(params or {}), future))
+            if len(self.pending) == 1 or len(self.pending) >= self.MAX_CALLS:
+                self.condition.notify()
+        return future
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                if not self.pending and self.running:
+                    self.condition.wait()
+                if not self.pending and not self.running:
+                    return
+                # Даем время накопиться остальным вызовам пачки
+                if len(self.pending) < self.MAX_CALLS and self.running:
+                    self.condition.wait(self.flush_interval)
+                batch = self.pending[:self.MAX_CALLS]
+                del self.pending[:self.MAX_CALLS]
+
+            if batch:
+                self._send(batch)
+
+    def _send(self, batch):
+        self.batches += 1
+        self.calls += len(batch)
+
+        # Одиночный вызов отправляем напрямую, без execute
+        if len(batch) == 1:
+            method, params, future = batch[0]
+            try:
+                result = self.raw_call(method, params)
+                if 'error' in result:
+                    future.set_exception(VKAPIError(result['error']))
+                else:
+                    future.set_result(result.get('response'))
+            except Exception as e:
+                future.set_exception(e)
+            return
+
+        try:
+            result = self.raw_call('execute', {'code': self.execute_code([(method, params) for method, params, _ in batch])})
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, _, future), (response, error) in zip(batch, self.split_response(result, [method for method, _, _ in batch])):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(response)
+
+    @staticmethod
+    def execute_code(calls):
+        """Код execute, который выполняет вызовы (method, params) и возвращает их ответы по порядку"""
+        return 'return [' + ','.join(
+            f'API.{method}({json.dumps(params or {}, ensure_ascii=False)})'
+            for method, params in calls
+        ) + '];'
+
+    @staticmethod
+    def split_response(result, methods):
+        """Разбирает ответ execute: для каждого вызова (response, None) или (None, VKAPIError)"""
+        if 'error' in result:
+            return [(None, VKAPIError(result['error']))] * len(methods)
+
+        responses = result.get('response') or []
+        # Ошибки внутри execute идут по порядку неудачных вызовов
+        errors = iter(result.get('execute_errors', []))
+        outcomes = []
+        for index, method in enumerate(methods):
+            response = responses[index] if index < len(responses) else False
+            if response is False:
+                error = next(errors, {'error_code': None, 'error_msg': 'Вызов не выполнен', 'method': method})
+                outcomes.append((None, VKAPIError(error)))
+            else:
+                outcomes.append((response, None))
+        return outcomes
+
+    def stop(self):
+        """Отправляет оставшиеся вызовы и останавливает поток"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(5.0)
+
+def edit_distance(a, b):
+    """Полное расстояние Дамерау-Левенштейна (алгоритм Лоуренса-Вагнера).
+
+    В отличие от упрощенного варианта (optimal string alignment) это метрика:
+    выполняется неравенство треугольника, на котором держится отсечение в BK-дереве."""
+    if a == b:
+        return 0
+    infinity = len(a) + len(b)
+    # Строка 0 и столбец 0 — «бесконечность», со сдвигом на единицу индексы как у строк
+    table = [[infinity] * (len(b) + 2) for _ in range(len(a) + 2)]
+    for i in range(len(a) + 1):
+        table[i + 1][1] = i
+    for j in range(len(b) + 1):
+        table[1][j + 1] = j
+
+    last_row = {}
+    for i in range(1, len(a) + 1):
+        last_match_col = 0
+        for j in range(1, len(b) + 1):
+            k = last_row.get(b[j - 1], 0)
+            l = last_match_col
+            if a[i - 1] == b[j - 1]:
+                cost = 0
+                last_match_col = j
+            else:
+                cost = 1
+            table[i + 1][j + 1] = min(
+                table[i][j] + cost,
+                table[i + 1][j] + 1,
+                table[i][j + 1] + 1,
+                table[k][l] + (i - k - 1) + 1 + (j - l - 1),
+            )
+        last_row[a[i - 1]] = i
+    return table[len(a) + 1][len(b) + 1]
+
+class CommandSuggester:
+    """Индекс алиасов команд для подсказок «возможно, вы имели в виду»: префиксное дерево и BK-дерево"""
+
+    def __init__(self, commands):
+        self.alias_to_command = {}
+        self.trie = {}
+        self.bk_tree = None
+
+        for cmd_key, aliases in commands.items():
+            for alias in aliases:
+                alias = alias.lower()
+                if alias in self.alias_to_command:
+                    continue
+                self.alias_to_command[alias] = cmd_key
+                self._add_to_trie(alias)
+                self._add_to_bk_tree(alias)
+
+    def _add_to_trie(self, alias):
+        node = self.trie
+        for char in alias:
+            node = node.setdefault(char, {})
+        node[''] = alias
+
+    def _add_to_bk_tree(self, alias):
+        if self.bk_tree is None:
+            self.bk_tree = (alias, {})
+            return
+        node = self.bk_tree
+        while True:
+            distance = edit_distance(alias, node[0])
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (alias, {})
+                return
+            node = child
+
+    def prefix_matches(self, prefix, limit=20):
+        """Алиасы, начинающиеся с prefix"""
+        node = self.trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        found = []
+        stack = [node]
+        while stack and len(found) < limit:
+            node = stack.pop()
+            for char, child in node.items():
+                if char == '':
+                    found.append(child)
+                else:
+                    stack.append(child)
+        return found
+
+    def within_distance(self, word, max_distance):
+        """Алиасы на расстоянии не больше max_distance (поиск по BK-дереву)"""
+        if self.bk_tree is None:
+            return []
+        found = []
+        stack = [self.bk_tree]
+        while stack:
+            alias, children = stack.pop()
+            distance = edit_distance(word, alias)
+            if distance <= max_distance:
+                found.append((distance, alias))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+    def suggest(self, entered_command, limit=5):
+        """Возвращает до limit подсказок, лучшие первыми; для каждой команды только лучший алиас"""
+        word = entered_command.lower()
+        if not word:
+            return []
+
+        max_distance = max(1, min(3, len(word) // 3))
+        candidates = {alias: distance for distance, alias in self.within_distance(word, max_distance)}
+        if len(word) >= 2:
+            for alias in self.prefix_matches(word):
+                candidates.setdefault(alias, edit_distance(word, alias))
+        candidates.pop(word, None)
+
+        def rank(alias):
+            distance = candidates[alias]
+            # Алиасы, которые продолжают введенное слово, идут первыми
+            score = 0 if alias.startswith(word) else distance
+            return (score, distance, len(alias), alias)
+
+        suggestions = []
+        used_commands = set()
+        for alias in sorted(candidates, key=rank):
+            cmd_key = self.alias_to_command[alias]
+            if cmd_key in used_commands:
+                continue
+            used_commands.add(cmd_key)
+            suggestions.append('/' + alias)
+            if len(suggestions) >= limit:
+                break
+        return suggestions
+
+class LatencyHistogram:
+    """Гистограмма времени выполнения с фиксированными границами корзин (мс)"""
+
+    BOUNDS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        index = 0
+        while index < len(self.BOUNDS) and ms > self.BOUNDS[index]:
+            index += 1
+        with self.lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total += ms
+            self.max = max(self.max, ms)
+
+    def percentile(self, fraction):
+        """Верхняя граница корзины, в которую попадает заданная доля измерений"""
+        if not self.count:
+            return 0.0
+        threshold = self.count * fraction
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= threshold:
+                return min(float(self.BOUNDS[index]), round(self.max, 2)) if index < len(self.BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'total_ms': round(self.total, 3),
+                'avg_ms': round(self.total / self.count, 2) if self.count else 0.0,
+                'p50_ms': self.percentile(0.5),
+                'p95_ms': self.percentile(0.95),
+                'max_ms': round(self.max, 2),
+                'buckets': dict(zip([f'<={bound}' for bound in self.BOUNDS] + [f'>{self.BOUNDS[-1]}'], self.buckets)),
+            }
+
+class LatencyTracer:
+    """Трассировка обработки событий по стадиям.
+
+    Событие обрабатывается целиком в одном потоке, поэтому текущая трасса хранится в threading.local:
+    стадии (span) пишутся в гистограммы, а время в SQLite и VK API копится в трассе и по ее
+    завершении относится к команде (или к типу события, если команды не было).
+    Медленные события логируются с разбивкой по стадиям."""
+
+    def __init__(self, enabled=True, slow_ms=2000, log=print):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.log = log
+        self.local = threading.local()
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, kind, name, seconds):
+        key = (kind, name)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, LatencyHistogram())
+        histogram.observe(seconds)
+
+    def current(self):
+        return getattr(self.local, 'trace', None)
+
+    @contextmanager
+    def trace(self, event_type):
+        """Трасса одного события; вложенный вызов продолжает уже открытую трассу"""
+        if not self.enabled or self.current() is not None:
+            yield self.current()
+            return
+
+        trace = {'event': event_type, 'command': None, 'stages': [],
+                 'db': 0.0, 'db_calls': 0, 'vk': 0.0, 'vk_calls': 0}
+        self.local.trace = trace
+        started = time.perf_counter()
+        try:
+            yield trace
+        finally:
+            self.local.trace = None
+            elapsed = time.perf_counter() - started
+            label = trace['command'] or event_type
+            self.observe('event', event_type, elapsed)
+            self.observe('db', label, trace['db'])
+            self.observe('vk', label, trace['vk'])
+            if elapsed * 1000 >= self.slow_ms:
+                self.log(f"🐢 Медленное событие: {self.describe(trace, elapsed)}")
+
+    @contextmanager
+    def span(self, stage):
+        """Замер стадии обработки; без открытой трассы попадает только в гистограмму"""
+        if not self.enabled:
+            yield
+            return
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe('stage', stage, elapsed)
+            trace = self.current()
+            if trace is not None:
+                trace['stages'].append((stage, elapsed))
+
+    def set_command(self, command):
+        trace = self.current()
+        if trace is not None:
+            trace['command'] = command
+
+    def add_db(self, seconds):
+        """Время запроса SQLite (вызывается из SQLiteConnectionManager)"""
+        trace = self.current()
+        if trace is not None:
+            trace['db'] += seconds
+            trace['db_calls'] += 1
+
+    def add_vk(self, method, seconds):
+        """Время вызова VK API вместе с повторами"""
+        if not self.enabled:
+            return
+        self.observe('vk_method', method, seconds)
+        trace = self.current()
+        if trace is not None:
+            trace['vk'] += seconds
+            trace['vk_calls'] += 1
+
+    @staticmethod
+    def describe(trace, elapsed):
+        stages = ', '.join(f"{stage} {seconds * 1000:.0f} мс" for stage, seconds in trace['stages'])
+        command = f" (/{trace['command']})" if trace['command'] else ''
+        return (f"{trace['event']}{command}: {elapsed * 1000:.0f} мс — {stages or 'без стадий'}; "
+                f"БД {trace['db'] * 1000:.0f} мс ({trace['db_calls']} запр.), "
+                f"VK {trace['vk'] * 1000:.0f} мс ({trace['vk_calls']} выз.)")
+
+    def snapshot(self, kind=None):
+        """Гистограммы {(вид, имя): снимок}; kind оставляет только один вид"""
+        with self.lock:
+            items = list(self.histograms.items())
+        return {key: histogram.snapshot() for key, histogram in items if kind is None or key[0] == kind}
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def render_prometheus(self, gauges=None, histograms=None):
+        """Гистограммы (свои и переданные снимки {(вид, имя): снимок}) и числовые метрики компонентов
+        в текстовом формате Prometheus"""
+        snapshots = self.snapshot()
+        snapshots.update(histograms or {})
+        lines = ['# TYPE vkbot_latency_seconds histogram']
+        bounds = [f'{bound / 1000:g}' for bound in LatencyHistogram.BOUNDS] + ['+Inf']
+        for (kind, name), snapshot in sorted(snapshots.items()):
+            labels = f'kind="{kind}",name="{prometheus_escape(name)}"'
+            cumulative = 0
+            for bound, count in zip(bounds, snapshot['buckets'].values()):
+                cumulative += count
+                lines.append(f'vkbot_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'vkbot_latency_seconds_sum{{{labels}}} {snapshot["total_ms"] / 1000:.6f}')
+            lines.append(f'vkbot_latency_seconds_count{{{labels}}} {snapshot["count"]}')
+
+        for component, stats in (gauges or {}).items():
+            for key, value in stats.items():
+                metric = f'vkbot_{component}_{key}'
+                if isinstance(value, (list, tuple)):
+                    lines.extend(f'{metric}{{index="{index}"}} {item}' for index, item in enumerate(value)
+                                 if isinstance(item, (int, float)))
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'{metric} {value}')
+        return '\n'.join(lines) + '\n'
+
+def prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class SamplingProfiler:
+    """Семплирующий профилировщик: раз в interval снимает стеки рабочих потоков.
+
+    В отличие от cProfile не замедляет сами обработчики, поэтому его можно включать на живом боте.
+    Простаивающие потоки (ждущие событие в очереди) не учитываются. Результат — свернутые
+    стеки ("a;b;c N"), которые понимают flamegraph.pl и speedscope."""
+
+    THREAD_PREFIXES = ('dispatcher-', 'asyncio_', 'scheduler_', 'fanout_')
+    # Функции циклов ожидания: если стек из этого файла заканчивается на них, поток простаивает
+    IDLE_FUNCTIONS = ('_worker',)
+
+    def __init__(self, interval=0.005, max_depth=64, source=None):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.source = source or __file__
+        self.stacks = {}
+        self.samples = 0
+        self.started_at = None
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.running:
+            return False
+        self.running = True
+        self.started_at = time.time()
+        self.thread = threading.Thread(target=self._loop, daemon=True, name='profiler')
+        self.thread.start()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        self.running = False
+        self.thread.join(1.0)
+        return True
+
+    def reset(self):
+        with self.lock:
+            self.stacks = {}
+            self.samples = 0
+        self.started_at = time.time() if self.running else None
+
+    def _loop(self):
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if names.get(ident, '').startswith(self.THREAD_PREFIXES):
+                    stack = self._collapse(frame)
+                    if stack:
+                        with self.lock:
+                            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                            self.samples += 1
+            time.sleep(self.interval)
+
+    def _collapse(self, frame):
+        """Стек потока в виде 'внешняя;...;внутренняя' или None, если поток простаивает"""
+        frames = []
+        innermost_own = None
+        while frame is not None and len(frames) < self.max_depth:
+            code = frame.f_code
+            if innermost_own is None and code.co_filename == self.source:
+                innermost_own = code.co_name
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if innermost_own is None or innermost_own in self.IDLE_FUNCTIONS:
+            return None
+        return ';'.join(reversed(frames))
+
+    def collapsed(self):
+        """Свернутые стеки для flamegraph"""
+        with self.lock:
+            items = sorted(self.stacks.items(), key=lambda item: -item[1])
+        return '\n'.join(f"{stack} {count}" for stack, count in items) + '\n'
+
+    def top(self, limit=10):
+        """Функции с наибольшей долей семплов: собственное время (вершина стека) и с учетом вложенных
+        (только функции бота — иначе вверху всегда будут рамки threading)"""
+        own_file = f"({os.path.basename(self.source)}:"
+        own = {}
+        inclusive = {}
+        with self.lock:
+            items = list(self.stacks.items())
+            total = self.samples
+        for stack, count in items:
+            frames = stack.split(';')
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for name in set(frames):
+                if own_file in name:
+                    inclusive[name] = inclusive.get(name, 0) + count
+
+        def ranked(counts):
+            return [(name, round(count / total * 100, 1))
+                    for name, count in sorted(counts.items(), key=lambda item: -item[1])[:limit]]
+
+        return {'samples': total, 'own': ranked(own) if total else [], 'inclusive': ranked(inclusive) if total else []}
+
+class MetricsServer:
+    """Локальный HTTP-эндпоинт: /metrics (Prometheus), /metrics.json и /profile (свернутые стеки)"""
+
+    def __init__(self, bot, host='127.0.0.1', port=9108):
+        self.bot = bot
+        bot_ref = bot
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                if path == '/metrics':
+                    body, content_type = bot_ref.render_metrics(), 'text/plain; version=0.0.4'
+                elif path == '/metrics.json':
+                    body, content_type = json.dumps(bot_ref.get_metrics(), ensure_ascii=False, default=str), 'application/json'
+                elif path == '/profile':
+                    body, content_type = bot_ref.profiler.collapsed(), 'text/plain'
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True, name='metrics-http')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class EventDispatcher:
+    """Ограниченный пул воркеров: события одного peer_id всегда идут в одну очередь"""
+
+    def __init__(self, handler, workers=8, queue_size=1000, log=print):
+        self.handler = handler
+        self.log = log
+        self.workers_count = max(1, int(workers))
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(self.workers_count)]
+        self.threads = []
+        self.lock = threading.Lock()
+        self.running = True
+
+        # Метрики
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy_time = [0.0] * self.workers_count
+        self.queue_wait = LatencyHistogram()
+        self.started_at = time.time()
+
+        for index in range(self.workers_count):
+            thread = threading.Thread(target=self._worker, args=(index,), daemon=True,
+                                      name=f"dispatcher-{index}")
+            thread.start()
+            self.threads.append(thread)
+
+    @staticmethod
+    def get_event_peer_id(update):
+        """Достает peer_id из события Long Poll"""
+        obj = update.get('object') or {}
+        if 'message' in obj:
+            return obj['message'].get('peer_id', 0)
+        return obj.get('peer_id', 0)
+
+    def submit(self, update):
+        """Ставит событие в очередь воркера; при переполнении событие отбрасывается"""
+        peer_id = self.get_event_peer_id(update) or 0
+        index = peer_id % self.workers_count
+        try:
+            self.queues[index].put_nowait((update, time.perf_counter()))
+            with self.lock:
+                self.submitted += 1
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            self.log(f"⚠️ Очередь воркера {index} переполнена, событие для {peer_id} отброшено")
+            return False
+
+    def _worker(self, index):
+        """Цикл воркера: события обрабатываются строго по порядку"""
+        work_queue = self.queues[index]
+        while True:
+            item = work_queue.get()
+            if item is None:
+                work_queue.task_done()
+                break
+
+            update, submitted_at = item
+            started = time.perf_counter()
+            # Время от получения события из Long Poll до начала обработки
+            self.queue_wait.observe(started - submitted_at)
+            try:
+                self.handler(update)
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                self.log(f"Ошибка в воркере {index}: {e}")
+            finally:
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    self.processed += 1
+                    self.busy_time[index] += elapsed
+                work_queue.task_done()
+
+    def get_stats(self):
+        """Возвращает метрики пула: глубину очередей, отброшенные события, загрузку воркеров"""
+        uptime = max(time.time() - self.started_at, 1e-9)
+        with self.lock:
+            return {
+                'workers': self.workers_count,
+                'queue_depth': [q.qsize() for q in self.queues],
+                'submitted': self.submitted,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'busy_time': [round(t, 3) for t in self.busy_time],
+                'utilization': [round(t / uptime, 3) for t in self.busy_time],
+                'queue_wait_p95_ms': self.queue_wait.percentile(0.95),
+            }
+
+    def stop(self, timeout=5.0):
+        """Останавливает воркеры после обработки уже поставленных событий"""
+        if not self.running:
+            return
+        self.running = False
+        for work_queue in self.queues:
+            try:
+                work_queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        for thread in self.threads:
+            thread.join(timeout)
+
+class Scheduler:
+    """Единый планировщик отложенных задач: одна куча по времени срабатывания и один поток.
+
+    Задачи адресуются ключом: повторное планирование с тем же ключом заменяет задачу.
+    Колбэки выполняются в небольшом пуле, чтобы долгая задача не задерживала остальные.
+    Задачи с persist=True сохраняются в БД и восстанавливаются после перезапуска."""
+
+    def __init__(self, workers=4, db=None, log=print):
+        self.log = log
+        self.db = db
+        self.heap = []
+        self.jobs = {}
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix='scheduler')
+        self.running = True
+
+        # Метрики
+        self.executed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.lateness_total = 0.0
+        self.lateness_max = 0.0
+
+        self.thread = threading.Thread(target=self._loop, daemon=True, name='scheduler')
+        self.thread.start()
+
+    def schedule(self, key, delay, func, *args, interval=None, persist=False):
+        """Запускает func(*args) через delay секунд; interval делает задачу периодической"""
+        return self.schedule_at(key, time.time() + max(0.0, delay), func, *args,
+                                interval=interval, persist=persist)
+
+    def schedule_at(self, key, due_at, func, *args, interval=None, persist=False):
+        """Запускает func(*args) в момент due_at (unix time)"""
+        job = {
+            'seq': next(self.sequence),
+            'due_at': due_at,
+            'func': func,
+            'args': args,
+            'interval': interval,
+            'persist': persist,
+        }
+        with self.condition:
+            previous = self.jobs.get(key)
+            self.jobs[key] = job
+            heapq.heappush(self.heap, (due_at, job['seq'], key))
+            self._compact()
+            if self.heap[0][2] == key:
+                self.condition.notify()
+
+        if persist:
+            self._save(key, job)
+        elif previous and previous['persist']:
+            self._delete(key)
+        return key
+
+    def cancel(self, key):
+        """Отменяет задачу по ключу; возвращает True, если задача была"""
+        with self.condition:
+            job = self.jobs.pop(key, None)
+            if not job:
+                return False
+            self.cancelled += 1
+            self._compact()
+
+        if job['persist']:
+            self._delete(key)
+        return True
+
+    def reschedule(self, key, delay):
+        """Переносит существующую задачу на delay секунд от текущего момента"""
+        with self.condition:
+            job = self.jobs.get(key)
+            if not job:
+                return False
+            job['seq'] = next(self.sequence)
+            job['due_at'] = time.time() + max(0.0, delay)
+            heapq.heappush(self.heap, (job['due_at'], job['seq'], key))
+            self._compact()
+            self.condition.notify()
+
+        if job['persist']:
+            self._save(key, job)
+        return True
+
+    def exists(self, key):
+        with self.condition:
+            return key in self.jobs
+
+    def restore(self, target):
+        """Восстанавливает сохраненные задачи; методы ищутся по имени на объекте target"""
+        if not self.db:
+            return 0
+
+        restored = 0
+        for row in self.db.get_scheduled_jobs():
+            func = getattr(target, row['method'], None)
+            if not callable(func):
+                self.log(f"⚠️ Задача {row['job_key']} ссылается на неизвестный метод {row['method']}, удаляем")
+                self._delete(row['job_key'])
+                continue
+            args = json.loads(row['args']) if row['args'] else []
+            self.schedule_at(row['job_key'], row['due_at'], func, *args,
+                             interval=row['interval'], persist=True)
+            restored += 1
+        return restored
+
+    def _compact(self):
+        """Перестраивает кучу, когда в ней накопилось много отмененных записей"""
+        if len(self.heap) > 2 * len(self.jobs) + 64:
+            self.heap = [(job['due_at'], job['seq'], key) for key, job in self.jobs.items()]
+            heapq.heapify(self.heap)
+
+    def _is_stale(self, entry):
+        job = self.jobs.get(entry[2])
+        return job is None or job['seq'] != entry[1]
+
+    def _save(self, key, job):
+        if not self.db:
+            return
+        try:
+            self.db.save_scheduled_job(key, job['func'].__name__, job['args'], job['due_at'], job['interval'])
+        except Exception as e:
+            self.log(f"Ошибка сохранения задачи {key}: {e}")
+
+    def _delete(self, key):
+        if not self.db:
+            return
+        try:
+            self.db.delete_scheduled_job(key)
+        except Exception as e:
+            self.log(f"Ошибка удаления задачи {key}: {e}")
+
+    def _loop(self):
+        """Поток планировщика: спит до ближайшей задачи и передает ее в пул"""
+        while True:
+            with self.condition:
+                while self.running:
+                    while self.heap and self._is_stale(self.heap[0]):
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    wait = self.heap[0][0] - time.time()
+                    if wait > 0:
+                        self.condition.wait(wait)
+                        continue
+
+                    due_at, _, key = heapq.heappop(self.heap)
+                    job = self.jobs[key]
+                    if job['interval']:
+                        # Периодическая задача: следующий запуск не раньше текущего момента
+                        job['seq'] = next(self.sequence)
+                        job['due_at'] = max(due_at + job['interval'], time.time())
+                        heapq.heappush(self.heap, (job['due_at'], job['seq'], key))
+                    else:
+                        del self.jobs[key]
+
+                    lateness = time.time() - due_at
+                    self.lateness_total += lateness
+                    self.lateness_max = max(self.lateness_max, lateness)
+                    break
+                else:
+                    return
+
+            if job['persist']:
+                if job['interval']:
+                    self._save(key, job)
+                else:
+                    self._delete(key)
+
+            try:
+                self.executor.submit(self._run, key, job['func'], job['args'])
+            except RuntimeError:
+                return
+
+    def _run(self, key, func, args):
+        try:
+            func(*args)
+            with self.condition:
+                self.executed += 1
+        except Exception as e:
+            with self.condition:
+                self.failed += 1
+            self.log(f"Ошибка в задаче планировщика {key}: {e}")
+
+    def get_stats(self):
+        """Возвращает метрики: размер очереди, выполненные и отмененные задачи, опоздание запусков"""
+        with self.condition:
+            fired = self.executed + self.failed
+            next_due = min((job['due_at'] for job in self.jobs.values()), default=None)
+            return {
+                'queue_size': len(self.jobs),
+                'heap_size': len(self.heap),
+                'executed': self.executed,
+                'failed': self.failed,
+                'cancelled': self.cancelled,
+                'avg_lateness_ms': round(self.lateness_total / fired * 1000, 2) if fired else 0.0,
+                'max_lateness_ms': round(self.lateness_max * 1000, 2),
+                'next_due_in': round(next_due - time.time(), 3) if next_due is not None else None,
+            }
+
+    def stop(self, timeout=5.0):
+        """Останавливает поток планировщика; сохраненные задачи остаются в БД"""
+        if not self.running:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class AsyncVKRuntime:
+    """Асинхронный Long Poll и VK API поверх одного пула keep-alive соединений (aiohttp).
+
+    Синхронные обработчики бота выполняются в потоках (asyncio.to_thread), но их вызовы
+    VK API (api_call_raw, в том числе пачки execute) уходят в event loop и выполняются через
+    тот же пул соединений. Адрес API берется из bot.api_url, поэтому рантайм можно запускать
+    против локального фейкового сервера VK.
+    """
+
+    def __init__(self, bot, concurrency=None, connections=None):
+        self.bot = bot
+        self.api_url = bot.api_url
+        self.concurrency = concurrency or CONFIG.get('async_concurrency', 64)
+        self.connections = connections or CONFIG.get('async_connections', 32)
+        self.session = None
+        self.semaphore = None
+        self.loop = None
+        self.loop_thread_id = None
+        self.peer_locks = {}
+        self.tasks = set()
+
+    async def start(self):
+        """Открывает HTTP-сессию с пулом соединений"""
+        if aiohttp is None:
+            raise RuntimeError("Для асинхронного режима установите пакет aiohttp")
+        connector = aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=35))
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        # С этого момента VKBot.api_call_raw отправляет запросы через этот рантайм
+        self.bot.async_runtime = self
+
+    async def close(self):
+        """Дожидается активных задач и закрывает сессию"""
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.bot.async_runtime = None
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def api_call_raw(self, method, params=None):
+        """Асинхронный аналог VKBot.api_call_raw: ответ целиком, вместе с ошибкой"""
+        params = dict(params or {})
+        params['access_token'] = self.bot.token
+        params['v'] = self.bot.api_version
+
+        delay = self.bot.rate_limiter.reserve(self.bot.token, method)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        async with self.session.post(f'{self.api_url}/{method}', data=params) as response:
+            result = await response.json(content_type=None)
+
+        error = result.get('error')
+        if error and error.get('error_code') in VK_RETRY_ERROR_CODES:
+            self.bot.rate_limiter.penalize(self.bot.token, method)
+        return result
+
+    def call_api_from_thread(self, method, params=None):
+        """Вызов VK API из потока обработчика: запрос выполняется в event loop, поток ждет ответ"""
+        future = asyncio.run_coroutine_threadsafe(self.api_call_raw(method, params), self.loop)
+        return future.result(timeout=40)
+
+    async def api_request(self, method, params=None):
+        """Асинхронный аналог VKBot.api_request"""
+        started = time.perf_counter()
+        try:
+            result = await self.api_call_raw(method, params)
+            self.bot.tracer.add_vk(method, time.perf_counter() - started)
+
+            if 'error' in result:
+                self.bot.log(f"VK API Error: {result['error']}")
+                return None
+
+            return result.get('response')
+        except Exception as e:
+            self.bot.log(f"Ошибка API запроса: {e}")
+            return None
+
+    async def get_long_poll_server(self):
+        response = await self.api_request('groups.getLongPollServer', {
+            'group_id': self.bot.group_id
+        })
+
+        if response:
+            self.bot.server = response['server']
+            self.bot.key = response['key']
+            self.bot.ts = response['ts']
+            self.bot.log(f"Long Poll сервер настроен: {self.bot.server[:50]}...")
+            return True
+
+        self.bot.log("❌ Не удалось получить Long Poll сервер. Проверьте настройки группы ВК!")
+        return False
+
+    async def poll(self, wait=25):
+        """Один запрос к Long Poll серверу, возвращает список событий"""
+        params = {'act': 'a_check', 'key': self.bot.key, 'ts': self.bot.ts, 'wait': wait}
+        async with self.session.get(self.bot.server, params=params) as response:
+            data = await response.json(content_type=None)
+
+        if 'failed' in data:
+            if data['failed'] == 1:
+                self.bot.ts = data['ts']
+            elif not await self.get_long_poll_server():
+                raise RuntimeError("Ошибка обновления Long Poll сервера")
+            return []
+
+        self.bot.ts = data['ts']
+        return data.get('updates', [])
+
+    async def call(self, func, *args, **kwargs):
+        """Выполняет синхронный обработчик вне event loop"""
+        async with self.semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    def command(self, name):
+        """Возвращает корутинную обертку над command_* методом бота"""
+        handler = getattr(self.bot, name if name.startswith('command_') else f'command_{name}')
+
+        async def coroutine(*args, **kwargs):
+            return await self.call(handler, *args, **kwargs)
+
+        return coroutine
+
+    async def handle_update(self, update):
+        """Обрабатывает событие, сохраняя порядок внутри одной беседы"""
+        peer_id = EventDispatcher.get_event_peer_id(update)
+        entry = self.peer_locks.setdefault(peer_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self.call(self.bot.process_message, update)
+        except Exception as e:
+            self.bot.log(f"Ошибка обработки события: {e}")
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.peer_locks[peer_id]
+
+    async def run(self):
+        """Основной асинхронный цикл Long Poll"""
+        await self.start()
+        try:
+            if not await self.get_long_poll_server():
+                self.bot.log("Ошибка получения Long Poll сервера")
+                return
+
+            self.bot.log("Бот запущен в асинхронном режиме и слушает сообщения...")
+
+            while self.bot.running:
+                try:
+                    updates = await self.poll()
+                except Exception as e:
+                    self.bot.log(f"Ошибка в главном цикле: {e}")
+                    await asyncio.sleep(5)
+                    continue
+
+                if updates:
+                    self.bot.schedule_prefetch_user_infos(updates)
+
+                for update in updates:
+                    task = asyncio.create_task(self.handle_update(update))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+        finally:
+            await self.close()
 
 class VKBot:
     def __init__(self):
         self.token = VK_TOKEN
         self.group_id = VK_GROUP_ID
         self.api_version = CONFIG.get('api_version', '5.131')
+        self.api_url = CONFIG.get('api_url', 'https://api.vk.com/method')
+        self.http = requests.Session()
+        # Заполняется AsyncVKRuntime на время асинхронного режима
+        self.async_runtime = None
         self.server = None
         self.key = None
         self.ts = None
-        self.db = Database()
+        # Трассировка стадий обработки; время запросов SQLite относится к текущей трассе
+        self.tracer = LatencyTracer(
+            enabled=CONFIG.get('latency_tracing', True),
+            slow_ms=CONFIG.get('trace_slow_ms', 2000),
+            log=self.log
+        )
+        self.profiler = SamplingProfiler(interval=CONFIG.get('profiler_interval', 0.005))
+        self.metrics_server = None
+        self.db = Database(on_query=self.tracer.add_db if self.tracer.enabled else None)
         self.registering_chats = {}
-        self.mute_check_timer = None
+        self.user_cache = UserProfileCache(
+            max_size=CONFIG.get('user_cache_size', 10000),
+            ttl=CONFIG.get('user_cache_ttl', 3600),
+            negative_ttl=CONFIG.get('user_cache_negative_ttl', 300)
+        )
+        self.member_cache = ConversationMemberCache(
+            self.fetch_conversation_members,
+            admin_ttl=CONFIG.get('member_cache_admin_ttl', 60),
+            online_ttl=CONFIG.get('member_cache_online_ttl', 30),
+            max_chats=CONFIG.get('member_cache_size', 1000)
+        )
         self.start_time = time.time()
         self.running = True
+        self.command_registry = None
+        self.command_suggester = None
+        self.dispatcher = EventDispatcher(
+            self.process_message,
+            workers=CONFIG.get('worker_pool_size', 8),
+            queue_size=CONFIG.get('worker_queue_size', 1000),
+            log=self.log
+        )
+        self.rate_limiter = TokenBucketRateLimiter(
+            rate=CONFIG.get('vk_rate_limit', 19),
+            method_rates=CONFIG.get('vk_method_rate_limits', {'messages.send': 15})
+        )
+        self.api_max_retries = CONFIG.get('vk_max_retries', 4)
+        # Сколько секунд обработчик события может ждать повторов: воркер диспетчера обслуживает и другие чаты
+        self.handler_retry_budget = CONFIG.get('vk_handler_retry_budget', 2.0)
+        self.retry_deadline = threading.local()
+        self.list_page_size = CONFIG.get('list_page_size', 20)
+        # Предзагрузка профилей авторов пачки событий идет вне потока Long Poll
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        # Общий пул для рассылки действий по чатам объединения (gban, gkick, gzov)
+        self.fanout_pool = ThreadPoolExecutor(
+            max_workers=CONFIG.get('fanout_workers', 4),
+            thread_name_prefix='fanout'
+        )
+        self.batcher = VKExecuteBatcher(
+            self.api_call_raw,
+            flush_interval=CONFIG.get('execute_flush_interval', 0.05),
+            log=self.log
+        )
+        self.scheduler = Scheduler(
+            workers=CONFIG.get('scheduler_workers', 4),
+            db=self.db,
+            log=self.log
+        )
 
         # Инициализировать разработчика
         self.initialize_developer()
@@ -1250,8 +4007,13 @@ class VKBot:
         if not self.token or not self.group_id:
             raise ValueError("VK_TOKEN и VK_GROUP_ID должны быть установлены в config.json")
 
+        restored = self.scheduler.restore(self)
+        if restored:
+            self.log(f"Восстановлено отложенных задач: {restored}")
+        self.resume_games()
+        self.resume_broadcasts()
         self.start_mute_checker()
-        self.start_mute_expiration_checker()
+        self.start_perf_monitoring()
 
     def log(self, message):
         """Метод для логирования сообщений"""
@@ -1272,8 +4034,9 @@ class VKBot:
         # Основной цикл обработки событий
         while self.running:
             try:
-                response = requests.get(
-                    f"{self.server}?act=a_check&key={self.key}&ts={self.ts}&wait=25"
+                response = self.http.get(
+                    f"{self.server}?act=a_check&key={self.key}&ts={self.ts}&wait=25",
+                    timeout=30
                 ).json()
 
                 if 'failed' in response:
@@ -1286,6 +4049,7 @@ class VKBot:
                     continue
 
                 self.ts = response['ts']
+                self.schedule_prefetch_user_infos(response.get('updates', []))
                 self.handle_events(response.get('updates', []))
                 
             except Exception as e:
@@ -1455,70 +4219,127 @@ class VKBot:
             self.log(f"❌ Ошибка удаления сообщения: {e}")
 
     def start_mute_checker(self):
-        """Запустить периодическую проверку истекших мутов"""
-        def check_expired_mutes():
-            try:
-                # Создаем новое соединение с БД для этого потока
-                db = Database()
-                expired_mutes = db.get_expired_mutes()
-                
-                for mute in expired_mutes:
-                    try:
-                        # Снимаем мут
-                        db.remove_mute_by_id(mute['id'])
-
-                        # Отправляем уведомление в чат
-                        chat_id = mute['chat_id']
-                        user_id = mute['user_id']
-                        peer_id = 2000000000 + chat_id
+        """Запланировать снятие всех активных мутов точно по mute_until"""
+        # Дальше очередь обновляют add_mute/remove_mute через подписку
+        self.db.add_mute_listener(self.schedule_mute_expiry)
+        mutes = self.db.get_timed_mutes()
+        for mute in mutes:
+            self.schedule_mute_expiry(dict(mute), True)
+        self.log(f"Система автоматического снятия мутов запущена, запланировано: {len(mutes)}")
+
+    def schedule_mute_expiry(self, mute, active):
+        """Ставит или снимает задачу окончания мута в планировщике"""
+        key = f"mute:{mute['id']}"
+        mute_until = parse_db_datetime(mute['mute_until']) if active else None
+        if mute_until:
+            self.scheduler.schedule_at(key, mute_until.timestamp(), self.expire_mute, mute['id'])
+        else:
+            self.scheduler.cancel(key)
 
-                        # Получаем информацию о пользователе
-                        user_info = self.get_user_info(user_id)
-                        user_name = user_info['screen_name'] if user_info else str(user_id)
+    def expire_mute(self, mute_id):
+        """Снимает истекший мут, если он еще активен"""
+        mute = self.db.get_active_mute_by_id(mute_id)
+        if mute:
+            self.check_expired_mutes([mute])
 
-                        message = f"⚠️ У @{user_name}(Пользователя) закончилась блокировка чата."
-                        self.send_message(peer_id, message)
-                        self.log(f"Автоматически снят мут с пользователя {user_id} в чате {chat_id}")
+    def resume_games(self):
+        """Возобновляет раунды, не рассчитанные до перезапуска, или возвращает по ним ставки.
 
-                    except Exception as e:
-                        self.log(f"Ошибка обработки истекшего мута {mute['id']}: {e}")
+        Политика задается в config.json: game_recovery = 'resume' (по умолчанию) или 'refund'.
+        Раунды без сохраненного peer_id (созданные до появления колонки) всегда возвращаются."""
+        refund_all = CONFIG.get('game_recovery', 'resume') == 'refund'
+        now = time.time()
+        resumed = refunded = 0
 
-                db.close()
-                
-            except Exception as e:
-                self.log(f"Ошибка при проверке истекших мутов: {e}")
+        try:
+            for game in self.db.get_unsettled_roulette_games():
+                peer_id, game_id = game['peer_id'], game['id']
+                if refund_all or not peer_id:
+                    self.db.refund_roulette_game(game_id)
+                    self.notify_game_refund(peer_id, 'Рулетка', game_id)
+                    refunded += 1
+                    continue
+                due_at = max(game['settle_at'] or now, now)
+                if game['status'] == 'closed':
+                    self.scheduler.schedule_at(f"roulette-settle:{game_id}", due_at, self.settle_roulette_round, peer_id, game_id)
+                else:
+                    self.scheduler.schedule_at(f"roulette:{game_id}", due_at, self.end_roulette_round,
+                                               peer_id, game_id, game['chat_id'])
+                resumed += 1
+
+            for game in self.db.get_unsettled_crash_games():
+                peer_id, game_id, game_type = game['peer_id'], game['id'], game['game_type'] or 'crash'
+                if refund_all or not peer_id:
+                    self.db.refund_crash_game(game_id)
+                    self.notify_game_refund(peer_id, 'Дрим' if game_type == 'dream' else 'Crash', game_id)
+                    refunded += 1
+                    continue
+                due_at = max(game['settle_at'] or now, now)
+                if game['status'] == 'closed':
+                    self.scheduler.schedule_at(f"crash-settle:{game_id}", due_at, self.settle_crash_round,
+                                               peer_id, game_id, game_type)
+                else:
+                    end_round = self.end_dream_round if game_type == 'dream' else self.end_crash_round
+                    self.scheduler.schedule_at(f"crash:{game_id}", due_at, end_round, peer_id, game_id, game['chat_id'])
+                resumed += 1
+
+            for game in self.db.get_unsettled_dice_games():
+                peer_id, game_id = game['peer_id'], game['id']
+                key = f"dice:{game_id}"
+                if self.scheduler.exists(key):
+                    # Таймаут или переигровка уже восстановлены из scheduled_jobs
+                    continue
+                if refund_all or not peer_id:
+                    self.db.refund_dice_game(game_id, statuses=('waiting', 'rolling'))
+                    self.notify_game_refund(peer_id, 'Кости', game_id)
+                    refunded += 1
+                elif game['status'] == 'rolling':
+                    self.scheduler.schedule(key, 0, self.start_dice_game, peer_id, game_id, game['chat_id'], persist=True)
+                    resumed += 1
+                else:
+                    self.scheduler.schedule(key, 1800.0, self.cancel_dice_game_timeout,
+                                            peer_id, game_id, game['chat_id'], persist=True)
+                    resumed += 1
+        except Exception as e:
+            self.log(f"Ошибка восстановления игр: {e}")
 
-            # Запускаем следующую проверку через 60 секунд, если бот еще работает
-            if self.running:
-                self.mute_check_timer = threading.Timer(60.0, check_expired_mutes)
-                self.mute_check_timer.daemon = True
-                self.mute_check_timer.start()
+        if resumed or refunded:
+            self.log(f"Незавершенные игры: возобновлено {resumed}, ставки возвращены в {refunded}")
 
-        # Первая проверка через 10 секунд после запуска
-        if self.running:
-            self.mute_check_timer = threading.Timer(10.0, check_expired_mutes)
-            self.mute_check_timer.daemon = True
-            self.mute_check_timer.start()
-            self.log("Система автоматической проверки мутов запущена")
-
-    def start_mute_expiration_checker(self):
-        """Запускает фоновую проверку истекших блокировок чата"""
-        self.check_expired_mutes()
-        # Запускаем проверку каждые 60 секунд, если бот еще работает
-        if self.running:
-            self.mute_check_timer = threading.Timer(60.0, self.start_mute_expiration_checker)
-            self.mute_check_timer.daemon = True
-            self.mute_check_timer.start()
+    def notify_game_refund(self, peer_id, game_name, game_id):
+        """Сообщает в чат, что раунд прерван перезапуском и ставки возвращены"""
+        if peer_id:
+            self.send_message(peer_id, f'♻️ Игра "{game_name}" №{game_id} прервана перезапуском бота. Ставки возвращены.')
 
     def stop(self):
         """Остановка бота"""
         self.log("🛑 Остановка бота...")
         self.running = False
         
-        # Останавливаем таймеры
-        if self.mute_check_timer:
-            self.mute_check_timer.cancel()
+        # Останавливаем планировщик отложенных задач
+        if self.scheduler:
+            self.scheduler.stop()
+
+        if self.metrics_server:
+            self.metrics_server.stop()
+        self.profiler.stop()
+
+        # Дожидаемся обработки событий, уже стоящих в очередях
+        if self.dispatcher:
+            self.dispatcher.stop()
+
+        if self.fanout_pool:
+            self.fanout_pool.shutdown(wait=True)
+
+        if self.prefetch_pool:
+            self.prefetch_pool.shutdown(wait=False, cancel_futures=True)
+
+        if self.batcher:
+            self.batcher.stop()
             
+        if self.http:
+            self.http.close()
+
         # Закрываем соединение с БД
         if self.db:
             self.db.close()
@@ -1567,30 +4388,15 @@ class VKBot:
             self.log(f"Ошибка проверки прав пользователя: {e}")
             return False
 
-        self.start_mute_checker()
-        self.start_mute_expiration_checker()
-
-    def start_mute_expiration_checker(self):
-        """Запускает фоновую проверку истекших блокировок чата"""
-        self.check_expired_mutes()
-        # Запускаем проверку каждые 60 секунд
-        self.mute_check_timer = threading.Timer(60.0, self.start_mute_expiration_checker)
-        self.mute_check_timer.daemon = True
-        self.mute_check_timer.start()
-
-    def check_expired_mutes(self):
-        """Проверяет и обрабатывает истекшие блокировки чата"""
+    def check_expired_mutes(self, expired_mutes):
+        """Снимает истекшие блокировки чата и уведомляет чаты"""
         try:
-            cursor = self.db.conn.cursor()
-            # Находим все активные блокировки, у которых истек срок
-            cursor.execute('''
-                SELECT id, user_id, chat_id, mute_until 
-                FROM mutes 
-                WHERE is_active = 1 
-                AND mute_until IS NOT NULL
-                AND mute_until <= datetime("now")
-            ''')
-            expired_mutes = cursor.fetchall()
+            if not expired_mutes:
+                return
+
+            # Профили всех пользователей загружаем одним users.get
+            user_infos = self.get_users_info([mute['user_id'] for mute in expired_mutes])
+            notifications = []
 
             for mute in expired_mutes:
                 try:
@@ -1608,19 +4414,26 @@ class VKBot:
                     display_name = self.get_display_name(mute['user_id'], mute['chat_id'])
 
                     # Получаем информацию о пользователе для упоминания
-                    user_info = self.get_user_info(mute['user_id'])
+                    user_info = user_infos.get(str(mute['user_id']))
                     if user_info:
                         first_name = user_info.get('first_name', display_name)
                         message = f"⚠ У [id{mute['user_id']}|{first_name}] закончилась блокировка чата."
                     else:
                         message = f"⚠ У [id{mute['user_id']}|Пользователя] закончилась блокировка чата."
 
-                    self.send_message(chat_peer_id, message)
+                    notifications.append(('messages.send', {
+                        'peer_id': chat_peer_id,
+                        'message': message,
+                        'random_id': random.randint(1, 2147483647)
+                    }))
                     self.log(f"Блокировка истекла для пользователя {mute['user_id']} в чате {mute['chat_id']}")
 
                 except Exception as e:
                     self.log(f"Ошибка обработки истекшей блокировки {mute['id']}: {e}")
 
+            # Уведомления уходят пачками через execute
+            self.api_request_many(notifications)
+
         except Exception as e:
             self.log(f"Ошибка проверки истекших блокировок: {e}")
 
@@ -1631,14 +4444,9 @@ class VKBot:
 
         if chat_id:
             try:
-                cursor = self.db.conn.cursor()
-                cursor.execute(
-                    'SELECT role_name FROM custom_role_definitions WHERE chat_id = ? AND role_level = ? AND is_active = 1',
-                    (chat_id, role_level)
-                )
-                custom_role = cursor.fetchone()
+                custom_role = self.db.get_chat_permissions(chat_id)['custom_roles'].get(role_level)
                 if custom_role:
-                    return custom_role['role_name']
+                    return custom_role
             except Exception as e:
                 self.log(f"Ошибка получения кастомного названия роли: {e}")
 
@@ -1654,54 +4462,233 @@ class VKBot:
 
         if chat_id:
             try:
-                cursor = self.db.conn.cursor()
-                cursor.execute(
-                    'SELECT COUNT(*) as count FROM custom_role_definitions WHERE chat_id = ? AND role_level = ? AND is_active = 1',
-                    (chat_id, role_level)
-                )
-                result = cursor.fetchone()
-                return result['count'] > 0
+                return role_level in self.db.get_chat_permissions(chat_id)['custom_roles']
             except Exception as e:
                 self.log(f"Ошибка проверки существования роли: {e}")
 
         return False
 
     def get_similar_commands(self, entered_command):
-        """Находит похожие команды по первой букве"""
+        """Находит похожие команды: по началу слова и с учетом опечаток"""
         if not entered_command:
             return []
 
-        first_letter = entered_command[0].lower()
-        similar_commands = []
+        if self.command_suggester is None:
+            self.command_suggester = CommandSuggester(CONFIG['commands'])
+        return self.command_suggester.suggest(entered_command)
 
-        for cmd_key, cmd_aliases in CONFIG['commands'].items():
-            for alias in cmd_aliases:
-                if alias.lower().startswith(first_letter) and alias.lower() != entered_command.lower():
-                    similar_commands.append('/' + alias)
+    def reload_config(self):
+        """Перечитывает config.json и сбрасывает построенные по нему индексы команд.
+
+        В отличие от load_config не завершает процесс: при ошибке остается старая конфигурация
+        и возвращается текст ошибки (None — успех)."""
+        try:
+            with open('config.json', 'r', encoding='utf-8') as f:
+                new_config = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            return str(e)
+        if not isinstance(new_config, dict) or not isinstance(new_config.get('commands'), dict):
+            return 'в конфигурации нет раздела commands'
+
+        # Сначала дописываем новые значения, потом убираем исчезнувшие ключи:
+        # другие потоки читают CONFIG все это время и не должны видеть его пустым
+        CONFIG.update(new_config)
+        for key in set(CONFIG) - set(new_config):
+            CONFIG.pop(key, None)
+        self.command_registry = None
+        self.command_suggester = None
+        self.log("Конфигурация перезагружена")
+        return None
 
-        return list(set(similar_commands))[:5]
+    def command_reload(self, peer_id, sender_id):
+        """Перезагрузка config.json без перезапуска бота"""
+        system_admin = self.db.get_system_admin(sender_id)
+        if not system_admin or system_admin['access_level'] < 5:
+            self.send_message(peer_id, '❌ Только разработчик может перезагружать конфигурацию.')
+            return
 
-    def api_request(self, method, params=None):
-        if params is None:
-            params = {}
+        error = self.reload_config()
+        if error:
+            self.log(f"Ошибка перезагрузки конфигурации: {error}")
+            self.send_message(peer_id, f'❌ Конфигурация не перезагружена, работает прежняя: {error}')
+        else:
+            self.send_message(peer_id, '✅ Конфигурация перезагружена.')
+
+    def api_call_raw(self, method, params=None):
+        """Выполняет HTTP-запрос к VK API и возвращает ответ целиком"""
+        # В асинхронном режиме запрос идет через пул соединений aiohttp (см. AsyncVKRuntime)
+        runtime = self.async_runtime
+        if runtime is not None and threading.get_ident() != runtime.loop_thread_id:
+            return runtime.call_api_from_thread(method, params)
 
+        params = dict(params or {})
         params['access_token'] = self.token
         params['v'] = self.api_version
 
-        url = f'https://api.vk.com/method/{method}'
+        self.rate_limiter.acquire(self.token, method)
+        response = self.http.post(f'{self.api_url}/{method}', data=params, timeout=30)
+        result = response.json()
+
+        error = result.get('error')
+        if error and error.get('error_code') in VK_RETRY_ERROR_CODES:
+            self.rate_limiter.penalize(self.token, method)
+        return result
+
+    def get_retry_delay(self, attempt):
+        """Экспоненциальная задержка перед повтором со случайным разбросом"""
+        return min(30.0, 0.5 * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+    @contextmanager
+    def retry_budget(self, seconds):
+        """Ограничивает суммарное ожидание повторов VK-вызовов текущего потока внутри блока"""
+        previous = getattr(self.retry_deadline, 'value', None)
+        deadline = time.monotonic() + seconds
+        self.retry_deadline.value = deadline if previous is None else min(previous, deadline)
+        try:
+            yield
+        finally:
+            self.retry_deadline.value = previous
+
+    def wait_before_retry(self, attempt):
+        """Ждет перед повтором; False - повтор не уложится в бюджет потока и вызов надо отбросить"""
+        delay = self.get_retry_delay(attempt)
+        deadline = getattr(self.retry_deadline, 'value', None)
+        if deadline is not None and time.monotonic() + delay > deadline:
+            return False
+        time.sleep(delay)
+        return True
+
+    def api_request_result(self, method, params=None):
+        """Вызов VK API с повторами при ошибках 6/9.
 
+        Возвращает словарь: status ('ok', 'retried' или 'dropped'), response, error, attempts.
+        """
+        started = time.perf_counter()
         try:
-            response = requests.post(url, data=params)
-            result = response.json()
+            error = None
+            for attempt in range(self.api_max_retries + 1):
+                try:
+                    result = self.api_call_raw(method, params)
+                except Exception as e:
+                    error = {'error_code': None, 'error_msg': str(e)}
+                else:
+                    if 'error' not in result:
+                        return {
+                            'status': 'ok' if attempt == 0 else 'retried',
+                            'response': result.get('response'),
+                            'error': None,
+                            'attempts': attempt + 1
+                        }
+                    error = result['error']
+                    if error.get('error_code') not in VK_RETRY_ERROR_CODES:
+                        return {'status': 'dropped', 'response': None, 'error': error, 'attempts': attempt + 1}
 
-            if 'error' in result:
-                self.log(f"VK API Error: {result['error']}")
-                return None
+                if attempt == self.api_max_retries or not self.wait_before_retry(attempt):
+                    break
 
-            return result.get('response')
-        except Exception as e:
-            self.log(f"Ошибка API запроса: {e}")
-            return None
+            return {'status': 'dropped', 'response': None, 'error': error, 'attempts': attempt + 1}
+        finally:
+            self.tracer.add_vk(method, time.perf_counter() - started)
+
+    def api_request(self, method, params=None, batch=False):
+        """Вызов VK API; с batch=True вызов уходит через execute вместе с соседними"""
+        if batch:
+            return self.api_request_many([(method, params)])[0]
+
+        result = self.api_request_result(method, params)
+        if result['status'] == 'dropped':
+            self.log(f"VK API Error ({method}): {result['error']}")
+        elif result['status'] == 'retried':
+            self.log(f"VK API: {method} выполнен с {result['attempts']}-й попытки")
+        return result['response']
+
+    def api_request_many_results(self, calls):
+        """Выполняет вызовы (method, params) пачками execute с повторами при ошибках 6/9.
+
+        Для каждого вызова возвращает словарь того же вида, что и api_request_result.
+        """
+        started = time.perf_counter()
+        try:
+            results = [None] * len(calls)
+            pending = list(range(len(calls)))
+            attempt = 0
+
+            while pending:
+                futures = [(index, self.batcher.submit(*calls[index])) for index in pending]
+                retry = []
+                for index, future in futures:
+                    try:
+                        outcome = (future.result(), None)
+                    except Exception as e:
+                        outcome = (None, e)
+                    results[index], retryable = self.make_call_result(attempt, *outcome)
+                    if retryable:
+                        retry.append(index)
+
+                pending = retry if retry and self.wait_before_retry(attempt) else []
+                attempt += 1
+
+            return results
+        finally:
+            # Одиночный вызов учитываем под своим методом, пачку — как execute
+            self.tracer.add_vk(calls[0][0] if len(calls) == 1 else 'execute', time.perf_counter() - started)
+
+    def api_execute_results(self, calls):
+        """Выполняет до 25 вызовов (method, params) одним execute прямо в вызывающем потоке.
+
+        В отличие от api_request_many_results вызовы не идут через общий поток батчера, поэтому
+        запросы из разных потоков действительно выполняются параллельно (в пределах rate_limiter).
+        Повторы при ошибках 6/9 и вид результатов — как у api_request_many_results."""
+        started = time.perf_counter()
+        try:
+            results = [None] * len(calls)
+            pending = list(range(len(calls)))
+            attempt = 0
+
+            while pending:
+                batch = [calls[index] for index in pending]
+                try:
+                    result = self.api_call_raw('execute', {'code': VKExecuteBatcher.execute_code(batch)})
+                    outcomes = VKExecuteBatcher.split_response(result, [method for method, _ in batch])
+                except Exception as e:
+                    outcomes = [(None, e)] * len(batch)
+
+                retry = []
+                for index, outcome in zip(pending, outcomes):
+                    results[index], retryable = self.make_call_result(attempt, *outcome)
+                    if retryable:
+                        retry.append(index)
+
+                pending = retry if retry and self.wait_before_retry(attempt) else []
+                attempt += 1
+
+            return results
+        finally:
+            self.tracer.add_vk('execute', time.perf_counter() - started)
+
+    def make_call_result(self, attempt, response, error):
+        """Результат вызова в виде api_request_result и признак того, что вызов стоит повторить"""
+        if error is None:
+            status = 'ok' if attempt == 0 else 'retried'
+            return {'status': status, 'response': response, 'error': None, 'attempts': attempt + 1}, False
+
+        if isinstance(error, VKAPIError):
+            retryable = error.code in VK_RETRY_ERROR_CODES
+            error = {'error_code': error.code, 'error_msg': error.msg}
+        else:
+            retryable = True
+            error = {'error_code': None, 'error_msg': str(error)}
+        result = {'status': 'dropped', 'response': None, 'error': error, 'attempts': attempt + 1}
+        return result, retryable and attempt < self.api_max_retries
+
+    def api_request_many(self, calls):
+        """Выполняет список вызовов (method, params) пачками execute, результат у каждого свой"""
+        results = []
+        for (method, _), result in zip(calls, self.api_request_many_results(calls)):
+            if result['status'] == 'dropped':
+                self.log(f"VK API Error ({method}): {result['error']}")
+            results.append(result['response'])
+        return results
 
     def get_long_poll_server(self):
         response = self.api_request('groups.getLongPollServer', {
@@ -1767,14 +4754,94 @@ class VKBot:
         return None
 
     def get_user_info(self, user_id):
-        response = self.api_request('users.get', {
-            'user_ids': user_id,
-            'fields': 'screen_name'
+        return self.get_users_info([user_id]).get(str(user_id))
+
+    def get_users_info(self, user_ids):
+        """Получает профили пачкой: промахи кэша запрашиваются одним users.get"""
+        result = {}
+        missing = []
+        seen = set()
+        for user_id in user_ids:
+            key = str(user_id)
+            if key in seen:
+                continue
+            seen.add(key)
+            found, info = self.user_cache.get(user_id)
+            if found:
+                result[key] = info
+            else:
+                missing.append(key)
+
+        # users.get принимает до 1000 id за раз
+        for start in range(0, len(missing), 1000):
+            chunk = missing[start:start + 1000]
+            response = self.api_request('users.get', {
+                'user_ids': ','.join(chunk),
+                'fields': 'screen_name'
+            })
+
+            # При ошибке API ничего не кэшируем
+            if response is None:
+                for key in chunk:
+                    result[key] = None
+                continue
+
+            by_id = {}
+            for profile in response:
+                by_id[str(profile['id'])] = profile
+                if profile.get('screen_name'):
+                    by_id[profile['screen_name']] = profile
+
+            for key in chunk:
+                info = by_id.get(key)
+                self.user_cache.put(key, info)
+                result[key] = info
+
+        return result
+
+    def fetch_conversation_members(self, chat_id):
+        """Запрос участников беседы для ConversationMemberCache; профили заодно попадают в кэш профилей"""
+        response = self.api_request('messages.getConversationMembers', {
+            'peer_id': 2000000000 + chat_id,
+            'fields': 'online,screen_name'
         })
+        if response:
+            for profile in response.get('profiles', []):
+                self.user_cache.put(profile['id'], profile)
+        return response
 
-        if response and len(response) > 0:
-            return response[0]
-        return None
+    def get_conversation_members(self, chat_id, online=False, refresh=False):
+        """Состав беседы (ChatMemberRoster) из кэша, см. ConversationMemberCache"""
+        if not chat_id:
+            return None
+        return self.member_cache.get(chat_id, online=online, refresh=refresh)
+
+    def schedule_prefetch_user_infos(self, updates):
+        """Запускает предзагрузку профилей в фоне: поток Long Poll не ждет users.get.
+
+        Если обработчик успеет раньше, он сам загрузит профиль при промахе кэша."""
+        try:
+            self.prefetch_pool.submit(self.prefetch_user_infos, updates)
+        except RuntimeError:
+            # Пул уже остановлен (бот завершается)
+            pass
+
+    def prefetch_user_infos(self, updates):
+        """Заранее загружает профили авторов всех сообщений из пачки событий"""
+        user_ids = []
+        for update in updates:
+            if update.get('type') != 'message_new':
+                continue
+            message = update.get('object', {}).get('message', {})
+            from_id = message.get('from_id')
+            if from_id and from_id > 0:
+                user_ids.append(from_id)
+
+        if user_ids:
+            try:
+                self.get_users_info(user_ids)
+            except Exception as e:
+                self.log(f"Ошибка предзагрузки профилей: {e}")
 
 def has_permission(self, user_id, username, required_level: Union[str, int] = 'user', chat_id=None):
     global GRAND_MANAGER_ID
@@ -1824,14 +4891,9 @@ def initialize_developer(self):
             # Проверяем, есть ли кастомное название для роли 100 в этом чате
             if chat_id:
                 try:
-                    cursor = self.db.conn.cursor()
-                    cursor.execute(
-                        'SELECT role_name FROM custom_role_definitions WHERE chat_id = ? AND role_level = 100 AND is_active = 1',
-                        (chat_id,)
-                    )
-                    custom_role = cursor.fetchone()
+                    custom_role = self.db.get_chat_permissions(chat_id)['custom_roles'].get(100)
                     if custom_role:
-                        return {'level': 100, 'name': custom_role['role_name']}
+                        return {'level': 100, 'name': custom_role}
                 except Exception as e:
                     self.log(f"Ошибка получения кастомной роли 100: {e}")
             return {'level': 100, 'name': 'Владелец'}
@@ -1839,20 +4901,16 @@ def initialize_developer(self):
         try:
             # Проверяем роль в конкретном чате
             if chat_id:
-                chat_role = self.db.get_chat_role(user_id, chat_id)
+                permissions = self.db.get_chat_permissions(chat_id)
+                chat_role = permissions['roles'].get(user_id)
                 if chat_role and chat_role['role_level'] > 0:
                     # Используем название из chat_roles (которое уже обновлено)
                     role_name = chat_role['role_name']
-
-                    # Дополнительно проверяем кастомное определение роли
-                    cursor = self.db.conn.cursor()
-                    cursor.execute(
-                        'SELECT role_name FROM custom_role_definitions WHERE chat_id = ? AND role_level = ? AND is_active = 1',
-                        (chat_id, chat_role['role_level'])
-                    )
-                    custom_role = cursor.fetchone()
+
+                    # Дополнительно проверяем кастомное определение роли
+                    custom_role = permissions['custom_roles'].get(chat_role['role_level'])
                     if custom_role:
-                        role_name = custom_role['role_name']
+                        role_name = custom_role
 
                     return {
                         'level': chat_role['role_level'],
@@ -1921,9 +4979,31 @@ def initialize_developer(self):
         if keyboard:
             params['keyboard'] = keyboard
 
-        response = self.api_request('messages.send', params)
+        with self.tracer.span('send_message'):
+            response = self.api_request('messages.send', params)
         return response
 
+    def send_message_with_id(self, peer_id, message):
+        """Отправляет сообщение и возвращает его conversation_message_id (для последующего редактирования)"""
+        response = self.api_request('messages.send', {
+            'peer_ids': peer_id,
+            'message': message,
+            'random_id': random.randint(1, 2147483647)
+        })
+        if response and isinstance(response, list):
+            return response[0].get('conversation_message_id')
+        return None
+
+    def edit_message(self, peer_id, conversation_message_id, message, keyboard=None):
+        params = {
+            'peer_id': peer_id,
+            'conversation_message_id': conversation_message_id,
+            'message': message
+        }
+        if keyboard:
+            params['keyboard'] = keyboard
+        return self.api_request('messages.edit', params)
+
     def create_dice_keyboard(self, game_id, is_creator=False):
         """Создает клавиатуру для игры в кости"""
         buttons = []
@@ -1953,20 +5033,149 @@ def initialize_developer(self):
             "buttons": buttons
         })
 
+    def create_page_keyboard(self, list_name, page, page_number):
+        """Создает inline-клавиатуру «назад/вперед» для страницы списка"""
+        buttons = []
+        for direction, label, number in (('prev', '⬅️ Назад', page_number - 1), ('next', 'Вперед ➡️', page_number + 1)):
+            if page[direction] is None:
+                continue
+            buttons.append({
+                "action": {
+                    "type": "callback",
+                    "label": label,
+                    "payload": json.dumps({
+                        "action": "list_page",
+                        "list": list_name,
+                        "cursor": page[direction],
+                        "dir": direction,
+                        "page": number
+                    })
+                },
+                "color": "secondary"
+            })
+
+        if not buttons:
+            return None
+        return json.dumps({"inline": True, "buttons": [buttons]})
+
+    def send_list_page(self, peer_id, list_name, text, page, page_number=1, message_id=None):
+        """Отправляет страницу списка; при листании заменяет ею исходное сообщение"""
+        keyboard = self.create_page_keyboard(list_name, page, page_number)
+        if page_number > 1 or page['next'] is not None:
+            text += f"\n📄 Страница {page_number}"
+
+        if message_id is None:
+            self.send_message(peer_id, text, keyboard)
+            return
+
+        self.edit_message(peer_id, message_id, text, keyboard or json.dumps({"inline": True, "buttons": []}))
+
+    def handle_list_page(self, event_id, user_id, peer_id, chat_id, message_id, payload):
+        """Листает постраничный список по нажатию inline-кнопки"""
+        handlers = {
+            'banlist': self.command_banlist,
+            'nicknames': self.command_nicknames,
+            'nonames': self.command_nonames,
+            'warnlist': self.command_warnlist,
+            'mutelist': self.command_mutelist,
+            'staff': self.command_staff,
+        }
+        list_name = payload.get('list')
+        handler = handlers.get(list_name)
+        answer = {'event_id': event_id, 'user_id': user_id, 'peer_id': peer_id}
+
+        if not handler or not chat_id or not message_id:
+            self.api_request('messages.sendMessageEventAnswer', answer)
+            return
+
+        if not self.check_command_permission(list_name, user_id, None, chat_id)['has_permission']:
+            self.api_request('messages.sendMessageEventAnswer', {
+                **answer,
+                'event_data': json.dumps({
+                    'type': 'show_snackbar',
+                    'text': '❌ Недостаточно прав для просмотра этого списка'
+                })
+            })
+            return
+
+        handler(peer_id, chat_id, cursor=payload.get('cursor'), backward=payload.get('dir') == 'prev',
+                page_number=max(1, int(payload.get('page', 1))), message_id=message_id)
+        self.api_request('messages.sendMessageEventAnswer', answer)
+
+    def get_kick_params(self, chat_id, user_id):
+        params = {'chat_id': chat_id}
+        if user_id > 0:
+            params['user_id'] = user_id
+        else:
+            params['member_id'] = user_id
+        return params
+
     def kick_user(self, chat_id, user_id, reason='Не указано'):
         try:
-            params = {'chat_id': chat_id}
-            if user_id > 0:
-                params['user_id'] = user_id
-            else:
-                params['member_id'] = user_id
-
-            response = self.api_request('messages.removeChatUser', params)
+            response = self.api_request('messages.removeChatUser', self.get_kick_params(chat_id, user_id))
             return response is not None
         except Exception as e:
             self.log(f"Ошибка кика пользователя: {e}")
             return False
 
+    def run_union_fanout(self, peer_id, title, chat_ids, make_call):
+        """Выполняет VK-вызов для каждого чата объединения в общем пуле и показывает прогресс.
+
+        make_call(chat_id) возвращает (method, params). Чаты идут пачками по 25: каждая пачка — один
+        execute, который поток пула отправляет сам, минуя общий батчер, так что одновременно в VK
+        уходит не больше fanout_workers пачек (и не чаще, чем пускает rate_limiter). Сообщение о прогрессе
+        обновляется не чаще fanout_progress_interval секунд. Возвращает
+        ({chat_id: None при успехе или текст ошибки}, conversation_message_id сообщения о прогрессе)."""
+        total = len(chat_ids)
+        progress_id = self.send_message_with_id(peer_id, f'⏳ {title}: 0/{total}')
+        progress_interval = CONFIG.get('fanout_progress_interval', 2.0)
+        last_progress = time.monotonic()
+
+        size = VKExecuteBatcher.MAX_CALLS
+        chunks = [chat_ids[start:start + size] for start in range(0, total, size)]
+        futures = {
+            self.fanout_pool.submit(self.api_execute_results, [make_call(chat_id) for chat_id in chunk]): chunk
+            for chunk in chunks
+        }
+
+        results = {}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                chunk_results = future.result()
+            except Exception as e:
+                chunk_results = [{'status': 'dropped', 'error': {'error_msg': str(e)}}] * len(chunk)
+
+            for chat_id, result in zip(chunk, chunk_results):
+                results[chat_id] = None if result['status'] != 'dropped' else result['error'].get('error_msg') or 'ошибка'
+
+            now = time.monotonic()
+            if progress_id and len(results) < total and now - last_progress >= progress_interval:
+                self.edit_message(peer_id, progress_id, f'⏳ {title}: {len(results)}/{total}')
+                last_progress = now
+
+        failed = {chat_id: error for chat_id, error in results.items() if error}
+        if failed:
+            self.log(f"{title}: ошибки в {len(failed)}/{total} чатах: {failed}")
+        return results, progress_id
+
+    def format_fanout_failures(self, results, limit=10):
+        """Список чатов, где действие не выполнено, с текстом ошибки VK"""
+        failed = [(chat_id, error) for chat_id, error in results.items() if error]
+        if not failed:
+            return ''
+        text = '\n⚠️ Не выполнено:\n'
+        for chat_id, error in failed[:limit]:
+            text += f'— чат {chat_id}: {error}\n'
+        if len(failed) > limit:
+            text += f'... и еще {len(failed) - limit}\n'
+        return text
+
+    def finish_fanout(self, peer_id, progress_id, text):
+        """Заменяет сообщение о прогрессе итогом или отправляет итог отдельно"""
+        if not progress_id or not self.edit_message(peer_id, progress_id, text):
+            self.send_message(peer_id, text)
+
     # Команды бота
     def command_help(self, peer_id):
         help_text = """♛ ROLEX 2.0 — удобный админ-бот для модерации.
@@ -2044,6 +5253,8 @@ def initialize_developer(self):
         if access_level >= 5:
             help_text += """💻 КОМАНДЫ РАЗРАБОТЧИКА БОТА (5)
 • /giveowner [@user] — выдать права основателя бота
+• /perf [сброс | профиль вкл | профиль выкл] — задержки по стадиям и командам
+• /reload — перечитать config.json без перезапуска
 
 """
 
@@ -2134,26 +5345,19 @@ def initialize_developer(self):
             if chat_info and chat_info.get('items'):
                 chat_title = chat_info['items'][0].get('chat_settings', {}).get('title', 'Неизвестная беседа')
 
-            # Получаем информацию о участниках беседы
-            conversation_info = self.api_request('messages.getConversationMembers', {
-                'peer_id': peer_id
-            })
+            # Получаем информацию о участниках беседы (при регистрации всегда свежую)
+            roster = self.get_conversation_members(chat_id, refresh=True)
 
-            # Определяем владельца
+            # Определяем владельца (только пользователи, не группы)
             owner_id = user_id if admin_rights['is_owner'] else None
-            if not owner_id and conversation_info and 'items' in conversation_info:
-                # Ищем владельца среди участников (только пользователи, не группы)
-                for member in conversation_info['items']:
-                    member_id = member.get('member_id')
-                    if member.get('is_owner') and member_id and member_id > 0:
-                        owner_id = member_id
-                        break
+            if not owner_id and roster is not None:
+                owner_id = roster.owner_id()
 
             # Регистрируем беседу
             self.db.register_chat(chat_id, user_id, owner_id or user_id, chat_title)
 
             # Назначаем роли
-            self.assign_initial_roles(chat_id, conversation_info)
+            self.assign_initial_roles(chat_id, roster)
 
             # Генерируем случайный код чата (в стиле как на примере)
             import string
@@ -2274,51 +5478,38 @@ def initialize_developer(self):
     def check_user_admin_rights(self, user_id, chat_id):
         """Проверить права администратора пользователя в беседе через VK API"""
         try:
-            # Получаем информацию о беседе и участниках
-            conversation_info = self.api_request('messages.getConversationMembers', {
-                'peer_id': 2000000000 + chat_id
-            })
+            # Получаем состав беседы с флагами администраторов
+            roster = self.get_conversation_members(chat_id)
 
-            if not conversation_info or 'items' not in conversation_info:
+            if roster is None:
                 return {'is_admin': False, 'is_owner': False}
 
-            # Ищем пользователя среди участников
-            for member in conversation_info['items']:
-                if member.get('member_id') == user_id:
-                    is_owner = member.get('is_owner', False)
-                    is_admin = member.get('is_admin', False)
-
-                    return {
-                        'is_admin': is_admin or is_owner,
-                        'is_owner': is_owner
-                    }
-
-            return {'is_admin': False, 'is_owner': False}
+            return {
+                'is_admin': roster.is_admin(user_id),
+                'is_owner': roster.is_owner(user_id)
+            }
 
         except Exception as e:
             self.log(f"Ошибка проверки прав администратора: {e}")
             return {'is_admin': False, 'is_owner': False}
 
-    def assign_initial_roles(self, chat_id, conversation_info):
+    def assign_initial_roles(self, chat_id, roster):
         """Назначить начальные роли владельцу и администраторам при регистрации беседы"""
         try:
-            if not conversation_info or 'items' not in conversation_info:
+            if roster is None:
                 self.log(f"Не удалось получить информацию об участниках беседы {chat_id}")
                 return
 
-            for member in conversation_info['items']:
-                member_id = member.get('member_id')
-                if not member_id or member_id < 0:  # Пропускаем группы/сообщества (отрицательные ID)
-                    continue
-
+            # Группы/сообщества (отрицательные ID) в admins() не попадают
+            for member_id, is_owner in roster.admins():
                 # Назначаем роль владельцу
-                if member.get('is_owner'):
+                if is_owner:
                     owner_role_name = self.get_role_name_for_level(100, chat_id)
                     self.db.set_chat_role(member_id, chat_id, 100, owner_role_name, member_id)
                     self.log(f"Назначена роль '{owner_role_name}' пользователю {member_id} в беседе {chat_id}")
 
                 # Назначаем роль администраторам
-                elif member.get('is_admin'):
+                else:
                     admin_role_name = self.get_role_name_for_level(80, chat_id)
                     self.db.set_chat_role(member_id, chat_id, 80, admin_role_name, member_id)
                     self.log(f"Назначена роль '{admin_role_name}' пользователю {member_id} в беседе {chat_id}")
@@ -2338,25 +5529,21 @@ def initialize_developer(self):
 
         try:
             # Получаем список участников беседы
-            conversation_info = self.api_request('messages.getConversationMembers', {
-                'peer_id': 2000000000 + chat_id
-            })
+            roster = self.get_conversation_members(chat_id)
 
-            if not conversation_info or 'items' not in conversation_info:
+            if roster is None:
                 self.send_message(peer_id, '❌ Не удалось получить список участников беседы.')
                 return
 
-            # Фильтруем только реальных пользователей (не группы)
-            members = [m for m in conversation_info['items'] if m.get('member_id', 0) > 0]
+            # Только реальные пользователи (не группы)
+            members = roster.user_ids()
 
             if not members:
                 self.send_message(peer_id, '❌ В беседе нет участников.')
                 return
 
             # Выбираем случайного участника
-            import random
-            random_member = random.choice(members)
-            member_id = random_member['member_id']
+            member_id = random.choice(members)
 
             # Получаем информацию о пользователе
             user_info = self.get_user_info(member_id)
@@ -2964,42 +6151,6 @@ def initialize_developer(self):
             self.log(f"Ошибка разбана пользователя: {e}")
             self.send_message(peer_id, '❌ Ошибка при разблокировке пользователя.')
 
-    def start_mute_checker(self):
-        """Запустить периодическую проверку истекших мутов"""
-        def check_expired_mutes():
-            try:
-                expired_mutes = self.db.get_expired_mutes()
-                for mute in expired_mutes:
-                    # Снимаем мут
-                    self.db.remove_mute(mute['id'])
-
-                    # Отправляем уведомление в чат
-                    chat_id = mute['chat_id']
-                    user_id = mute['user_id']
-                    peer_id = 2000000000 + chat_id
-
-                    # Получаем информацию о пользователе
-                    user_info = self.get_user_info(user_id)
-                    user_name = user_info['screen_name'] if user_info else str(user_id)
-
-                    message = f"⚠️ У @{user_name}(Пользователя) закончилась блокировка чата."
-                    self.send_message(peer_id, message)
-                    self.log(f"Автоматически снят мут с пользователя {user_id} в чате {chat_id}")
-
-            except Exception as e:
-                self.log(f"Ошибка при проверке истекших мутов: {e}")
-
-            # Запускаем следующую проверку через 60 секунд
-            self.mute_check_timer = threading.Timer(60.0, check_expired_mutes)
-            self.mute_check_timer.daemon = True
-            self.mute_check_timer.start()
-
-        # Первая проверка через 10 секунд после запуска
-        self.mute_check_timer = threading.Timer(10.0, check_expired_mutes)
-        self.mute_check_timer.daemon = True
-        self.mute_check_timer.start()
-        self.log("Система автоматической проверки мутов запущена")
-
     def command_balance(self, peer_id, user_id):
         try:
             user_balance = self.db.get_user_balance(user_id)
@@ -3159,6 +6310,7 @@ def initialize_developer(self):
                     self.send_message(peer_id, f'✅ Роль "{role_name}" с приоритетом [{role_level}] успешно создана!')
 
             self.db.conn.commit()
+            self.db.invalidate_chat_permissions(chat_id)
 
         except Exception as e:
             self.log(f"Ошибка создания кастомной роли: {e}")
@@ -3197,11 +6349,11 @@ def initialize_developer(self):
                 if nickname:
                     nickname_text = nickname
 
-                # Количество сообщений
+                # Количество сообщений (с учетом еще не записанных в БД)
+                message_count = self.db.get_message_count(target_id)
                 user = self.db.get_user(target_id)
                 if user:
                     user_dict = dict(user)
-                    message_count = user_dict.get('message_count', 0)
 
                     # Дата приглашения
                     if user_dict.get('created_at'):
@@ -3232,18 +6384,19 @@ def initialize_developer(self):
 
     def command_online(self, peer_id, chat_id):
         try:
-            response = self.api_request('messages.getConversationMembers', {
-                'peer_id': peer_id
-            })
+            roster = self.get_conversation_members(chat_id, online=True)
 
-            if not response:
+            if roster is None:
                 self.send_message(peer_id, '❌ Ошибка получения участников чата.')
                 return
 
+            # Профили уже в кэше: fetch_conversation_members положил их туда вместе с составом
+            online_ids = roster.online_ids()
+            user_infos = self.get_users_info(online_ids)
             online_users = []
-            for profile in response.get('profiles', []):
-                if profile.get('online'):
-                    online_users.append(f"@{profile.get('screen_name', profile['id'])}")
+            for member_id in online_ids:
+                user_info = user_infos.get(str(member_id))
+                online_users.append(f"@{user_info.get('screen_name', member_id) if user_info else member_id}")
 
             online_text = f"""🟢 Пользователи онлайн: {len(online_users)}
 
@@ -3253,52 +6406,47 @@ def initialize_developer(self):
             self.log(f"Ошибка получения онлайн: {e}")
             self.send_message(peer_id, '❌ Ошибка получения списка онлайн.')
 
-    def command_staff(self, peer_id, chat_id):
+    def command_staff(self, peer_id, chat_id, cursor=None, backward=False, page_number=1, message_id=None):
         try:
             staff_text = "☕️ Список Администрации:\n\n"
 
-            if chat_id:
-                chat_roles = self.db.get_all_chat_roles(chat_id)
-                role_groups = {}
-
-                for role in chat_roles:
-                    if role['role_level'] >= 10 and role['user_id'] > 0:  # Показываем только пользователей, не группы
-                        role_name = role['role_name']
-                        if role_name not in role_groups:
-                            role_groups[role_name] = []
-
-                        user_info = self.get_user_info(role['user_id'])
-                        username = user_info['screen_name'] if user_info else str(role['user_id'])
-
-                        # Получаем полное имя пользователя
-                        full_name = f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}".strip() if user_info else username
-
-                        role_groups[role_name].append({
-                            'user_id': role['user_id'],
-                            'username': username,
-                            'full_name': full_name,
-                            'level': role['role_level']
-                        })
+            if not chat_id:
+                staff_text += "❌ Команда доступна только в групповых чатах\n"
+                self.send_message(peer_id, staff_text)
+                return
 
-                # Сортируем роли по уровню
-                sorted_roles = sorted(role_groups.items(), key=lambda x: max(r['level'] for r in x[1]), reverse=True)
+            # Страница уже отсортирована по уровню роли, пользователи без групп
+            page = self.db.get_chat_staff_page(chat_id, cursor, backward, self.list_page_size)
+            user_infos = self.get_users_info([role['user_id'] for role in page['items']])
+            role_groups = {}
 
-                for role_name, members in sorted_roles:
-                    staff_text += f"{role_name}:\n"
-                    for member in members:
-                        # Используем формат [id|Имя] если есть полное имя, иначе @username
-                        if member['full_name'] and member['full_name'] != member['username']:
-                            staff_text += f"— [id{member['user_id']}|{member['full_name']}]\n"
-                        else:
-                            staff_text += f"— @{member['username']}\n"
-                    staff_text += "\n"
+            for role in page['items']:
+                user_info = user_infos.get(str(role['user_id']))
+                username = user_info['screen_name'] if user_info else str(role['user_id'])
 
-                if not role_groups:
-                    staff_text += "❌ Нет администрации в этом чате\n"
-            else:
-                staff_text += "❌ Команда доступна только в групповых чатах\n"
+                # Получаем полное имя пользователя
+                full_name = f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}".strip() if user_info else username
+
+                role_groups.setdefault(role['role_name'], []).append({
+                    'user_id': role['user_id'],
+                    'username': username,
+                    'full_name': full_name
+                })
+
+            for role_name, members in role_groups.items():
+                staff_text += f"{role_name}:\n"
+                for member in members:
+                    # Используем формат [id|Имя] если есть полное имя, иначе @username
+                    if member['full_name'] and member['full_name'] != member['username']:
+                        staff_text += f"— [id{member['user_id']}|{member['full_name']}]\n"
+                    else:
+                        staff_text += f"— @{member['username']}\n"
+                staff_text += "\n"
+
+            if not role_groups:
+                staff_text += "❌ Нет администрации в этом чате\n"
 
-            self.send_message(peer_id, staff_text)
+            self.send_list_page(peer_id, 'staff', staff_text, page, page_number, message_id)
         except Exception as e:
             self.log(f"Ошибка получения администрации: {e}")
             self.send_message(peer_id, '❌ Ошибка получения списка администрации.')
@@ -3476,15 +6624,18 @@ def initialize_developer(self):
             self.log(f"Ошибка снятия иммунитета: {e}")
             self.send_message(peer_id, '❌ Ошибка при снятии иммунитета.')
 
-    def command_banlist(self, peer_id, chat_id):
+    def command_banlist(self, peer_id, chat_id, cursor=None, backward=False, page_number=1, message_id=None):
         try:
-            bans = self.db.get_all_active_chat_bans(chat_id)
+            page = self.db.get_chat_bans_page(chat_id, cursor, backward, self.list_page_size)
+            bans = page['items']
 
             banlist_text = "✄ Список заблокированных пользователей:\n\n"
 
             if bans:
-                for i, ban in enumerate(bans, 1):
-                    user_info = self.get_user_info(ban['user_id'])
+                user_infos = self.get_users_info([ban['user_id'] for ban in bans])
+                first = (page_number - 1) * self.list_page_size + 1
+                for i, ban in enumerate(bans, first):
+                    user_info = user_infos.get(str(ban['user_id']))
                     if user_info:
                         full_name = f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}".strip()
                         if not full_name:
@@ -3496,7 +6647,7 @@ def initialize_developer(self):
             else:
                 banlist_text += "✅ Нет заблокированных пользователей.\n"
 
-            self.send_message(peer_id, banlist_text)
+            self.send_list_page(peer_id, 'banlist', banlist_text, page, page_number, message_id)
         except Exception as e:
             self.log(f"Ошибка получения списка банов: {e}")
             self.send_message(peer_id, '❌ Ошибка получения списка заблокированных.')
@@ -3707,11 +6858,12 @@ def initialize_developer(self):
             self.log(f"Ошибка получения истории: {e}")
             self.send_message(peer_id, '❌ Ошибка получения истории предупреждений.')
 
-    def command_warnlist(self, peer_id, chat_id):
+    def command_warnlist(self, peer_id, chat_id, cursor=None, backward=False, page_number=1, message_id=None):
         try:
-            users_with_warnings = self.db.get_users_with_warnings(chat_id)
+            page = self.db.get_warned_users_page(chat_id, cursor, backward, self.list_page_size)
+            users_with_warnings = page['items']
 
-            if not users_with_warnings:
+            if not users_with_warnings and message_id is None:
                 self.send_message(peer_id, '✅ Нет пользователей с предупреждениями')
                 return
 
@@ -3722,18 +6874,17 @@ def initialize_developer(self):
                 warning_count = user_data['warning_count']
                 warnlist_text += f"[id{user_id}|@id{user_id}] — {warning_count}/3\n"
 
-            warnlist_text += f"\nВсего пользователей с предупреждениями: {len(users_with_warnings)}"
-
-            self.send_message(peer_id, warnlist_text)
+            self.send_list_page(peer_id, 'warnlist', warnlist_text, page, page_number, message_id)
         except Exception as e:
             self.log(f"Ошибка получения списка предупреждений: {e}")
             self.send_message(peer_id, '❌ Ошибка получения списка предупреждений.')
 
-    def command_mutelist(self, peer_id, chat_id):
+    def command_mutelist(self, peer_id, chat_id, cursor=None, backward=False, page_number=1, message_id=None):
         try:
-            users_with_mutes = self.db.get_users_with_active_mutes(chat_id)
+            page = self.db.get_muted_users_page(chat_id, cursor, backward, self.list_page_size)
+            users_with_mutes = page['items']
 
-            if not users_with_mutes:
+            if not users_with_mutes and message_id is None:
                 self.send_message(peer_id, '✅ Нет пользователей с блокировкой чата')
                 return
 
@@ -3760,9 +6911,7 @@ def initialize_developer(self):
                 mutelist_text += f"└ До: {mute_until_formatted}\n"
                 mutelist_text += f"└ Причина: {reason}\n\n"
 
-            mutelist_text += f"Всего пользователей в муте: {len(users_with_mutes)}"
-
-            self.send_message(peer_id, mutelist_text)
+            self.send_list_page(peer_id, 'mutelist', mutelist_text, page, page_number, message_id)
         except Exception as e:
             self.log(f"Ошибка получения списка мутов: {e}")
             self.send_message(peer_id, '❌ Ошибка получения списка мутов.')
@@ -3871,24 +7020,27 @@ def initialize_developer(self):
             self.log(f"Ошибка удаления никнейма: {e}")
             self.send_message(peer_id, '❌ Ошибка удаления никнейма.')
 
-    def command_nicknames(self, peer_id, chat_id):
+    def command_nicknames(self, peer_id, chat_id, cursor=None, backward=False, page_number=1, message_id=None):
         try:
             if not chat_id:
                 self.send_message(peer_id, '❌ Команда доступна только в групповых чатах.')
                 return
 
-            # Получаем всех пользователей с никнеймами в этом чате
-            chat_users_with_nicks = self.db.get_all_users_with_nicknames(chat_id)
+            # Получаем страницу пользователей с никнеймами в этом чате
+            page = self.db.get_chat_nicknames_page(chat_id, cursor, backward, self.list_page_size)
+            chat_users_with_nicks = page['items']
 
-            if not chat_users_with_nicks:
+            if not chat_users_with_nicks and message_id is None:
                 nicknames_text = "✄ Список пользователей с никнеймами:\n\n пользователей"
                 self.send_message(peer_id, nicknames_text)
                 return
 
             nicknames_text = "✄ Список пользователей с никнеймами:\n\n"
+            user_infos = self.get_users_info([user['user_id'] for user in chat_users_with_nicks])
+            first = (page_number - 1) * self.list_page_size + 1
 
-            for index, user in enumerate(chat_users_with_nicks, 1):
-                user_info = self.get_user_info(user['user_id'])
+            for index, user in enumerate(chat_users_with_nicks, first):
+                user_info = user_infos.get(str(user['user_id']))
 
                 # Получаем полное имя пользователя
                 if user_info:
@@ -3901,31 +7053,33 @@ def initialize_developer(self):
                 # Форматируем строку с номером, именем и никнеймом
                 nicknames_text += f"{index}. [id{user['user_id']}|{full_name}] - {user['nickname']}\n"
 
-            self.send_message(peer_id, nicknames_text)
+            self.send_list_page(peer_id, 'nicknames', nicknames_text, page, page_number, message_id)
         except Exception as e:
             self.log(f"Ошибка получения списка никнеймов: {e}")
             self.send_message(peer_id, '❌ Ошибка получения списка никнеймов.')
 
-    def command_nonames(self, peer_id, chat_id):
+    def command_nonames(self, peer_id, chat_id, cursor=None, backward=False, page_number=1, message_id=None):
         try:
             if not chat_id:
                 self.send_message(peer_id, '❌ Команда доступна только в групповых чатах.')
                 return
 
-            # Получаем всех пользователей без никнеймов в этом чате
-            chat_users_without_nicks = self.db.get_all_users_without_nicknames(chat_id)
+            # Получаем страницу пользователей без никнеймов в этом чате
+            page = self.db.get_users_without_nicknames_page(chat_id, cursor, backward, self.list_page_size)
+            chat_users_without_nicks = page['items']
 
             nonames_text = f"""Пользователи без ников:
 
 """
-            for user in chat_users_without_nicks[:20]:
-                user_info = self.get_user_info(user['user_id'])
+            user_infos = self.get_users_info([user['user_id'] for user in chat_users_without_nicks])
+            for user in chat_users_without_nicks:
+                user_info = user_infos.get(str(user['user_id']))
                 username = user_info['screen_name'] if user_info else str(user['user_id'])
                 nonames_text += f"🔸 @{username}\n"
 
             if not chat_users_without_nicks:
                 nonames_text += "✅ Все пользователи этого чата имеют никнеймы\n"
-            self.send_message(peer_id, nonames_text)
+            self.send_list_page(peer_id, 'nonames', nonames_text, page, page_number, message_id)
         except Exception as e:
             self.log(f"Ошибка получения списка без никнеймов: {e}")
             self.send_message(peer_id, '❌ Ошибка получения списка пользователей без никнеймов.')
@@ -3984,54 +7138,164 @@ def initialize_developer(self):
             chat_ids = cursor.fetchall()
 
             broadcast_message = f"📢 РАССЫЛКА\n\n{message_text}"
-            sent_count = 0
-            error_count = 0
-
-            # Отправляем в групповые чаты
-            for chat_row in chat_ids:
-                chat_id = chat_row['chat_id']
-                peer_id_to_send = chat_id + 2000000000
-                try:
-                    self.send_message(peer_id_to_send, broadcast_message)
-                    sent_count += 1
-                except Exception as e:
-                    error_count += 1
-                    self.log(f"Ошибка отправки в чат {chat_id}: {e}")
 
-            # Отправляем в ЛС бота (используем ID создателя)
-            try:
-                self.send_message(sender_id, broadcast_message)
-                sent_count += 1
-            except Exception as e:
-                error_count += 1
-                self.log(f"Ошибка отправки в ЛС: {e}")
+            # Групповые чаты и ЛС создателя; каждый получатель получает строку в журнале доставки
+            peer_ids = [chat_row['chat_id'] + 2000000000 for chat_row in chat_ids]
+            peer_ids.append(sender_id)
+            job_id = self.db.create_broadcast_job(sender_id, peer_id, broadcast_message, peer_ids)
 
-            result_message = f"✅ Рассылка завершена!\n📤 Отправлено: {sent_count}\n❌ Ошибок: {error_count}"
-            self.send_message(peer_id, result_message)
+            self.scheduler.schedule(f"broadcast:{job_id}", 0, self.broadcast_step, job_id, persist=True)
+            self.send_message(peer_id, f"📢 Рассылка №{job_id} запущена: {len(set(peer_ids))} получателей.\n"
+                                       f"📊 Статус: /bstatus {job_id}")
+            self.log(f"Рассылка №{job_id} запущена на {len(set(peer_ids))} получателей")
 
         except Exception as e:
             self.log(f"Ошибка рассылки: {e}")
             self.send_message(peer_id, '❌ Ошибка при выполнении рассылки.')
 
+    def format_duration(self, seconds):
+        seconds = int(max(seconds, 0))
+        hours, minutes = seconds // 3600, (seconds % 3600) // 60
+        if hours:
+            return f"{hours}ч {minutes}м {seconds % 60}с"
+        return f"{minutes}м {seconds % 60}с"
+
+    def get_broadcast_random_id(self, job_id, peer_id):
+        """Постоянный random_id для пары (рассылка, получатель): VK отбросит повтор после перезапуска"""
+        return (job_id * 1000003 + peer_id) % 2147483647 or 1
+
+    def broadcast_step(self, job_id):
+        """Отправляет очередную пачку рассылки и планирует следующую.
+
+        Пачка — до broadcast_batch_size получателей, уходит через execute-батчер параллельно;
+        шаги идут не быстрее broadcast_rate сообщений в секунду. Временные ошибки VK (и ошибки
+        сети) повторяются с растущей паузой до broadcast_max_attempts раз."""
+        job = self.db.get_broadcast_job(job_id)
+        if not job or job['status'] != 'running':
+            return
+
+        batch_size = CONFIG.get('broadcast_batch_size', 100)
+        rate = CONFIG.get('broadcast_rate', 20)
+        max_attempts = CONFIG.get('broadcast_max_attempts', 3)
+        retry_delay = CONFIG.get('broadcast_retry_delay', 30)
+        started = time.time()
+
+        due = self.db.get_due_broadcast_peers(job_id, started, batch_size)
+        if due:
+            calls = [('messages.send', {
+                'peer_id': row['peer_id'],
+                'message': job['message'],
+                'random_id': self.get_broadcast_random_id(job_id, row['peer_id'])
+            }) for row in due]
+            results = self.api_request_many_results(calls)
+
+            delivered, retries, failed = [], [], []
+            for row, result in zip(due, results):
+                if result['status'] != 'dropped':
+                    delivered.append(row['peer_id'])
+                    continue
+                error = result['error'] or {}
+                error_text = f"{error.get('error_code')}: {error.get('error_msg')}"
+                attempt = row['attempts'] + 1
+                transient = error.get('error_code') in VK_RETRY_ERROR_CODES or error.get('error_code') is None
+                if transient and attempt < max_attempts:
+                    retries.append((row['peer_id'], error_text, started + retry_delay * attempt))
+                else:
+                    failed.append((row['peer_id'], error_text))
+            self.db.record_broadcast_results(job_id, delivered, retries, failed)
+
+        next_due = self.db.get_next_broadcast_retry(job_id)
+        if next_due is None:
+            if self.db.finish_broadcast_job(job_id):
+                self.notify_broadcast_finished(job_id)
+            return
+
+        # Темп рассылки: пачка из n сообщений занимает не меньше n / rate секунд
+        pace = len(due) / rate if rate else 0
+        delay = max(pace - (time.time() - started), next_due - time.time(), 0)
+        self.scheduler.schedule(f"broadcast:{job_id}", delay, self.broadcast_step, job_id, persist=True)
+
+    def notify_broadcast_finished(self, job_id):
+        job = self.db.get_broadcast_job(job_id)
+        stats = self.db.get_broadcast_stats(job_id)
+        elapsed = (job['finished_at'] or time.time()) - (job['started_at'] or job['finished_at'])
+        self.log(f"Рассылка №{job_id} завершена: доставлено {stats['sent']}, ошибок {stats['failed']}")
+        if job['reply_peer_id']:
+            self.send_message(job['reply_peer_id'], f"✅ Рассылка №{job_id} завершена!\n"
+                                                    f"📤 Отправлено: {stats['sent']}\n"
+                                                    f"❌ Ошибок: {stats['failed']}\n"
+                                                    f"⏱ Время: {self.format_duration(elapsed)}")
+
+    def resume_broadcasts(self):
+        """Продолжает рассылки, прерванные перезапуском: журнал хранит, кому уже отправлено"""
+        try:
+            for job in self.db.get_running_broadcast_jobs():
+                self.scheduler.schedule(f"broadcast:{job['id']}", 0, self.broadcast_step, job['id'], persist=True)
+                self.log(f"Рассылка №{job['id']} возобновлена после перезапуска")
+        except Exception as e:
+            self.log(f"Ошибка возобновления рассылок: {e}")
+
+    def command_broadcast_status(self, peer_id, sender_id, args):
+        """Статус рассылки: прогресс, скорость и оценка времени; 'отмена' останавливает ее"""
+        sender_info = self.get_user_info(sender_id)
+        sender_name = sender_info['screen_name'] if sender_info else str(sender_id)
+
+        if sender_name != CONFIG['grand_manager']:
+            self.send_message(peer_id, '❌ Только создатель может управлять рассылкой!')
+            return
+
+        try:
+            job_arg = next((arg for arg in args if arg.isdigit()), None)
+            job = self.db.get_broadcast_job(int(job_arg)) if job_arg else self.db.get_latest_broadcast_job()
+            if not job:
+                self.send_message(peer_id, '❌ Рассылка не найдена.')
+                return
+
+            job_id = job['id']
+            if any(arg.lower() in ('отмена', 'стоп', 'cancel') for arg in args):
+                if self.db.finish_broadcast_job(job_id, 'cancelled'):
+                    self.scheduler.cancel(f"broadcast:{job_id}")
+                    self.send_message(peer_id, f'🛑 Рассылка №{job_id} остановлена.')
+                else:
+                    self.send_message(peer_id, f'❌ Рассылка №{job_id} уже не выполняется.')
+                return
+
+            stats = self.db.get_broadcast_stats(job_id)
+            done = stats['sent'] + stats['failed']
+            elapsed = (job['finished_at'] or time.time()) - (job['started_at'] or time.time())
+            throughput = done / elapsed if elapsed > 0 else 0
+            statuses = {'running': '⏳ выполняется', 'finished': '✅ завершена', 'cancelled': '🛑 остановлена'}
+
+            status_text = f"📢 Рассылка №{job_id}: {statuses.get(job['status'], job['status'])}\n\n"
+            status_text += f"📊 Обработано: {done}/{job['total']}\n"
+            status_text += f"📤 Доставлено: {stats['sent']}\n"
+            status_text += f"❌ Ошибок: {stats['failed']}\n"
+            status_text += f"🔄 В очереди: {stats['pending']}\n"
+            status_text += f"⚡ Скорость: {throughput:.1f} сообщ./с\n"
+            if job['status'] == 'running' and throughput > 0:
+                status_text += f"⏱ Осталось примерно: {self.format_duration(stats['pending'] / throughput)}\n"
+            else:
+                status_text += f"⏱ Прошло: {self.format_duration(elapsed)}\n"
+
+            self.send_message(peer_id, status_text)
+        except Exception as e:
+            self.log(f"Ошибка получения статуса рассылки: {e}")
+            self.send_message(peer_id, '❌ Ошибка получения статуса рассылки.')
+
     def command_chatinfo(self, peer_id, chat_id):
         try:
-            response = self.api_request('messages.getConversationMembers', {
-                'peer_id': peer_id
-            })
+            roster = self.get_conversation_members(chat_id, online=True)
 
-            if not response:
+            if roster is None:
                 self.send_message(peer_id, '❌ Ошибка получения информации о чате.')
                 return
 
-            total_members = response.get('count', 0)
-            online_count = 0
-
-            for profile in response.get('profiles', []):
-                if profile.get('online'):
-                    online_count += 1
+            total_members = roster.count
+            online_count = roster.online_count()
 
-            chat_roles = self.db.get_all_chat_roles(chat_id) if chat_id else []
-            admin_count = len([r for r in chat_roles if r['role_level'] >= 20])
+            # Администрация — участники беседы с ролью от 20: соединяем состав с ролями из снимка прав
+            roles = self.db.get_chat_permissions(chat_id)['roles']
+            admin_count = roles.count_at_least(20, roster.member_ids)
 
             chatinfo_text = f"""ℹ️ Информация о чате:
 
@@ -4110,6 +7374,7 @@ Peer ID: {peer_id}"""
             ''', (chat_id or 0, command, level, sender_id))
 
             self.db.conn.commit()
+            self.db.invalidate_chat_permissions(chat_id)
 
             self.send_message(peer_id, f'✅ Для команды /{command} установлен приоритет {level}')
             self.log(f"Команда /{command} теперь требует уровень {level}")
@@ -4368,6 +7633,7 @@ Peer ID: {peer_id}"""
                 return
 
             self.db.conn.commit()
+            self.db.invalidate_chat_permissions(chat_id)
             self.log(f"Выполнена очистка {wipe_type} в чате {chat_id}")
 
         except Exception as e:
@@ -4430,8 +7696,6 @@ Peer ID: {peer_id}"""
 
     def command_piar(self, peer_id, sender_id, text, interval_minutes, chat_id):
         """Запустить периодическую рассылку сообщения в чате"""
-        global PIAR_TIMERS
-
         if not self.has_permission(sender_id, None, 100, chat_id):
             self.send_message(peer_id, '❌ Только создатель может использовать команду /piar.')
             return
@@ -4440,11 +7704,8 @@ Peer ID: {peer_id}"""
             self.send_message(peer_id, '❌ Команда доступна только в групповых чатах.')
             return
 
-        # Проверяем, есть ли уже активная рассылка
-        timer_key = str(chat_id)
-        if timer_key in PIAR_TIMERS:
-            PIAR_TIMERS[timer_key].cancel()
-            del PIAR_TIMERS[timer_key]
+        # Останавливаем уже активную рассылку
+        self.scheduler.cancel(f"piar:{chat_id}")
 
         if not text or not text.strip():
             # Остановка рассылки
@@ -4460,32 +7721,20 @@ Peer ID: {peer_id}"""
             self.send_message(peer_id, '❌ Максимальный интервал рассылки: 1440 минут (24 часа).')
             return
 
-        # Запускаем периодическую рассылку
+        # Запускаем периодическую рассылку (сохраняется в БД и переживает перезапуск)
         self.send_piar_message(peer_id, text, interval_minutes, chat_id)
+        interval_seconds = interval_minutes * 60
+        self.scheduler.schedule(f"piar:{chat_id}", interval_seconds, self.send_piar_message,
+                                peer_id, text, interval_minutes, chat_id,
+                                interval=interval_seconds, persist=True)
 
         self.send_message(peer_id, f'✅ Пиар-рассылка запущена!\n📝 Текст: {text}\n⏱ Интервал: {interval_minutes} минут\n\n💡 Для остановки используйте: /piar стоп')
         self.log(f"Пиар-рассылка запущена в чате {chat_id} с интервалом {interval_minutes} минут")
 
     def send_piar_message(self, peer_id, text, interval_minutes, chat_id):
-        """Отправляет пиар-сообщение и планирует следующую отправку"""
-        global PIAR_TIMERS
-
+        """Отправляет пиар-сообщение; повтор выполняет планировщик"""
         try:
-            # Отправляем сообщение
             self.send_message(peer_id, f"📢 {text}")
-
-            # Планируем следующую отправку
-            timer_key = str(chat_id)
-            interval_seconds = interval_minutes * 60
-
-            timer = threading.Timer(
-                interval_seconds,
-                self.send_piar_message,
-                args=[peer_id, text, interval_minutes, chat_id]
-            )
-            timer.start()
-            PIAR_TIMERS[timer_key] = timer
-
         except Exception as e:
             self.log(f"Ошибка отправки пиар-сообщения: {e}")
 
@@ -4673,42 +7922,30 @@ Peer ID: {peer_id}"""
 
         try:
             # Получаем объединение для текущего чата
-            cursor = self.db.conn.cursor()
-            cursor.execute('''
-                SELECT cu.id, cu.union_name 
-                FROM chat_unions cu
-                JOIN union_chats uc ON cu.id = uc.union_id
-                WHERE uc.chat_id = ?
-            ''', (chat_id,))
-            union = cursor.fetchone()
+            union = self.db.get_chat_union(chat_id)
 
             if not union:
                 self.send_message(peer_id, '❌ Этот чат не входит в объединение.')
                 return
 
             # Получаем все чаты в объединении
-            cursor.execute('''
-                SELECT chat_id FROM union_chats WHERE union_id = ?
-            ''', (union['id'],))
-            union_chats = cursor.fetchall()
+            union_chats = self.db.get_union_chat_ids(union['id'])
 
             target_info = self.get_user_info(target_id)
             target_name = target_info['screen_name'] if target_info else str(target_id)
 
-            success_count = 0
-            for chat in union_chats:
-                try:
-                    chat_peer_id = chat['chat_id'] + 2000000000
-                    if self.kick_user(chat['chat_id'], target_id, reason):
-                        success_count += 1
-                except Exception as e:
-                    self.log(f"Ошибка кика из чата {chat['chat_id']}: {e}")
+            kick_results, progress_id = self.run_union_fanout(
+                peer_id, f'Глобальный кик @{target_name}', union_chats,
+                lambda union_chat_id: ('messages.removeChatUser', self.get_kick_params(union_chat_id, target_id))
+            )
+            success_count = sum(1 for error in kick_results.values() if not error)
 
             result_text = f'✅ Глобальный кик @{target_name} выполнен!\n'
             result_text += f'📊 Исключен из {success_count}/{len(union_chats)} конференций объединения "{union["union_name"]}".\n'
             result_text += f'📝 Причина: {reason}'
+            result_text += self.format_fanout_failures(kick_results)
 
-            self.send_message(peer_id, result_text)
+            self.finish_fanout(peer_id, progress_id, result_text)
             self.log(f"Глобальный кик пользователя {target_name} из {success_count} чатов. Причина: {reason}")
 
         except Exception as e:
@@ -4764,8 +8001,31 @@ Peer ID: {peer_id}"""
     def command_gzov(self, peer_id, sender_id, message_text, chat_id):
         """Упомянуть всех пользователей во всех конференциях объединения"""
         try:
-            self.send_message(peer_id, f'📢 Глобальный зов выполняется...\n{message_text if message_text else ""}')
-            self.log(f"Глобальный зов выполнен в чате {chat_id}")
+            union = self.db.get_chat_union(chat_id)
+
+            if not union:
+                self.send_message(peer_id, '❌ Этот чат не входит в объединение.')
+                return
+
+            union_chats = self.db.get_union_chat_ids(union['id'])
+            zov_text = f"📢 Вызов!\n\n{message_text if message_text else 'Важное объявление!'}\n\n@all"
+
+            zov_results, progress_id = self.run_union_fanout(
+                peer_id, 'Глобальный зов', union_chats,
+                lambda union_chat_id: ('messages.send', {
+                    'peer_id': 2000000000 + union_chat_id,
+                    'message': zov_text,
+                    'random_id': random.randint(1, 2147483647)
+                })
+            )
+            success_count = sum(1 for error in zov_results.values() if not error)
+
+            result_text = f'📢 Глобальный зов выполнен!\n'
+            result_text += f'📊 Отправлен в {success_count}/{len(union_chats)} конференций объединения "{union["union_name"]}".'
+            result_text += self.format_fanout_failures(zov_results)
+
+            self.finish_fanout(peer_id, progress_id, result_text)
+            self.log(f"Глобальный зов из чата {chat_id} отправлен в {success_count} чатов")
 
         except Exception as e:
             self.log(f"Ошибка глобального зова: {e}")
@@ -4791,44 +8051,34 @@ Peer ID: {peer_id}"""
 
         try:
             # Получаем объединение для текущего чата
-            cursor = self.db.conn.cursor()
-            cursor.execute('''
-                SELECT cu.id, cu.union_name 
-                FROM chat_unions cu
-                JOIN union_chats uc ON cu.id = uc.union_id
-                WHERE uc.chat_id = ?
-            ''', (chat_id,))
-            union = cursor.fetchone()
+            union = self.db.get_chat_union(chat_id)
 
             if not union:
                 self.send_message(peer_id, '❌ Этот чат не входит в объединение.')
                 return
 
             # Получаем все чаты в объединении
-            cursor.execute('''
-                SELECT chat_id FROM union_chats WHERE union_id = ?
-            ''', (union['id'],))
-            union_chats = cursor.fetchall()
+            union_chats = self.db.get_union_chat_ids(union['id'])
 
             target_info = self.get_user_info(target_id)
             target_name = target_info['screen_name'] if target_info else str(target_id)
 
-            success_count = 0
-            for chat in union_chats:
-                try:
-                    # Добавляем бан в каждый чат
-                    self.db.add_chat_ban(target_id, chat['chat_id'], reason, sender_id)
-                    # Кикаем из чата
-                    if self.kick_user(chat['chat_id'], target_id, reason):
-                        success_count += 1
-                except Exception as e:
-                    self.log(f"Ошибка бана в чате {chat['chat_id']}: {e}")
+            # Баны во всех чатах пишутся одной транзакцией, до обращений к VK
+            self.db.add_chat_bans(target_id, union_chats, reason, sender_id)
+
+            kick_results, progress_id = self.run_union_fanout(
+                peer_id, f'Глобальная блокировка @{target_name}', union_chats,
+                lambda union_chat_id: ('messages.removeChatUser', self.get_kick_params(union_chat_id, target_id))
+            )
+            success_count = sum(1 for error in kick_results.values() if not error)
 
             result_text = f'🚫 Глобальная блокировка @{target_name} выполнена!\n'
-            result_text += f'📊 Заблокирован в {success_count}/{len(union_chats)} конференциях объединения "{union["union_name"]}".\n'
+            result_text += f'📊 Заблокирован в {len(union_chats)} конференциях объединения "{union["union_name"]}", '
+            result_text += f'исключен из {success_count}.\n'
             result_text += f'📝 Причина: {reason}'
+            result_text += self.format_fanout_failures(kick_results)
 
-            self.send_message(peer_id, result_text)
+            self.finish_fanout(peer_id, progress_id, result_text)
             self.log(f"Глобальная блокировка пользователя {target_name} в {success_count} чатах. Причина: {reason}")
 
         except Exception as e:
@@ -4847,39 +8097,26 @@ Peer ID: {peer_id}"""
 
         try:
             # Получаем объединение для текущего чата
-            cursor = self.db.conn.cursor()
-            cursor.execute('''
-                SELECT cu.id, cu.union_name 
-                FROM chat_unions cu
-                JOIN union_chats uc ON cu.id = uc.union_id
-                WHERE uc.chat_id = ?
-            ''', (chat_id,))
-            union = cursor.fetchone()
+            union = self.db.get_chat_union(chat_id)
 
             if not union:
                 self.send_message(peer_id, '❌ Этот чат не входит в объединение.')
                 return
 
             # Получаем все чаты в объединении
-            cursor.execute('''
-                SELECT chat_id FROM union_chats WHERE union_id = ?
-            ''', (union['id'],))
-            union_chats = cursor.fetchall()
+            union_chats = self.db.get_union_chat_ids(union['id'])
 
             target_info = self.get_user_info(target_id)
             target_name = target_info['screen_name'] if target_info else str(target_id)
 
-            success_count = 0
-            for chat in union_chats:
-                try:
-                    # Снимаем бан в каждом чате
-                    self.db.remove_chat_ban(target_id, chat['chat_id'])
-                    success_count += 1
-                except Exception as e:
-                    self.log(f"Ошибка разбана в чате {chat['chat_id']}: {e}")
+            # Снимаем баны во всех чатах одной транзакцией
+            unbanned_chats = self.db.remove_chat_bans(target_id, union_chats)
+            success_count = len(unbanned_chats)
 
             result_text = f'✅ Глобальная разблокировка @{target_name} выполнена!\n'
             result_text += f'📊 Разблокирован в {success_count}/{len(union_chats)} конференциях объединения "{union["union_name"]}".'
+            if success_count < len(union_chats):
+                result_text += f'\nℹ️ В остальных {len(union_chats) - success_count} блокировки не было.'
 
             self.send_message(peer_id, result_text)
             self.log(f"Глобальная разблокировка пользователя {target_name} в {success_count} чатах")
@@ -5062,6 +8299,7 @@ Peer ID: {peer_id}"""
                     self.log(f"Ошибка создания роли в чате {chat['chat_id']}: {e}")
 
             self.db.conn.commit()
+            self.db.invalidate_chat_permissions()
 
             result_text = f'✅ Глобальное создание роли "{role_name}" ({role_level}) выполнено!\n'
             result_text += f'📊 Роль создана в {success_count}/{len(union_chats)} конференциях объединения "{union["union_name"]}".'
@@ -5320,6 +8558,7 @@ Peer ID: {peer_id}"""
                 ''', (original_name, chat_id, role_level))
 
                 self.db.conn.commit()
+                self.db.invalidate_chat_permissions(chat_id)
 
                 affected_count = len(users_with_role)
                 if affected_count > 0:
@@ -5349,6 +8588,7 @@ Peer ID: {peer_id}"""
                     ''', (user_row['user_id'], chat_id, sender_id))
 
                 self.db.conn.commit()
+                self.db.invalidate_chat_permissions(chat_id)
 
                 affected_count = len(users_with_role)
                 if affected_count > 0:
@@ -5412,6 +8652,7 @@ Peer ID: {peer_id}"""
             )
 
             self.db.conn.commit()
+            self.db.invalidate_chat_permissions()
 
             affected_count = len(users_with_role)
             self.send_message(peer_id, f'✅ Роль уровня {role_level} удалена глобально.')
@@ -5529,6 +8770,19 @@ Peer ID: {peer_id}"""
             self.log(f"Ошибка открепления сообщения: {e}")
             self.send_message(peer_id, '❌ Ошибка при открреплении сообщения.')
 
+    def get_message_key(self, message, action):
+        """Ключ идемпотентности действия по сообщению: повторно доставленное событие не спишет деньги дважды"""
+        if not message or not message.get('conversation_message_id'):
+            return None
+        return f"{action}:{message.get('peer_id')}:{message['conversation_message_id']}"
+
+    def accept_bet_result(self, peer_id, user_id, result):
+        """Разбирает результат списания ставки; при отказе сообщает причину. False - ставка не принята"""
+        if result == LEDGER_INSUFFICIENT:
+            balance = self.db.get_user_balance(user_id)
+            self.send_message(peer_id, f'❌ Недостаточно средств! Ваш баланс: {balance["balance"]:,} $')
+        return result == LEDGER_APPLIED
+
     def command_roulette(self, peer_id, sender_id):
         roulette_help = """🎰 КАЗИНО РУЛЕТКА
 
@@ -5547,9 +8801,7 @@ Peer ID: {peer_id}"""
 🟢 Зеленое: 0 (банк забирает все ставки)"""
         self.send_message(peer_id, roulette_help)
 
-    def command_bet(self, peer_id, sender_id, bet_type, bet_amount, bet_target=None, chat_id=None):
-        global ROULETTE_TIMERS
-
+    def command_bet(self, peer_id, sender_id, bet_type, bet_amount, bet_target=None, chat_id=None, idempotency_key=None):
         try:
             bet_amount = int(bet_amount)
         except (ValueError, TypeError):
@@ -5564,54 +8816,35 @@ Peer ID: {peer_id}"""
             self.send_message(peer_id, '❌ Максимальная ставка: 1,000,000,000 монет!')
             return
 
-        # Проверяем баланс
-        if not self.db.can_afford_bet(sender_id, bet_amount):
-            balance = self.db.get_user_balance(sender_id)
-            self.send_message(peer_id, f'❌ Недостаточно средств! Ваш баланс: {balance["balance"]:,} $')
-            return
+        # Получаем информацию о пользователе до списания: запрос к VK не должен разрывать ставку
+        sender_info = self.get_user_info(sender_id)
+        sender_name = sender_info['screen_name'] if sender_info else str(sender_id)
 
-        # Списываем ставку
-        self.db.update_user_balance(sender_id, -bet_amount)
+        # Списываем ставку и записываем ее в открытый (или новый) раунд одной транзакцией
+        result, game_id, created = self.db.place_roulette_bet(
+            chat_id or peer_id, peer_id, sender_id, sender_name, bet_type, bet_target, bet_amount, idempotency_key
+        )
+        if not self.accept_bet_result(peer_id, sender_id, result):
+            return
 
-        # Получаем или создаем активную игру
-        active_game = self.db.get_active_roulette_game(chat_id or peer_id)
-        if not active_game:
-            game_id = self.db.create_roulette_game(chat_id or peer_id)
+        if created:
             # При создании новой игры отправляем уведомление
             self.send_message(peer_id, '🎰 Игра "Рулетка" началась!\n⏱️ Приём ставок в течение 5 секунд...')
-        else:
-            game_id = active_game['id']
-
-        # Получаем информацию о пользователе
-        sender_info = self.get_user_info(sender_id)
-        sender_name = sender_info['screen_name'] if sender_info else str(sender_id)
 
-        # Добавляем ставку в базу
         display_bet_type = bet_target if bet_target else bet_type
-        self.db.add_roulette_bet(game_id, sender_id, sender_name, bet_type, bet_target, bet_amount)
 
         # Отправляем подтверждение ставки в красивом формате
         bet_confirmation = f"✅ [id{sender_id}|{sender_name}] — {bet_amount:,} $ на {display_bet_type}"
         self.send_message(peer_id, bet_confirmation)
 
-        # Сбрасываем предыдущий таймер если он был
-        timer_key = str(chat_id or peer_id)
-        if timer_key in ROULETTE_TIMERS:
-            ROULETTE_TIMERS[timer_key].cancel()
-
-        # Запускаем новый таймер на 5 секунд
-        timer = threading.Timer(5.0, self.end_roulette_round, args=[peer_id, game_id, chat_id or peer_id])
-        timer.start()
-        ROULETTE_TIMERS[timer_key] = timer
+        # Закрываем прием ставок через 5 секунд после последней ставки
+        settle_at = time.time() + 5.0
+        # Раунд могли закрыть сразу после ставки: тогда его итоги уже запланированы
+        if self.db.set_roulette_round(game_id, settle_at):
+            self.scheduler.schedule_at(f"roulette:{game_id}", settle_at, self.end_roulette_round,
+                                       peer_id, game_id, chat_id or peer_id)
 
     def end_roulette_round(self, peer_id, game_id, chat_id):
-        global ROULETTE_TIMERS
-
-        # Удаляем таймер из словаря
-        timer_key = str(chat_id)
-        if timer_key in ROULETTE_TIMERS:
-            del ROULETTE_TIMERS[timer_key]
-
         # Получаем все ставки перед закрытием
         bets = self.db.get_game_bets(game_id)
 
@@ -5620,89 +8853,46 @@ Peer ID: {peer_id}"""
             self.db.end_roulette_game(game_id, -1)
             return
 
+        settle_at = time.time() + 5.0
+        if not self.db.close_roulette_game(game_id, settle_at):
+            return
+
         # Отправляем сообщение о закрытии ставок с эмодзи рулетки
         self.send_message(peer_id, '🎰 Приём ставок для игры "Рулетка" закрыт.\n⏱️ Итоги раунда через 5 секунд...')
 
-        # Ждем 5 секунд
-        time.sleep(5)
+        # Итоги подводит отдельная задача планировщика, поток не ждет
+        self.scheduler.schedule_at(f"roulette-settle:{game_id}", settle_at, self.settle_roulette_round, peer_id, game_id)
 
+    def settle_roulette_round(self, peer_id, game_id):
+        """Подводит итоги закрытого раунда рулетки"""
         # Генерируем результат
         winning_number = random.randint(0, 36)
 
         # Определяем цвет
-        red_numbers = [1, 3, 5, 7, 9, 12, 14, 16, 18, 19, 21, 23, 25, 27, 30, 32, 34, 36]
-
         if winning_number == 0:
             color_emoji = "🟢"
-            color_name = "зеленое"
-        elif winning_number in red_numbers:
+        elif winning_number in ROULETTE_RED_NUMBERS:
             color_emoji = "🔴"
-            color_name = "красное"
         else:
             color_emoji = "⚫"
-            color_name = "черное"
-
-        # Завершаем игру
-        self.db.end_roulette_game(game_id, winning_number)
-
-        # Определяем победителей и формируем результат
-        winners = []
-        total_lost = 0
-        all_bets_info = []
-
-        for bet in bets:
-            is_winner = False
-            multiplier = 0
-
-            if bet['bet_type'] == 'число' and bet['bet_target'] and int(bet['bet_target']) == winning_number:
-                is_winner = True
-                multiplier = 36
-            elif bet['bet_type'] == 'чет' and winning_number > 0 and winning_number % 2 == 0:
-                is_winner = True
-                multiplier = 2
-            elif bet['bet_type'] == 'нечет' and winning_number > 0 and winning_number % 2 == 1:
-                is_winner = True
-                multiplier = 2
-            elif bet['bet_type'] == 'красное' and winning_number in red_numbers:
-                is_winner = True
-                multiplier = 2
-            elif bet['bet_type'] == 'черное' and winning_number != 0 and winning_number not in red_numbers:
-                is_winner = True
-                multiplier = 2
-
-            all_bets_info.append({
-                'user_id': bet['user_id'],
-                'username': bet['username'],
-                'bet_amount': bet['bet_amount'],
-                'bet_type': bet['bet_target'] if bet['bet_target'] else bet['bet_type'],
-                'is_winner': is_winner,
-                'multiplier': multiplier
-            })
 
-            if is_winner:
-                win_amount = bet['bet_amount'] * multiplier
-                self.db.update_user_balance(bet['user_id'], win_amount)
-                winners.append({
-                    'user_id': bet['user_id'],
-                    'username': bet['username'],
-                    'bet_amount': bet['bet_amount'],
-                    'win_amount': win_amount,
-                    'bet_type': bet['bet_target'] if bet['bet_target'] else bet['bet_type']
-                })
-            else:
-                total_lost += bet['bet_amount']
+        # Выплаты считаются в SQL и фиксируются вместе с результатом одной транзакцией
+        result = self.db.settle_roulette_round(game_id, winning_number)
+        if not result:
+            return
 
         # Формируем итоговое сообщение в стиле как на фото
         result_text = f"🎰 Итоги игры \"Рулетка\":\n\n🎲 Выпало: {color_emoji} {winning_number}\n\n"
 
-        if winners:
-            for winner in winners:
-                result_text += f"✅ [id{winner['user_id']}|{winner['username']}] выиграл {winner['win_amount']:,} $ (ставка {winner['bet_amount']:,} $ на {winner['bet_type']})\n"
+        if result['winners']:
+            for winner in result['winners']:
+                bet_label = winner['bet_target'] if winner['bet_target'] else winner['bet_type']
+                result_text += f"✅ [id{winner['user_id']}|{winner['username']}] выиграл {winner['win_amount']:,} $ (ставка {winner['bet_amount']:,} $ на {bet_label})\n"
         else:
             result_text += "❌ Все ставки проиграли!\n\n"
 
-        if total_lost > 0:
-            result_text += f"\n💰 Проиграно: {total_lost:,} $"
+        if result['total_lost'] > 0:
+            result_text += f"\n💰 Проиграно: {result['total_lost']:,} $"
 
         self.send_message(peer_id, result_text)
 
@@ -5973,9 +9163,7 @@ def command_giveowner(self, peer_id, sender_id, target_id):
             self.log(f"Ошибка выдачи системной роли: {e}")
             self.send_message(peer_id, '❌ Ошибка при выдаче роли.')
 
-    def command_dice(self, peer_id, sender_id, args, chat_id):
-        global DICE_TIMERS
-
+    def command_dice(self, peer_id, sender_id, args, chat_id, idempotency_key=None):
         if not args:
             # Показать доступные игры
             try:
@@ -6052,22 +9240,19 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                     self.send_message(peer_id, '❌ В игре нет свободных мест!')
                     return
 
-                # Проверяем баланс
-                bet_amount = game['bet_amount']
-                if not self.db.can_afford_bet(sender_id, bet_amount):
-                    balance = self.db.get_user_balance(sender_id)
-                    self.send_message(peer_id, f'❌ Недостаточно средств! Ваш баланс: {balance["balance"]:,}$')
-                    return
-
-                # Списываем ставку и добавляем игрока
-                self.db.update_user_balance(sender_id, -bet_amount)
-
                 sender_info = self.get_user_info(sender_id)
                 sender_name = sender_info['screen_name'] if sender_info else str(sender_id)
 
-                self.db.join_dice_game(game_id, sender_id, sender_name)
-
-                new_players_count = players_count + 1
+                # Списываем ставку и занимаем место одной транзакцией: проверки выше могли устареть,
+                # пока шел запрос к VK (таймаут, отмена создателем, другой игрок)
+                bet_amount = game['bet_amount']
+                result, new_players_count = self.db.join_dice_game(game_id, sender_id, sender_name,
+                                                                   f"dice_join:{game_id}:{sender_id}")
+                if result == LEDGER_CLOSED:
+                    self.send_message(peer_id, '❌ Игра уже началась, отменена или в ней нет свободных мест!')
+                    return
+                if not self.accept_bet_result(peer_id, sender_id, result):
+                    return
 
                 if new_players_count >= game['max_players']:
                     # Игра полная, запускаем
@@ -6121,14 +9306,14 @@ def command_giveowner(self, peer_id, sender_id, target_id):
             self.send_message(peer_id, '❌ Максимальное количество активных игр в кости: 5!')
             return
 
-        # Списываем ставку создателя
-        self.db.update_user_balance(sender_id, -bet_amount)
-
-        # Создаем игру
         sender_info = self.get_user_info(sender_id)
         sender_name = sender_info['screen_name'] if sender_info else str(sender_id)
 
-        game_id = self.db.create_dice_game(chat_id or peer_id, sender_id, sender_name, bet_amount, max_players)
+        # Списываем ставку создателя и создаем игру одной транзакцией
+        result, game_id = self.db.create_dice_game(chat_id or peer_id, sender_id, sender_name, bet_amount,
+                                                   max_players, peer_id, idempotency_key)
+        if not self.accept_bet_result(peer_id, sender_id, result):
+            return
 
         # Форматируем сумму для отображения
         amount_display = self.format_number(bet_amount)
@@ -6146,19 +9331,14 @@ def command_giveowner(self, peer_id, sender_id, target_id):
 
         self.send_message(peer_id, game_text, keyboard)
 
-        # Запускаем таймер на 30 минут
-        timer = threading.Timer(1800.0, self.cancel_dice_game_timeout, args=[peer_id, game_id, chat_id or peer_id])
-        timer.start()
-        DICE_TIMERS[game_id] = timer
+        # Запускаем таймер на 30 минут (сохраняется в БД и переживает перезапуск)
+        self.scheduler.schedule(f"dice:{game_id}", 1800.0, self.cancel_dice_game_timeout,
+                                peer_id, game_id, chat_id or peer_id, persist=True)
 
     def start_dice_game(self, peer_id, game_id, chat_id):
         """Запускает игру в кости когда набрались все игроки"""
-        global DICE_TIMERS
-
         # Отменяем таймер
-        if game_id in DICE_TIMERS:
-            DICE_TIMERS[game_id].cancel()
-            del DICE_TIMERS[game_id]
+        self.scheduler.cancel(f"dice:{game_id}")
 
         try:
             game = self.db.get_dice_game(game_id)
@@ -6167,6 +9347,10 @@ def command_giveowner(self, peer_id, sender_id, target_id):
             if not game or not players:
                 return
 
+            # Игра больше не ждет игроков: таймаут и отмена создателем ее не затронут
+            if not self.db.set_dice_game_rolling(game_id):
+                return
+
             # Бросаем кости для всех игроков
             results = []
             for player in players:
@@ -6199,20 +9383,18 @@ def command_giveowner(self, peer_id, sender_id, target_id):
 
                 self.send_message(peer_id, result_text)
 
-                # Перезапускаем через 3 секунды
-                timer = threading.Timer(3.0, self.start_dice_game, args=[peer_id, game_id, chat_id])
-                timer.start()
+                # Перезапускаем через 3 секунды (переигровка переживает перезапуск бота)
+                self.scheduler.schedule(f"dice:{game_id}", 3.0, self.start_dice_game, peer_id, game_id, chat_id,
+                                        persist=True)
                 return
 
             # Определяем победителя
             winner = winners[0]
             total_bank = game['bet_amount'] * (len(players) + 1)  # +1 за создателя
 
-            # Выплачиваем выигрыш
-            self.db.update_user_balance(winner['user_id'], total_bank)
-
-            # Завершаем игру
-            self.db.end_dice_game(game_id, winner['user_id'])
+            # Завершаем игру и выплачиваем выигрыш одной транзакцией
+            if not self.db.settle_dice_game(game_id, winner['user_id'], total_bank):
+                return
 
             # Отправляем результат
             result_text = f"🎮 Игра в кости №{game_id}\n"
@@ -6229,30 +9411,11 @@ def command_giveowner(self, peer_id, sender_id, target_id):
 
     def cancel_dice_game_timeout(self, peer_id, game_id, chat_id):
         """Отменяет игру по таймауту"""
-        global DICE_TIMERS
-
-        if game_id in DICE_TIMERS:
-            del DICE_TIMERS[game_id]
-
         try:
-            game = self.db.get_dice_game(game_id)
-            players = self.db.get_dice_players(game_id)
-
-            if game and game['status'] == 'waiting':
-                # Возвращаем ставки
-                self.db.update_user_balance(game['creator_id'], game['bet_amount'])
-
-                for player in players:
-                    self.db.update_user_balance(player['user_id'], game['bet_amount'])
-
-                # Отменяем игру
-                self.db.cancel_dice_game(game_id)
-
-                # Отменяем таймер
-                if game_id in DICE_TIMERS:
-                    DICE_TIMERS[game_id].cancel()
-                    del DICE_TIMERS[game_id]
+            # Отменяем игру и возвращаем ставки одной транзакцией
+            game = self.db.refund_dice_game(game_id)
 
+            if game:
                 amount_display = self.format_number(game['bet_amount'])
                 self.send_message(peer_id, f'⏰ Игра в кости №{game_id} отменена по таймауту. Ставки ({amount_display}$) возвращены всем участникам.')
 
@@ -6270,7 +9433,10 @@ def command_giveowner(self, peer_id, sender_id, target_id):
 
     def command_bonus(self, peer_id, sender_id):
         try:
-            if not self.db.can_claim_bonus(sender_id):
+            # Генерируем случайный бонус от 1,000,000 до 5,000,000
+            bonus_amount = random.randint(*BONUS_AMOUNT_RANGE)
+
+            if not self.db.claim_bonus(sender_id, bonus_amount):
                 balance_data = self.db.get_user_balance(sender_id)
                 last_claim_time_data = balance_data.get('last_bonus_claim')
 
@@ -6281,7 +9447,9 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                         else:
                             last_claim_time = last_claim_time_data
 
-                        time_until_next_claim = (last_claim_time + timedelta(hours=1)) - datetime.now()
+                        # CURRENT_TIMESTAMP в SQLite хранится в UTC
+                        now = datetime.now(timezone.utc).replace(tzinfo=None)
+                        time_until_next_claim = (last_claim_time + timedelta(hours=BONUS_INTERVAL_HOURS)) - now
 
                         if time_until_next_claim.total_seconds() > 0:
                             hours, remainder = divmod(time_until_next_claim.total_seconds(), 3600)
@@ -6291,15 +9459,8 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                             return
                     except:
                         pass
-                else:
-                    self.send_message(peer_id, '⏰ Бонус можно получать только раз в час! Попробуйте позже.')
-                    return
-
-            # Генерируем случайный бонус от 1,000,000 до 5,000,000
-            bonus_amount = random.randint(1000000, 5000000)
-
-            self.db.update_user_balance(sender_id, bonus_amount)
-            self.db.claim_bonus(sender_id)
+                self.send_message(peer_id, '⏰ Бонус можно получать только раз в час! Попробуйте позже.')
+                return
 
             sender_info = self.get_user_info(sender_id)
             sender_name = sender_info['screen_name'] if sender_info else str(sender_id)
@@ -6348,26 +9509,10 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                 return None
 
     def generate_crash_multiplier(self):
-        """Генерирует множитель для краш игры с реалистичными шансами"""
-        rand = random.random()
-
-        # Большинство крашей происходят рано
-        if rand < 0.4:  # 40% - краш между 1.01 и 1.50
-            return round(random.uniform(1.01, 1.50), 2)
-        elif rand < 0.7:  # 30% - краш между 1.50 и 3.00
-            return round(random.uniform(1.50, 3.00), 2)
-        elif rand < 0.85:  # 15% - краш между 3.00 и 10.00
-            return round(random.uniform(3.00, 10.00), 2)
-        elif rand < 0.95:  # 10% - краш между 10.00 и 50.00
-            return round(random.uniform(10.00, 50.00), 2)
-        elif rand < 0.99:  # 4% - краш между 50.00 и 200.00
-            return round(random.uniform(50.00, 200.00), 2)
-        else:  # 1% - очень редкие большие множители
-            return round(random.uniform(200.00, 1500.00), 2)
-
-    def command_crash(self, peer_id, sender_id, target_multiplier, bet_amount_str, chat_id=None):
-        global CRASH_TIMERS
+        """Генерирует множитель для краш игры с реалистичными шансами (см. CRASH_MULTIPLIER_TIERS)"""
+        return round(sample_multiplier(CRASH_MULTIPLIER_TIERS), 2)
 
+    def command_crash(self, peer_id, sender_id, target_multiplier, bet_amount_str, chat_id=None, idempotency_key=None):
         # Получаем баланс пользователя
         balance_data = self.db.get_user_balance(sender_id)
         user_balance = balance_data['balance']
@@ -6401,22 +9546,17 @@ def command_giveowner(self, peer_id, sender_id, target_id):
             self.send_message(peer_id, '❌ Максимальный множитель: 1000!')
             return
 
-        # Списываем ставку
-        self.db.update_user_balance(sender_id, -bet_amount)
-
-        # Получаем или создаем активную игру
-        active_game = self.db.get_active_crash_game(chat_id or peer_id)
-        if not active_game:
-            game_id = self.db.create_crash_game(chat_id or peer_id)
-        else:
-            game_id = active_game['id']
-
-        # Получаем информацию о пользователе
+        # Получаем информацию о пользователе до списания: запрос к VK не должен разрывать ставку
         sender_info = self.get_user_info(sender_id)
         sender_name = sender_info['screen_name'] if sender_info else str(sender_id)
 
-        # Добавляем ставку в базу
-        self.db.add_crash_bet(game_id, sender_id, sender_name, bet_amount, target_multiplier)
+        # Списываем ставку и записываем ее в открытый (или новый) раунд одной транзакцией
+        result, game_id, _ = self.db.place_crash_bet(
+            chat_id or peer_id, peer_id, sender_id, sender_name, bet_amount, target_multiplier, 'crash',
+            idempotency_key
+        )
+        if not self.accept_bet_result(peer_id, sender_id, result):
+            return
 
         # Форматируем сумму для отображения
         if bet_amount >= 1000000:
@@ -6430,24 +9570,14 @@ def command_giveowner(self, peer_id, sender_id, target_id):
         bet_confirmation = f"✅ [id{sender_id}|{sender_name}] — {amount_display} на x{target_multiplier:.2f}"
         self.send_message(peer_id, bet_confirmation)
 
-        # Сбрасываем предыдущий таймер если он был
-        timer_key = str(chat_id or peer_id)
-        if timer_key in CRASH_TIMERS:
-            CRASH_TIMERS[timer_key].cancel()
-
-        # Запускаем новый таймер на 10 секунд
-        timer = threading.Timer(10.0, self.end_crash_round, args=[peer_id, game_id, chat_id or peer_id])
-        timer.start()
-        CRASH_TIMERS[timer_key] = timer
+        # Закрываем прием ставок через 10 секунд после последней ставки
+        settle_at = time.time() + 10.0
+        # Раунд могли закрыть сразу после ставки: тогда его итоги уже запланированы
+        if self.db.set_crash_round(game_id, 'crash', settle_at):
+            self.scheduler.schedule_at(f"crash:{game_id}", settle_at, self.end_crash_round,
+                                       peer_id, game_id, chat_id or peer_id)
 
     def end_crash_round(self, peer_id, game_id, chat_id):
-        global CRASH_TIMERS
-
-        # Удаляем таймер из словаря
-        timer_key = str(chat_id)
-        if timer_key in CRASH_TIMERS:
-            del CRASH_TIMERS[timer_key]
-
         # Получаем все ставки перед закрытием
         bets = self.db.get_crash_game_bets(game_id)
 
@@ -6456,43 +9586,35 @@ def command_giveowner(self, peer_id, sender_id, target_id):
             self.db.end_crash_game(game_id, 0)
             return
 
+        settle_at = time.time() + 5.0
+        if not self.db.close_crash_game(game_id, settle_at):
+            return
+
         # Отправляем сообщение о закрытии ставок
         self.send_message(peer_id, '✅ Приём ставок для игры "Crash" закрыт.\n🕒 Итоги раунда через 5 секунд...')
 
         # Отправляем дополнительное сообщение о том, что ставки закрыты
         self.send_message(peer_id, '🚫 Ставки закрыты. Ожидайте результатов...')
 
-        # Ждем 5 секунд
-        time.sleep(5)
-
-        # Генерируем результат краша
-        crash_multiplier = self.generate_crash_multiplier()
-
-        # Завершаем игру
-        self.db.end_crash_game(game_id, crash_multiplier)
-
-        # Определяем победителей и проигравших
-        winners = []
-        total_lost = 0
-
-        for bet in bets:
-            if bet['target_multiplier'] <= crash_multiplier:
-                # Игрок выиграл
-                win_amount = int(bet['bet_amount'] * bet['target_multiplier'])
-                self.db.update_user_balance(bet['user_id'], win_amount)
-                winners.append({
-                    'user_id': bet['user_id'],
-                    'username': bet['username'],
-                    'bet_amount': bet['bet_amount'],
-                    'win_amount': win_amount,
-                    'target_multiplier': bet['target_multiplier']
-                })
-            else:
-                # Игрок проиграл
-                total_lost += bet['bet_amount']
+        # Итоги подводит отдельная задача планировщика, поток не ждет
+        self.scheduler.schedule_at(f"crash-settle:{game_id}", settle_at, self.settle_crash_round, peer_id, game_id, 'crash')
+
+    def settle_crash_round(self, peer_id, game_id, game_type='crash'):
+        """Подводит итоги закрытого раунда Crash или Дрим"""
+        # Генерируем результат (у Дрим более высокие множители)
+        if game_type == 'dream':
+            crash_multiplier = self.generate_dream_multiplier()
+            result_text = f"💭 Итоги игры \"Дрим\"\n💭 Дрим на отметке: x{crash_multiplier:.2f}\n\n"
+        else:
+            crash_multiplier = self.generate_crash_multiplier()
+            result_text = f"📈 Итоги игры \"Crash\"\n📈 Краш на отметке: x{crash_multiplier:.2f}\n\n"
 
-        # Формируем итоговое сообщение
-        result_text = f"📈 Итоги игры \"Crash\"\n📈 Краш на отметке: x{crash_multiplier:.2f}\n\n"
+        # Выплаты считаются в SQL и фиксируются вместе с результатом одной транзакцией
+        result = self.db.settle_crash_round(game_id, crash_multiplier)
+        if not result:
+            return
+        winners = result['winners']
+        total_lost = result['total_lost']
 
         if winners:
             for winner in winners:
@@ -6531,10 +9653,8 @@ def command_giveowner(self, peer_id, sender_id, target_id):
 
         self.send_message(peer_id, result_text)
 
-    def command_dream(self, peer_id, sender_id, target_multiplier, bet_amount_str, chat_id=None):
+    def command_dream(self, peer_id, sender_id, target_multiplier, bet_amount_str, chat_id=None, idempotency_key=None):
         """Команда Дрим - аналог краша с более высокими множителями"""
-        global CRASH_TIMERS
-
         # Получаем баланс пользователя
         balance_data = self.db.get_user_balance(sender_id)
         user_balance = balance_data['balance']
@@ -6568,22 +9688,17 @@ def command_giveowner(self, peer_id, sender_id, target_id):
             self.send_message(peer_id, '❌ Максимальный множитель: 10000!')
             return
 
-        # Списываем ставку
-        self.db.update_user_balance(sender_id, -bet_amount)
-
-        # Получаем или создаем активную игру (используем ту же таблицу что и краш)
-        active_game = self.db.get_active_crash_game(chat_id or peer_id)
-        if not active_game:
-            game_id = self.db.create_crash_game(chat_id or peer_id)
-        else:
-            game_id = active_game['id']
-
-        # Получаем информацию о пользователе
+        # Получаем информацию о пользователе до списания: запрос к VK не должен разрывать ставку
         sender_info = self.get_user_info(sender_id)
         sender_name = sender_info['screen_name'] if sender_info else str(sender_id)
 
-        # Добавляем ставку в базу (используем ту же таблицу что и краш)
-        self.db.add_crash_bet(game_id, sender_id, sender_name, bet_amount, target_multiplier)
+        # Списываем ставку и записываем ее в открытый (или новый) раунд одной транзакцией (используем ту же таблицу что и краш)
+        result, game_id, _ = self.db.place_crash_bet(
+            chat_id or peer_id, peer_id, sender_id, sender_name, bet_amount, target_multiplier, 'dream',
+            idempotency_key
+        )
+        if not self.accept_bet_result(peer_id, sender_id, result):
+            return
 
         # Форматируем сумму для отображения
         if bet_amount >= 1000000:
@@ -6597,25 +9712,15 @@ def command_giveowner(self, peer_id, sender_id, target_id):
         bet_confirmation = f"💭 [id{sender_id}|{sender_name}] — {amount_display} на x{target_multiplier:.2f} (Дрим)"
         self.send_message(peer_id, bet_confirmation)
 
-        # Сбрасываем предыдущий таймер если он был
-        timer_key = str(chat_id or peer_id)
-        if timer_key in CRASH_TIMERS:
-            CRASH_TIMERS[timer_key].cancel()
-
-        # Запускаем новый таймер на 15 секунд (дольше чем краш)
-        timer = threading.Timer(15.0, self.end_dream_round, args=[peer_id, game_id, chat_id or peer_id])
-        timer.start()
-        CRASH_TIMERS[timer_key] = timer
+        # Закрываем прием ставок через 15 секунд (дольше чем краш); Дрим делит раунд с крашем
+        settle_at = time.time() + 15.0
+        # Раунд могли закрыть сразу после ставки: тогда его итоги уже запланированы
+        if self.db.set_crash_round(game_id, 'dream', settle_at):
+            self.scheduler.schedule_at(f"crash:{game_id}", settle_at, self.end_dream_round,
+                                       peer_id, game_id, chat_id or peer_id)
 
     def end_dream_round(self, peer_id, game_id, chat_id):
         """Завершение раунда Дрим"""
-        global CRASH_TIMERS
-
-        # Удаляем таймер из словаря
-        timer_key = str(chat_id)
-        if timer_key in CRASH_TIMERS:
-            del CRASH_TIMERS[timer_key]
-
         # Получаем все ставки перед закрытием
         bets = self.db.get_crash_game_bets(game_id)
 
@@ -6624,102 +9729,22 @@ def command_giveowner(self, peer_id, sender_id, target_id):
             self.db.end_crash_game(game_id, 0)
             return
 
+        settle_at = time.time() + 7.0
+        if not self.db.close_crash_game(game_id, settle_at):
+            return
+
         # Отправляем сообщение о закрытии ставок
         self.send_message(peer_id, '✅ Приём ставок для игры "Дрим" закрыт.\n🕒 Итоги раунда через 7 секунд...')
 
         # Отправляем дополнительное сообщение о том, что ставки закрыты
         self.send_message(peer_id, '🚫 Ставки закрыты. Ожидайте результатов...')
 
-        # Ждем 7 секунд
-        time.sleep(7)
-
-        # Генерируем результат дрима (более высокие множители)
-        dream_multiplier = self.generate_dream_multiplier()
-
-        # Завершаем игру
-        self.db.end_crash_game(game_id, dream_multiplier)
-
-        # Определяем победителей и проигравших
-        winners = []
-        total_lost = 0
-
-        for bet in bets:
-            if bet['target_multiplier'] <= dream_multiplier:
-                # Игрок выиграл
-                win_amount = int(bet['bet_amount'] * bet['target_multiplier'])
-                self.db.update_user_balance(bet['user_id'], win_amount)
-                winners.append({
-                    'user_id': bet['user_id'],
-                    'username': bet['username'],
-                    'bet_amount': bet['bet_amount'],
-                    'win_amount': win_amount,
-                    'target_multiplier': bet['target_multiplier']
-                })
-            else:
-                # Игрок проиграл
-                total_lost += bet['bet_amount']
-
-        # Формируем итоговое сообщение
-        result_text = f"💭 Итоги игры \"Дрим\"\n💭 Дрим на отметке: x{dream_multiplier:.2f}\n\n"
-
-        if winners:
-            for winner in winners:
-                # Форматируем суммы для отображения
-                if winner['bet_amount'] >= 1000000:
-                    bet_display = f"{winner['bet_amount']/1000000:.3f}M$"
-                elif winner['bet_amount'] >= 1000:
-                    bet_display = f"{winner['bet_amount']/1000:.3f}к$"
-                else:
-                    bet_display = f"{winner['bet_amount']}$"
-
-                if winner['win_amount'] >= 1000000:
-                    win_display = f"{winner['win_amount']/1000000:.3f}M$"
-                elif winner['win_amount'] >= 1000:
-                    win_display = f"{winner['win_amount']/1000:.3f}к$"
-                else:
-                    win_display = f"{winner['win_amount']}$"
-
-                result_text += f"✅ [id{winner['user_id']}|{winner['username']}] — {bet_display} на {winner['target_multiplier']:.2f}\n— Приз: {win_display}\n\n"
-
-        if total_lost > 0:
-            if winners:
-                result_text += "\n"
-            else:
-                result_text += "❌ Все ставки проиграли!\n\n"
-
-            # Форматируем проигранную сумму
-            if total_lost >= 1000000:
-                lost_display = f"{total_lost/1000000:.3f}M$"
-            elif total_lost >= 1000:
-                lost_display = f"{total_lost/1000:.3f}к$"
-            else:
-                lost_display = f"{total_lost}$"
-
-            result_text += f"💰 Проиграно: {lost_display}"
-
-        self.send_message(peer_id, result_text)
+        # Итоги подводит отдельная задача планировщика, поток не ждет
+        self.scheduler.schedule_at(f"crash-settle:{game_id}", settle_at, self.settle_crash_round, peer_id, game_id, 'dream')
 
     def generate_dream_multiplier(self):
-        """Генерирует множитель для игры Дрим (более высокие значения)"""
-        # Дрим имеет более высокие множители чем краш
-        # 50% шанс на множитель до 2x
-        # 30% шанс на множитель до 5x  
-        # 15% шанс на множитель до 10x
-        # 4% шанс на множитель до 50x
-        # 1% шанс на множитель до 100x
-
-        rand = random.random()
-
-        if rand < 0.5:
-            return random.uniform(1.01, 2.0)
-        elif rand < 0.8:
-            return random.uniform(2.0, 5.0)
-        elif rand < 0.95:
-            return random.uniform(5.0, 10.0)
-        elif rand < 0.99:
-            return random.uniform(10.0, 50.0)
-        else:
-            return random.uniform(50.0, 100.0)
+        """Генерирует множитель для игры Дрим (более высокие значения, см. DREAM_MULTIPLIER_TIERS)"""
+        return sample_multiplier(DREAM_MULTIPLIER_TIERS)
 
     def command_add_balance(self, peer_id, sender_id, target_id, amount):
         if not target_id or not amount:
@@ -6773,20 +9798,15 @@ def command_giveowner(self, peer_id, sender_id, target_id):
         required_level = 0
 
         # Системные команды (проверяются отдельно)
-        if command in ['ahelp', 'sysadmins', 'tickets', 'giveagent', 'giveadm', 'null', 'sysban', 'unsysban', 'sysrole']:
+        if command in SYSTEM_COMMANDS:
             return {'has_permission': True}  # Проверка внутри самих команд
 
         # Проверяем кастомные права для команды в конкретном чате
         if chat_id:
             try:
-                cursor = self.db.conn.cursor()
-                cursor.execute(
-                    'SELECT required_level FROM command_permissions WHERE chat_id = ? AND command = ?',
-                    (chat_id, command)
-                )
-                custom_perm = cursor.fetchone()
-                if custom_perm:
-                    required_level = custom_perm['required_level']
+                custom_level = self.db.get_chat_permissions(chat_id)['commands'].get(command)
+                if custom_level is not None:
+                    required_level = custom_level
                     has_permission = self.has_permission(user_id, username, required_level, chat_id)
 
                     if not has_permission and required_level > 0:
@@ -6805,22 +9825,7 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                 self.log(f"Ошибка проверки кастомных прав команды: {e}")
 
         # Определяем минимальный уровень прав для команды (стандартные уровни)
-        if command in ['helper']:
-            required_level = 20  # Помощник
-        elif command in ['kick', 'warn', 'unwarn', 'getwarn', 'warnhistory', 'warnlist', 'mutelist', 'mute', 'unmute', 'getban', 'setnick', 'removenick', 'getbynick', 'nicknames', 'nonames', 'zov', 'roles']:
-            required_level = 20  # Помощник - базовые команды модерации
-        elif command in ['role', 'removerole', 'ban', 'unban', 'banlist', 'gkick', 'silence', 'logs', 'gsetnick', 'gremovenick', 'delete', 'gzov', 'newrole', 'delrole']:
-            required_level = 40  # Модератор - расширенные команды администрирования
-        elif command in ['admin', 'moder', 'gm', 'gms', 'gban', 'gunban', 'filter', 'settings', 'pin', 'unpin', 'rr', 'gsetrole', 'welcome']:
-            required_level = 60  # Администратор - глобальное управление и настройки
-        elif command in ['gdelrole', 'setrules', 'inactive']:
-            required_level = 80  # Спец.Администратор
-        elif command in ['owner', 'initadmin', 'checknicks', 'editcmd', 'pull', 'newpull', 'wipe', 'piar']:
-            required_level = 100 # Создатель
-        elif command in ['add']: # Команда add доступна только создателю
-            required_level = 100
-        elif command in ['help', 'ping', 'start', 'rules', 'try', 'kiss', 'hug', 'marry', 'divorce', 'roulette', 'bet', 'bonus', 'balance', 'report', 'stats', 'online', 'staff', 'top', 'getreport', 'chatinfo', 'getnick', 'nicknames', 'nonames', 'zov', 'reg', 'settoken', 'answer', 'rape', 'oral', 'mtop', 'crash', 'dream', 'dice', 'convert', 'transfer', 'q', 'chatid', 'ai']:
-            required_level = 0 # Любой пользователь
+        required_level = COMMAND_LEVELS.get(command, 0)
 
         has_permission = self.has_permission(user_id, username, required_level, chat_id)
 
@@ -6840,6 +9845,142 @@ def command_giveowner(self, peer_id, sender_id, target_id):
 
         return {'has_permission': has_permission}
 
+    def get_command_registry(self):
+        """Таблица команд, строится один раз при первом обращении"""
+        if self.command_registry is None:
+            self.command_registry = self.build_command_registry()
+        return self.command_registry
+
+    def build_command_registry(self):
+        """Строит таблицу: алиас -> ключ команды, ключ -> описание обработчика"""
+        aliases = {}
+        for cmd_key, cmd_aliases in CONFIG['commands'].items():
+            for alias in cmd_aliases:
+                aliases.setdefault(alias, cmd_key)
+
+        commands = {}
+        for name in dir(self):
+            if not name.startswith('route_'):
+                continue
+            cmd_key = name[len('route_'):]
+            commands[cmd_key] = {
+                'name': cmd_key,
+                'handler': getattr(self, name),
+                'level': COMMAND_LEVELS.get(cmd_key, 0),
+                'aliases': CONFIG['commands'].get(cmd_key, []),
+            }
+            aliases.setdefault(cmd_key, cmd_key)
+
+        return {'aliases': aliases, 'commands': commands}
+
+    def record_command_latency(self, command, elapsed):
+        self.tracer.observe('command', command, elapsed)
+
+    def get_command_latency_stats(self):
+        """Гистограммы времени выполнения по командам"""
+        return {name: snapshot for (_, name), snapshot in self.tracer.snapshot('command').items()}
+
+    def start_perf_monitoring(self):
+        """Метрики по конфигу: HTTP-эндпоинт, периодический отчет в лог и профилировщик"""
+        metrics_port = CONFIG.get('metrics_port')
+        if metrics_port:
+            try:
+                self.metrics_server = MetricsServer(self, CONFIG.get('metrics_host', '127.0.0.1'), metrics_port)
+                self.metrics_server.start()
+                self.log(f"Метрики доступны на http://{CONFIG.get('metrics_host', '127.0.0.1')}:{metrics_port}/metrics")
+            except OSError as e:
+                self.metrics_server = None
+                self.log(f"Не удалось запустить сервер метрик: {e}")
+
+        report_interval = CONFIG.get('perf_report_interval', 0)
+        if report_interval:
+            self.scheduler.schedule('perf:report', report_interval, self.log_perf_report, interval=report_interval)
+
+        if CONFIG.get('profiler_enabled', False):
+            self.profiler.start()
+
+    def get_metrics(self):
+        """Все метрики бота одним словарем (для /metrics.json)"""
+        return {
+            'uptime': round(time.time() - self.start_time, 1),
+            'latency': {f"{kind}:{name}": snapshot for (kind, name), snapshot in self.tracer.snapshot().items()},
+            'queue_wait': self.dispatcher.queue_wait.snapshot(),
+            'dispatcher': self.dispatcher.get_stats(),
+            'scheduler': self.scheduler.get_stats(),
+            'user_cache': self.user_cache.get_stats(),
+            'member_cache': self.member_cache.get_stats(),
+            'profiler': self.profiler.top() if self.profiler.samples else None,
+        }
+
+    def render_metrics(self):
+        """Метрики в текстовом формате Prometheus"""
+        return self.tracer.render_prometheus(
+            gauges={
+                'dispatcher': self.dispatcher.get_stats(),
+                'scheduler': self.scheduler.get_stats(),
+                'user_cache': self.user_cache.get_stats(),
+                'member_cache': self.member_cache.get_stats(),
+            },
+            histograms={('queue', 'wait'): self.dispatcher.queue_wait.snapshot()}
+        )
+
+    def format_perf_report(self, limit=8):
+        """Текстовый отчет: стадии обработки, самые затратные команды с долей БД и VK, профилировщик"""
+        stages = self.tracer.snapshot('stage')
+        commands = self.tracer.snapshot('command')
+        db_time = {name: snapshot['total_ms'] for (_, name), snapshot in self.tracer.snapshot('db').items()}
+        vk_time = {name: snapshot['total_ms'] for (_, name), snapshot in self.tracer.snapshot('vk').items()}
+        queue_wait = self.dispatcher.queue_wait.snapshot()
+
+        report = f"📈 Производительность за {self.format_duration(time.time() - self.start_time)}\n\n"
+        report += f"⏳ Ожидание в очереди: p50 {queue_wait['p50_ms']:g} мс, p95 {queue_wait['p95_ms']:g} мс\n\n"
+
+        report += "🧩 Стадии (p50 / p95 / max, мс):\n"
+        for (_, stage), snapshot in sorted(stages.items(), key=lambda item: -item[1]['total_ms'])[:limit]:
+            report += f"• {stage}: {snapshot['p50_ms']:g} / {snapshot['p95_ms']:g} / {snapshot['max_ms']:g} ({snapshot['count']})\n"
+
+        report += "\n⚙️ Команды по суммарному времени:\n"
+        for (_, command), snapshot in sorted(commands.items(), key=lambda item: -item[1]['total_ms'])[:limit]:
+            # БД и VK копятся за все событие, поэтому долю ограничиваем сверху
+            total = snapshot['total_ms'] or 1
+            db_share = min(1.0, db_time.get(command, 0) / total)
+            vk_share = min(1.0, vk_time.get(command, 0) / total)
+            report += (f"• /{command}: {snapshot['count']} выз., p95 {snapshot['p95_ms']:g} мс, "
+                       f"БД {db_share:.0%}, VK {vk_share:.0%}\n")
+        if not commands:
+            report += "• команд еще не было\n"
+
+        if self.profiler.running or self.profiler.samples:
+            top = self.profiler.top(5)
+            report += f"\n🔬 Профилировщик: {'включен' if self.profiler.running else 'выключен'}, семплов {top['samples']}\n"
+            for name, share in top['own']:
+                report += f"• {share}% {name}\n"
+        return report
+
+    def log_perf_report(self):
+        self.log(self.format_perf_report())
+
+    def command_perf(self, peer_id, sender_id, args):
+        """Отчет о задержках; 'сброс' обнуляет гистограммы, 'профиль вкл/выкл' управляет профилировщиком"""
+        system_admin = self.db.get_system_admin(sender_id)
+        if not system_admin or system_admin['access_level'] < 5:
+            self.send_message(peer_id, '❌ Только разработчик может смотреть метрики производительности.')
+            return
+
+        action = ' '.join(arg.lower() for arg in args)
+        if action in ('сброс', 'reset'):
+            self.tracer.reset()
+            self.profiler.reset()
+            self.send_message(peer_id, '✅ Метрики производительности сброшены.')
+        elif action in ('профиль вкл', 'profile on'):
+            started = self.profiler.start()
+            self.send_message(peer_id, '🔬 Профилировщик включен.' if started else '❌ Профилировщик уже работает.')
+        elif action in ('профиль выкл', 'profile off'):
+            stopped = self.profiler.stop()
+            self.send_message(peer_id, '🔬 Профилировщик выключен.' if stopped else '❌ Профилировщик не запущен.')
+        else:
+            self.send_message(peer_id, self.format_perf_report())
+
     def handle_command(self, text, user_id, username, peer_id, chat_id, message):
         # Проверяем системный бан
         if self.db.is_system_banned(user_id):
@@ -6884,10 +10025,7 @@ def command_giveowner(self, peer_id, sender_id, target_id):
 
         # Определяем команду по алиасам
         original_command = command
-        for cmd_key, aliases in CONFIG['commands'].items():
-            if command in aliases:
-                command = cmd_key
-                break
+        command = self.get_command_registry()['aliases'].get(command, command)
 
         # Проверка регистрации беседы (кроме команды start)
         if chat_id and command not in ['start', 'начать', 'старт'] and not self.is_chat_registered(chat_id):
@@ -6912,7 +10050,8 @@ def command_giveowner(self, peer_id, sender_id, target_id):
             return
 
         # Проверка прав доступа к командам
-        permission_check = self.check_command_permission(command, user_id, username, chat_id)
+        with self.tracer.span('check_command_permission'):
+            permission_check = self.check_command_permission(command, user_id, username, chat_id)
         if not permission_check['has_permission']:
             if 'required_level' in permission_check:
                 error_message = f"""⛔ Доступ запрещён! Для команды /{permission_check['command']} нужен приоритет ({permission_check['required_level']}) и выше.
@@ -6923,523 +10062,558 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                 self.send_message(peer_id, '❌ У вас недостаточно прав для выполнения этой команды.')
             return
 
-        # Далее идет обработка команд, как было раньше
-        if command == 'help':
-            self.command_help(peer_id)
+        # Обработчик находим одним обращением к таблице команд
+        descriptor = self.get_command_registry()['commands'].get(command)
+        if descriptor is None:
+            # Ищем похожие команды
+            similar = self.get_similar_commands(original_command)
+            if similar:
+                similar_text = ', '.join(similar)
+                self.send_message(peer_id, f'🤔 Команда "/{original_command}" не найдена. Возможно, вы имели в виду: {similar_text}')
+            else:
+                self.send_message(peer_id, f'❌ Команда "/{original_command}" не найдена.')
+            return
+
+        self.tracer.set_command(command)
+        started = time.perf_counter()
+        try:
+            with self.tracer.span('command'):
+                descriptor['handler'](args, user_id, username, peer_id, chat_id, message)
+        finally:
+            self.record_command_latency(command, time.perf_counter() - started)
+
 
-        elif command == 'ping':
-            self.command_ping(peer_id)
+    def route_help(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_help(peer_id)
 
-        elif command == 'start':
-            self.command_start(peer_id, user_id, chat_id)
+    def route_ping(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_ping(peer_id)
 
-        elif command == 'rules':
-            self.command_rules(peer_id)
+    def route_start(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_start(peer_id, user_id, chat_id)
 
-        elif command == 'roles':
-            self.command_roles(peer_id, chat_id)
+    def route_rules(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_rules(peer_id)
 
-        elif command == 'try':
-            action = ' '.join(args[1:])
-            self.command_try(peer_id, action)
+    def route_roles(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_roles(peer_id, chat_id)
 
-        elif command == 'kiss':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_kiss(peer_id, user_id, target_id)
+    def route_try(self, args, user_id, username, peer_id, chat_id, message):
+        action = ' '.join(args[1:])
+        self.command_try(peer_id, action)
 
-        elif command == 'hug':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_hug(peer_id, user_id, target_id)
+    def route_kiss(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_kiss(peer_id, user_id, target_id)
 
-        elif command == 'marry':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_marry(peer_id, user_id, target_id)
+    def route_hug(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_hug(peer_id, user_id, target_id)
 
-        elif command == 'divorce':
-            self.command_divorce(peer_id, user_id)
+    def route_marry(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_marry(peer_id, user_id, target_id)
 
-        elif command == 'rape':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_rape(peer_id, user_id, target_id)
+    def route_divorce(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_divorce(peer_id, user_id)
 
-        elif command == 'oral':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_oral(peer_id, user_id, target_id)
+    def route_rape(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_rape(peer_id, user_id, target_id)
 
-        elif command == 'roulette':
-            self.command_roulette(peer_id, user_id)
+    def route_oral(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_oral(peer_id, user_id, target_id)
 
-        elif command == 'bet':
-            if len(args) < 3:
-                self.send_message(peer_id, '❌ Использование: /ставка [тип] [сумма] или /ставка [число] [сумма]')
-                return
+    def route_roulette(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_roulette(peer_id, user_id)
 
-            bet_type = args[1]
+    def route_bet(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 3:
+            self.send_message(peer_id, '❌ Использование: /ставка [тип] [сумма] или /ставка [число] [сумма]')
+            return
 
-            # Ставка на конкретное число
-            try:
-                number = int(bet_type)
-                if 0 <= number <= 36:
-                    bet_amount = args[2]
-                    self.command_bet(peer_id, user_id, 'число', bet_amount, bet_type, chat_id)
-                else:
-                    self.send_message(peer_id, '❌ Номер должен быть от 0 до 36!')
-            except ValueError:
-                # Ставка на тип (чет/нечет/красное/черное)
-                if bet_type in ['чет', 'нечет', 'красное', 'черное']:
-                    bet_amount = args[2]
-                    self.command_bet(peer_id, user_id, bet_type, bet_amount, None, chat_id)
-                else:
-                    self.send_message(peer_id, '❌ Доступные ставки: чет, нечет, красное, черное или число от 0 до 36')
+        bet_type = args[1]
 
-        elif command == 'bonus':
-            self.command_bonus(peer_id, user_id)
+        # Ставка на конкретное число
+        try:
+            number = int(bet_type)
+            if 0 <= number <= 36:
+                bet_amount = args[2]
+                self.command_bet(peer_id, user_id, 'число', bet_amount, bet_type, chat_id,
+                                 self.get_message_key(message, 'bet'))
+            else:
+                self.send_message(peer_id, '❌ Номер должен быть от 0 до 36!')
+        except ValueError:
+            # Ставка на тип (чет/нечет/красное/черное)
+            if bet_type in ['чет', 'нечет', 'красное', 'черное']:
+                bet_amount = args[2]
+                self.command_bet(peer_id, user_id, bet_type, bet_amount, None, chat_id,
+                                 self.get_message_key(message, 'bet'))
+            else:
+                self.send_message(peer_id, '❌ Доступные ставки: чет, нечет, красное, черное или число от 0 до 36')
 
-        elif command == 'crash':
-            if len(args) < 3:
-                self.send_message(peer_id, '❌ Использование: /краш [множитель] [сумма]')
-                return
+    def route_bonus(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_bonus(peer_id, user_id)
+
+    def route_crash(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 3:
+            self.send_message(peer_id, '❌ Использование: /краш [множитель] [сумма]')
+            return
 
-            target_multiplier = args[1]
-            bet_amount_str = args[2]
-            self.command_crash(peer_id, user_id, target_multiplier, bet_amount_str, chat_id)
+        target_multiplier = args[1]
+        bet_amount_str = args[2]
+        self.command_crash(peer_id, user_id, target_multiplier, bet_amount_str, chat_id,
+                           self.get_message_key(message, 'crash'))
 
-        elif command == 'dream':
-            if len(args) < 3:
-                self.send_message(peer_id, '❌ Использование: /дрим [множитель] [сумма]')
-                return
+    def route_dream(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 3:
+            self.send_message(peer_id, '❌ Использование: /дрим [множитель] [сумма]')
+            return
 
-            target_multiplier = args[1]
-            bet_amount_str = args[2]
-            self.command_dream(peer_id, user_id, target_multiplier, bet_amount_str, chat_id)
+        target_multiplier = args[1]
+        bet_amount_str = args[2]
+        self.command_dream(peer_id, user_id, target_multiplier, bet_amount_str, chat_id,
+                           self.get_message_key(message, 'dream'))
 
-        elif command == 'add': # Обработка команды add здесь, если она не была обработана выше для создателя
-            if len(args) < 2:
-                self.send_message(peer_id, '❌ Использование: !add [сумма] или !add [@ID] [сумма]')
-                return
+    def route_add(self, args, user_id, username, peer_id, chat_id, message):
+        # Обработка команды add здесь, если она не была обработана выше для создателя
+        if len(args) < 2:
+            self.send_message(peer_id, '❌ Использование: !add [сумма] или !add [@ID] [сумма]')
+            return
 
-            if len(args) == 2:
-                # Установить баланс себе
-                amount = args[1]
-                self.command_add_balance(peer_id, user_id, user_id, amount)
+        if len(args) == 2:
+            # Установить баланс себе
+            amount = args[1]
+            self.command_add_balance(peer_id, user_id, user_id, amount)
+        else:
+            # Установить баланс другому пользователю
+            target_id = self.resolve_user_id(args[1])
+            amount = args[2]
+            if target_id:
+                self.command_add_balance(peer_id, user_id, target_id, amount)
             else:
-                # Установить баланс другому пользователю
-                target_id = self.resolve_user_id(args[1])
-                amount = args[2]
-                if target_id:
-                    self.command_add_balance(peer_id, user_id, target_id, amount)
-                else:
-                    self.send_message(peer_id, '❌ Пользователь не найден!')
+                self.send_message(peer_id, '❌ Пользователь не найден!')
 
-        elif command == 'balance':
-            self.command_balance(peer_id, user_id)
+    def route_balance(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_balance(peer_id, user_id)
 
-        elif command == 'report':
-            text = ' '.join(args[1:])
-            self.command_report(peer_id, user_id, text)
+    def route_report(self, args, user_id, username, peer_id, chat_id, message):
+        text = ' '.join(args[1:])
+        self.command_report(peer_id, user_id, text)
 
-        # Модерационные команды
-        elif command == 'warn':
-            target_id = self.get_target_user_from_command(message, args)
+    # Модерационные команды
+    def route_warn(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
 
-            # Определяем причину в зависимости от способа вызова команды
-            if message.get('reply_message'):
-                # Если это ответ на сообщение: /warn п1.2
-                reason = ' '.join(args[1:]) if len(args) > 1 else ''
-            else:
-                # Если это упоминание: /warn @user п1.2
-                reason = ' '.join(args[2:]) if len(args) > 2 else ''
+        # Определяем причину в зависимости от способа вызова команды
+        if message.get('reply_message'):
+            # Если это ответ на сообщение: /warn п1.2
+            reason = ' '.join(args[1:]) if len(args) > 1 else ''
+        else:
+            # Если это упоминание: /warn @user п1.2
+            reason = ' '.join(args[2:]) if len(args) > 2 else ''
 
-            self.command_warn(peer_id, user_id, target_id, reason, chat_id)
+        self.command_warn(peer_id, user_id, target_id, reason, chat_id)
 
-        elif command == 'kick':
-            target_id = self.get_target_user_from_command(message, args)
+    def route_kick(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
 
-            # Проверяем, указан ли пользователь
-            if not target_id:
-                error_message = """☕️ Аргументы введены неверно. Вы не указали ппользователя для исключения.
+        # Проверяем, указан ли пользователь
+        if not target_id:
+            error_message = """☕️ Аргументы введены неверно. Вы не указали ппользователя для исключения.
 
 ☕️ Примеры использования:
 /kick @user причина
 /kick @user
 /kick - ответом на сообщение"""
-                self.send_message(peer_id, error_message)
-                return
+            self.send_message(peer_id, error_message)
+            return
 
-            reason = ' '.join(args[2:]) if len(args) > 2 else 'Нарушение правил'
-            if message.get('reply_message'):
-                reason = ' '.join(args[1:]) if len(args) > 1 else 'Нарушение правил'
+        reason = ' '.join(args[2:]) if len(args) > 2 else 'Нарушение правил'
+        if message.get('reply_message'):
+            reason = ' '.join(args[1:]) if len(args) > 1 else 'Нарушение правил'
 
-            self.command_kick(peer_id, user_id, target_id, reason, chat_id)
+        self.command_kick(peer_id, user_id, target_id, reason, chat_id)
 
-        elif command == 'ban':
-            target_id = self.get_target_user_from_command(message, args)
+    def route_ban(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
 
-            # Парсим дни и причину
-            days = None
-            reason = 'Серьезное нарушение правил'
+        # Парсим дни и причину
+        days = None
+        reason = 'Серьезное нарушение правил'
 
-            if message.get('reply_message'):
-                # Если ответ на сообщение: /ban [дни] [причина]
-                if len(args) > 1 and args[1].isdigit():
-                    days = int(args[1])
-                    reason = ' '.join(args[2:]) if len(args) > 2 else 'Не указана'
-                elif len(args) > 1:
-                    reason = ' '.join(args[1:])
-            else:
-                # Если упоминание: /ban @user [дни] [причина]
-                if len(args) > 2 and args[2].isdigit():
-                    days = int(args[2])
-                    reason = ' '.join(args[3:]) if len(args) > 3 else 'Не указана'
-                elif len(args) > 2:
-                    reason = ' '.join(args[2:])
-
-            self.command_ban(peer_id, user_id, target_id, reason, chat_id, days)
-
-        elif command == 'mute':
-            target_id = self.get_target_user_from_command(message, args)
-            duration = 60  # по умолчанию 60 минут
-            reason = 'Спам или флуд'
-
-            if message.get('reply_message'):
-                if len(args) > 1 and args[1].isdigit():
-                    duration = int(args[1])
-                if len(args) > 2:
-                    reason = ' '.join(args[2:])
-            else:
-                if len(args) > 2 and args[2].isdigit():
-                    duration = int(args[2])
-                if len(args) > 3:
-                    reason = ' '.join(args[3:])
+        if message.get('reply_message'):
+            # Если ответ на сообщение: /ban [дни] [причина]
+            if len(args) > 1 and args[1].isdigit():
+                days = int(args[1])
+                reason = ' '.join(args[2:]) if len(args) > 2 else 'Не указана'
+            elif len(args) > 1:
+                reason = ' '.join(args[1:])
+        else:
+            # Если упоминание: /ban @user [дни] [причина]
+            if len(args) > 2 and args[2].isdigit():
+                days = int(args[2])
+                reason = ' '.join(args[3:]) if len(args) > 3 else 'Не указана'
+            elif len(args) > 2:
+                reason = ' '.join(args[2:])
+
+        self.command_ban(peer_id, user_id, target_id, reason, chat_id, days)
+
+    def route_mute(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        duration = 60  # по умолчанию 60 минут
+        reason = 'Спам или флуд'
+
+        if message.get('reply_message'):
+            if len(args) > 1 and args[1].isdigit():
+                duration = int(args[1])
+            if len(args) > 2:
+                reason = ' '.join(args[2:])
+        else:
+            if len(args) > 2 and args[2].isdigit():
+                duration = int(args[2])
+            if len(args) > 3:
+                reason = ' '.join(args[3:])
 
-            self.command_mute(peer_id, user_id, target_id, duration, reason, chat_id)
+        self.command_mute(peer_id, user_id, target_id, duration, reason, chat_id)
 
-        elif command == 'unmute':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_unmute(peer_id, user_id, target_id, chat_id)
+    def route_unmute(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_unmute(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'unban':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_unban(peer_id, user_id, target_id, chat_id)
+    def route_unban(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_unban(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'newrole':
-            if len(args) < 3:
-                self.send_message(peer_id, '⛔️ Отказано! /newrole [приоретет] [название]')
-                return
+    def route_newrole(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 3:
+            self.send_message(peer_id, '⛔️ Отказано! /newrole [приоретет] [название]')
+            return
 
-            role_level = args[1]
-            role_name = ' '.join(args[2:])
+        role_level = args[1]
+        role_name = ' '.join(args[2:])
 
-            self.command_newrole(peer_id, user_id, None, role_level, role_name, chat_id)
+        self.command_newrole(peer_id, user_id, None, role_level, role_name, chat_id)
 
-        elif command == 'stats':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_stats(peer_id, user_id, target_id, chat_id)
+    def route_stats(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_stats(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'online':
-            self.command_online(peer_id, chat_id)
+    def route_online(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_online(peer_id, chat_id)
 
-        elif command == 'staff':
-            self.command_staff(peer_id, chat_id)
+    def route_staff(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_staff(peer_id, chat_id)
 
-        elif command == 'unwarn':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_unwarn(peer_id, user_id, target_id, chat_id)
+    def route_unwarn(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_unwarn(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'getwarn':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_getwarn(peer_id, target_id)
+    def route_getwarn(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_getwarn(peer_id, target_id)
 
-        elif command == 'getreport':
-            self.command_getreport(peer_id, user_id)
+    def route_getreport(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_getreport(peer_id, user_id)
 
-        elif command == 'helper':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_helper(peer_id, user_id, target_id, chat_id)
+    def route_helper(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_helper(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'gm':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_gm(peer_id, user_id, target_id, chat_id)
+    def route_gm(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_gm(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'gms':
-            self.command_gms(peer_id, chat_id)
+    def route_gms(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_gms(peer_id, chat_id)
 
-        elif command == 'grm':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_grm(peer_id, user_id, target_id, chat_id)
+    def route_grm(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_grm(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'banlist':
-            self.command_banlist(peer_id, chat_id)
+    def route_banlist(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_banlist(peer_id, chat_id)
 
-        elif command == 'top':
-            self.command_top(peer_id)
+    def route_top(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_top(peer_id)
 
-        elif command == 'mtop':
-            self.command_mtop(peer_id)
+    def route_mtop(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_mtop(peer_id)
 
-        elif command == 'sysadmins':
-            self.command_sysadmins(peer_id, user_id)
+    def route_sysadmins(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_sysadmins(peer_id, user_id)
 
-        elif command == 'broadcast':
-            text = ' '.join(args[1:])
-            self.command_broadcast(peer_id, user_id, text)
+    def route_broadcast(self, args, user_id, username, peer_id, chat_id, message):
+        text = ' '.join(args[1:])
+        self.command_broadcast(peer_id, user_id, text)
 
-        elif command == 'answer':
-            if len(args) < 3:
-                self.send_message(peer_id, '❌ Использование: /answer [ID] [ответ]')
-                return
+    def route_bstatus(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_broadcast_status(peer_id, user_id, args[1:])
 
-            ticket_id = args[1]
-            answer = ' '.join(args[2:])
-            self.command_answer(peer_id, user_id, ticket_id, answer)
+    def route_perf(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_perf(peer_id, user_id, args[1:])
 
-        elif command == 'settoken':
-            self.command_settoken(peer_id)
+    def route_reload(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_reload(peer_id, user_id)
 
-        elif command == 'silence':
-            self.command_silence(peer_id, user_id, chat_id)
+    def route_answer(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 3:
+            self.send_message(peer_id, '❌ Использование: /answer [ID] [ответ]')
+            return
 
-        elif command == 'getbynick':
-            nickname = ' '.join(args[1:])
-            self.command_getbynick(peer_id, nickname)
+        ticket_id = args[1]
+        answer = ' '.join(args[2:])
+        self.command_answer(peer_id, user_id, ticket_id, answer)
 
-        elif command == 'warnhistory':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_warnhistory(peer_id, target_id)
+    def route_settoken(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_settoken(peer_id)
 
-        elif command == 'warnlist':
-            self.command_warnlist(peer_id, chat_id)
+    def route_silence(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_silence(peer_id, user_id, chat_id)
 
-        elif command == 'mutelist':
-            self.command_mutelist(peer_id, chat_id)
+    def route_getbynick(self, args, user_id, username, peer_id, chat_id, message):
+        nickname = ' '.join(args[1:])
+        self.command_getbynick(peer_id, nickname)
 
-        elif command == 'getban':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_getban(peer_id, target_id, chat_id)
+    def route_warnhistory(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_warnhistory(peer_id, target_id)
 
-        elif command == 'getnick':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_getnick(peer_id, target_id, chat_id)
+    def route_warnlist(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_warnlist(peer_id, chat_id)
 
-        elif command == 'setnick':
-            target_id = self.get_target_user_from_command(message, args)
+    def route_mutelist(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_mutelist(peer_id, chat_id)
 
-            # Определяем никнейм в зависимости от способа вызова команды
-            if message.get('reply_message'):
-                # Если это ответ на сообщение: /snick Никнейм
-                nickname = ' '.join(args[1:]) if len(args) > 1 else ''
-            else:
-                # Если это упоминание: /snick @user Никнейм
-                nickname = ' '.join(args[2:]) if len(args) > 2 else ''
+    def route_getban(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_getban(peer_id, target_id, chat_id)
 
-            self.command_setnick(peer_id, user_id, target_id, nickname, chat_id)
+    def route_getnick(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_getnick(peer_id, target_id, chat_id)
 
-        elif command == 'removenick':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_removenick(peer_id, user_id, target_id, chat_id)
+    def route_setnick(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
 
-        elif command == 'nicknames':
-            self.command_nicknames(peer_id, chat_id)
+        # Определяем никнейм в зависимости от способа вызова команды
+        if message.get('reply_message'):
+            # Если это ответ на сообщение: /snick Никнейм
+            nickname = ' '.join(args[1:]) if len(args) > 1 else ''
+        else:
+            # Если это упоминание: /snick @user Никнейм
+            nickname = ' '.join(args[2:]) if len(args) > 2 else ''
 
-        elif command == 'nonames':
-            self.command_nonames(peer_id, chat_id)
+        self.command_setnick(peer_id, user_id, target_id, nickname, chat_id)
 
-        elif command == 'zov':
-            text = ' '.join(args[1:])
-            self.command_zov(peer_id, user_id, text, chat_id)
+    def route_removenick(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_removenick(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'reg':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_reg(peer_id, target_id)
+    def route_nicknames(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_nicknames(peer_id, chat_id)
 
-        elif command == 'checknicks':
-            self.command_checknicks(peer_id, user_id)
+    def route_nonames(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_nonames(peer_id, chat_id)
 
-        elif command == 'chatinfo':
-            self.command_chatinfo(peer_id, chat_id)
+    def route_zov(self, args, user_id, username, peer_id, chat_id, message):
+        text = ' '.join(args[1:])
+        self.command_zov(peer_id, user_id, text, chat_id)
 
-        elif command == 'moder':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_moder(peer_id, user_id, target_id, chat_id)
+    def route_reg(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_reg(peer_id, target_id)
 
-        elif command == 'admin':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_admin(peer_id, user_id, target_id, chat_id)
+    def route_checknicks(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_checknicks(peer_id, user_id)
 
-        elif command == 'owner':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_owner(peer_id, user_id, target_id, chat_id)
+    def route_chatinfo(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_chatinfo(peer_id, chat_id)
 
-        elif command == 'removerole':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_removerole(peer_id, user_id, target_id, chat_id)
+    def route_moder(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_moder(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'delete':
-            self.command_delete(peer_id, user_id, message, chat_id)
+    def route_admin(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_admin(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'gkick':
-            target_id = self.get_target_user_from_command(message, args)
-            reason = ' '.join(args[2:]) if len(args) > 2 else 'Нарушение правил'
-            self.command_gkick(peer_id, user_id, target_id, reason, chat_id)
+    def route_owner(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_owner(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'logs':
-            page = int(args[1]) if len(args) > 1 else 1
-            self.command_logs(peer_id, chat_id, page)
+    def route_removerole(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_removerole(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'gsetnick':
-            target_id = self.get_target_user_from_command(message, args)
-            nickname = ' '.join(args[2:]) if len(args) > 2 else None
-            self.command_gsetnick(peer_id, user_id, target_id, nickname, chat_id)
+    def route_delete(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_delete(peer_id, user_id, message, chat_id)
 
-        elif command == 'gremovenick':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_gremovenick(peer_id, user_id, target_id, chat_id)
+    def route_gkick(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        reason = ' '.join(args[2:]) if len(args) > 2 else 'Нарушение правил'
+        self.command_gkick(peer_id, user_id, target_id, reason, chat_id)
 
-        elif command == 'gzov':
-            message_text = ' '.join(args[1:]) if len(args) > 1 else ''
-            self.command_gzov(peer_id, user_id, message_text, chat_id)
+    def route_logs(self, args, user_id, username, peer_id, chat_id, message):
+        page = int(args[1]) if len(args) > 1 else 1
+        self.command_logs(peer_id, chat_id, page)
 
-        elif command == 'gban':
-            target_id = self.get_target_user_from_command(message, args)
-            reason = ' '.join(args[2:]) if len(args) > 2 else 'Нарушение правил'
-            self.command_gban(peer_id, user_id, target_id, reason, chat_id)
+    def route_gsetnick(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        nickname = ' '.join(args[2:]) if len(args) > 2 else None
+        self.command_gsetnick(peer_id, user_id, target_id, nickname, chat_id)
 
-        elif command == 'gunban':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_gunban(peer_id, user_id, target_id, chat_id)
+    def route_gremovenick(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_gremovenick(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'filter':
-            self.command_filter(peer_id, user_id, args, chat_id)
+    def route_gzov(self, args, user_id, username, peer_id, chat_id, message):
+        message_text = ' '.join(args[1:]) if len(args) > 1 else ''
+        self.command_gzov(peer_id, user_id, message_text, chat_id)
 
-        elif command == 'settings':
-            self.command_settings(peer_id, user_id, chat_id)
+    def route_gban(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        reason = ' '.join(args[2:]) if len(args) > 2 else 'Нарушение правил'
+        self.command_gban(peer_id, user_id, target_id, reason, chat_id)
 
-        elif command == 'rr':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_rr(peer_id, user_id, target_id, chat_id)
+    def route_gunban(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_gunban(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'gnewrole':
-            if len(args) < 3:
-                self.send_message(peer_id, '⛔️ Отказано! Использование: /gnewrole [приоритет] [название]')
-                return
+    def route_filter(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_filter(peer_id, user_id, args, chat_id)
 
-            role_level = args[1]
-            role_name = ' '.join(args[2:])
-            self.command_gnewrole(peer_id, user_id, role_level, role_name, chat_id)
+    def route_settings(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_settings(peer_id, user_id, chat_id)
 
-        elif command == 'gsetrole':
-            target_id = self.get_target_user_from_command(message, args)
-            if message.get('reply_message'):
-                role_level = args[1] if len(args) >= 2 else None
-            else:
-                role_level = args[2] if len(args) >= 3 else None
-            self.command_gsetrole(peer_id, user_id, target_id, role_level, chat_id)
+    def route_rr(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_rr(peer_id, user_id, target_id, chat_id)
 
-        elif command == 'pin':
-            self.command_pin(peer_id, user_id, message, chat_id)
+    def route_gnewrole(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 3:
+            self.send_message(peer_id, '⛔️ Отказано! Использование: /gnewrole [приоритет] [название]')
+            return
 
-        elif command == 'unpin':
-            self.command_unpin(peer_id, user_id, chat_id)
+        role_level = args[1]
+        role_name = ' '.join(args[2:])
+        self.command_gnewrole(peer_id, user_id, role_level, role_name, chat_id)
 
-        elif command == 'role':
-            target_id = self.get_target_user_from_command(message, args)
+    def route_gsetrole(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        if message.get('reply_message'):
+            role_level = args[1] if len(args) >= 2 else None
+        else:
+            role_level = args[2] if len(args) >= 3 else None
+        self.command_gsetrole(peer_id, user_id, target_id, role_level, chat_id)
 
-            # Определяем где находится уровень/название роли
-            if message.get('reply_message'):
-                # Если ответ на сообщение: /role 10 или /role Администратор
-                role_level = args[1] if len(args) >= 2 else None
-            else:
-                # Если через упоминание: /role @user 10 или /role @user Администратор
-                role_level = args[2] if len(args) >= 3 else None
+    def route_pin(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_pin(peer_id, user_id, message, chat_id)
 
-            self.command_role(peer_id, user_id, target_id, role_level, chat_id)
+    def route_unpin(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_unpin(peer_id, user_id, chat_id)
 
-        elif command == 'delrole':
-            if len(args) < 2:
-                self.send_message(peer_id, 'Отказано! Необходимо указать роль /delrole [уровень]')
-                return
+    def route_role(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
 
-            role_level = args[1]
-            self.command_delrole(peer_id, user_id, role_level, chat_id)
+        # Определяем где находится уровень/название роли
+        if message.get('reply_message'):
+            # Если ответ на сообщение: /role 10 или /role Администратор
+            role_level = args[1] if len(args) >= 2 else None
+        else:
+            # Если через упоминание: /role @user 10 или /role @user Администратор
+            role_level = args[2] if len(args) >= 3 else None
 
-        elif command == 'gdelrole':
-            if len(args) < 2:
-                self.send_message(peer_id, '❌ Использование: /gdelrole [уровень]')
-                return
+        self.command_role(peer_id, user_id, target_id, role_level, chat_id)
 
-            role_level = args[1]
-            self.command_gdelrole(peer_id, user_id, role_level)
+    def route_delrole(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 2:
+            self.send_message(peer_id, 'Отказано! Необходимо указать роль /delrole [уровень]')
+            return
 
-        elif command == 'welcome':
-            text = ' '.join(args[1:])
-            self.command_welcome(peer_id, user_id, text, chat_id)
+        role_level = args[1]
+        self.command_delrole(peer_id, user_id, role_level, chat_id)
 
-        elif command == 'setrules':
-            text = ' '.join(args[1:])
-            self.command_setrules(peer_id, user_id, text, chat_id)
+    def route_gdelrole(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 2:
+            self.send_message(peer_id, '❌ Использование: /gdelrole [уровень]')
+            return
 
-        elif command == 'inactive':
-            if len(args) < 2:
-                self.send_message(peer_id, '❌ Использование: /inactive [дни]')
-                return
+        role_level = args[1]
+        self.command_gdelrole(peer_id, user_id, role_level)
 
-            days = args[1]
-            self.command_inactive(peer_id, user_id, days, chat_id)
+    def route_welcome(self, args, user_id, username, peer_id, chat_id, message):
+        text = ' '.join(args[1:])
+        self.command_welcome(peer_id, user_id, text, chat_id)
 
-        elif command == 'initadmin':
-            self.command_initadmin(peer_id, user_id)
+    def route_setrules(self, args, user_id, username, peer_id, chat_id, message):
+        text = ' '.join(args[1:])
+        self.command_setrules(peer_id, user_id, text, chat_id)
 
-        # Команда convert
-        elif command == 'convert':
-            if len(args) < 2:
-                self.send_message(peer_id, '❌ Использование: /перевед [число]')
-                return
+    def route_inactive(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 2:
+            self.send_message(peer_id, '❌ Использование: /inactive [дни]')
+            return
 
-            number = args[1]
-            converted = self.convert_number_to_short(number)
-            if converted:
-                self.send_message(peer_id, f'🔢 {number} → {converted}')
-            else:
-                self.send_message(peer_id, '❌ Неверное число')
+        days = args[1]
+        self.command_inactive(peer_id, user_id, days, chat_id)
 
-        # Команда transfer
-        elif command == 'transfer':
-            if len(args) < 2:
-                self.send_message(peer_id, '❌ Использование: /перевод [сумма] [ID] или ответьте на сообщение')
-                return
+    def route_initadmin(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_initadmin(peer_id, user_id)
 
-            # Получаем сумму
-            balance_data = self.db.get_user_balance(user_id)
-            user_balance = balance_data['balance']
+    # Команда convert
+    def route_convert(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 2:
+            self.send_message(peer_id, '❌ Использование: /перевед [число]')
+            return
 
-            transfer_amount = self.parse_amount(args[1], user_balance)
-            if transfer_amount is None or transfer_amount <= 0:
-                self.send_message(peer_id, '❌ Неверная сумма для перевода!')
-                return
+        number = args[1]
+        converted = self.convert_number_to_short(number)
+        if converted:
+            self.send_message(peer_id, f'🔢 {number} → {converted}')
+        else:
+            self.send_message(peer_id, '❌ Неверное число')
 
-            # Получаем получателя
-            target_id = self.get_target_user_from_command(message, args, 2)
-            if not target_id:
-                self.send_message(peer_id, 'Отказано! Укажите получателя: ответьте на сообщение или укажите пользователя')
-                return
+    # Команда transfer
+    def route_transfer(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 2:
+            self.send_message(peer_id, '❌ Использование: /перевод [сумма] [ID] или ответьте на сообщение')
+            return
 
-            if target_id == user_id:
-                self.send_message(peer_id, '❌ Нельзя переводить деньги самому себе!')
-                return
+        # Получаем сумму
+        balance_data = self.db.get_user_balance(user_id)
+        user_balance = balance_data['balance']
 
-            # Выполняем перевод
-            success, message_text = self.db.transfer_balance(user_id, target_id, transfer_amount)
+        transfer_amount = self.parse_amount(args[1], user_balance)
+        if transfer_amount is None or transfer_amount <= 0:
+            self.send_message(peer_id, '❌ Неверная сумма для перевода!')
+            return
 
-            if success:
-                sender_info = self.get_user_info(user_id)
-                target_info = self.get_user_info(target_id)
-                sender_name = sender_info['screen_name'] if sender_info else str(user_id)
-                target_name = target_info['screen_name'] if target_info else str(target_id)
+        # Получаем получателя
+        target_id = self.get_target_user_from_command(message, args, 2)
+        if not target_id:
+            self.send_message(peer_id, 'Отказано! Укажите получателя: ответьте на сообщение или укажите пользователя')
+            return
+
+        if target_id == user_id:
+            self.send_message(peer_id, '❌ Нельзя переводить деньги самому себе!')
+            return
+
+        # Выполняем перевод
+        success, message_text = self.db.transfer_balance(user_id, target_id, transfer_amount,
+                                                         self.get_message_key(message, 'transfer'))
+
+        if success:
+            sender_info = self.get_user_info(user_id)
+            target_info = self.get_user_info(target_id)
+            sender_name = sender_info['screen_name'] if sender_info else str(user_id)
+            target_name = target_info['screen_name'] if target_info else str(target_id)
 
-                # Форматируем сумму для отображения
-                amount_display = self.convert_number_to_short(transfer_amount) or f"{transfer_amount:,}"
+            # Форматируем сумму для отображения
+            amount_display = self.convert_number_to_short(transfer_amount) or f"{transfer_amount:,}"
 
-                transfer_text = f"""💸 ПЕРЕВОД ВЫПОЛНЕН
+            transfer_text = f"""💸 ПЕРЕВОД ВЫПОЛНЕН
 
 📤 От: @{sender_name}
 📥 Кому: @{target_name}
@@ -7447,158 +10621,155 @@ def command_giveowner(self, peer_id, sender_id, target_id):
 
 ✅ Перевод успешно завершен!"""
 
-                self.send_message(peer_id, transfer_text)
-                self.log(f"Перевод {transfer_amount}$ от {sender_name} к {target_name}")
-            else:
-                self.send_message(peer_id, f'❌ {message_text}')
+            self.send_message(peer_id, transfer_text)
+            self.log(f"Перевод {transfer_amount}$ от {sender_name} к {target_name}")
+        else:
+            self.send_message(peer_id, f'❌ {message_text}')
 
-        elif command == 'dice':
-            dice_args = args[1:] if len(args) > 1 else []
-            self.command_dice(peer_id, user_id, dice_args, chat_id)
+    def route_dice(self, args, user_id, username, peer_id, chat_id, message):
+        dice_args = args[1:] if len(args) > 1 else []
+        self.command_dice(peer_id, user_id, dice_args, chat_id, self.get_message_key(message, 'dice'))
 
-        # Системные команды
-        elif command == 'ahelp':
-            self.command_ahelp(peer_id, user_id)
+    # Системные команды
+    def route_ahelp(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_ahelp(peer_id, user_id)
 
-        elif command == 'sysadmins':
-            self.command_sysadmins(peer_id)
+    def route_giveagent(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_giveagent(peer_id, user_id, target_id)
 
-        elif command == 'giveagent':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_giveagent(peer_id, user_id, target_id)
+    def route_giveadm(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_giveadm(peer_id, user_id, target_id)
 
-        elif command == 'giveadm':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_giveadm(peer_id, user_id, target_id)
+    def route_givezam(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_givezam(peer_id, user_id, target_id)
 
-        elif command == 'givezam':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_givezam(peer_id, user_id, target_id)
+    def route_giveowner(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_giveowner(peer_id, user_id, target_id)
 
-        elif command == 'giveowner':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_giveowner(peer_id, user_id, target_id)
+    def route_null(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_null(peer_id, user_id, target_id)
 
-        elif command == 'null':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_null(peer_id, user_id, target_id)
+    def route_sysban(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        if len(args) < 3:
+            self.send_message(peer_id, '❌ Использование: /sysban [ID] [дни] [причина]')
+            return
 
-        elif command == 'sysban':
-            target_id = self.get_target_user_from_command(message, args)
-            if len(args) < 3:
-                self.send_message(peer_id, '❌ Использование: /sysban [ID] [дни] [причина]')
-                return
+        days = args[2] if not message.get('reply_message') else args[1]
+        reason = ' '.join(args[3:]) if not message.get('reply_message') else ' '.join(args[2:])
 
-            days = args[2] if not message.get('reply_message') else args[1]
-            reason = ' '.join(args[3:]) if not message.get('reply_message') else ' '.join(args[2:])
+        if not reason:
+            reason = "Нарушение правил системы"
 
-            if not reason:
-                reason = "Нарушение правил системы"
+        self.command_sysban(peer_id, user_id, target_id, days, reason)
 
-            self.command_sysban(peer_id, user_id, target_id, days, reason)
+    def route_unsysban(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        self.command_unsysban(peer_id, user_id, target_id)
 
-        elif command == 'unsysban':
-            target_id = self.get_target_user_from_command(message, args)
-            self.command_unsysban(peer_id, user_id, target_id)
+    def route_sysrole(self, args, user_id, username, peer_id, chat_id, message):
+        target_id = self.get_target_user_from_command(message, args)
+        if len(args) < 3:
+            self.send_message(peer_id, '❌ Использование: /sysrole [ID] [уровень]')
+            return
 
-        elif command == 'sysrole':
-            target_id = self.get_target_user_from_command(message, args)
-            if len(args) < 3:
-                self.send_message(peer_id, '❌ Использование: /sysrole [ID] [уровень]')
-                return
+        role_level = args[2] if not message.get('reply_message') else args[1]
+        self.command_sysrole(peer_id, user_id, target_id, role_level, chat_id)
 
-            role_level = args[2] if not message.get('reply_message') else args[1]
-            self.command_sysrole(peer_id, user_id, target_id, role_level, chat_id)
+    def route_tickets(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_tickets(peer_id, user_id)
 
-        elif command == 'tickets':
-            self.command_tickets(peer_id, user_id)
+    def route_q(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_q(peer_id, user_id, chat_id)
 
-        elif command == 'q':
-            self.command_q(peer_id, user_id, chat_id)
+    def route_chatid(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_chatid(peer_id, chat_id)
 
-        elif command == 'chatid':
-            self.command_chatid(peer_id, chat_id)
+    def route_editcmd(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 3:
+            self.send_message(peer_id, '❌ /editcmd [команда] [приоритет]')
+            return
 
-        elif command == 'editcmd':
-            if len(args) < 3:
-                self.send_message(peer_id, '❌ /editcmd [команда] [приоритет]')
-                return
+        cmd = args[1]
+        level = args[2]
+        self.command_editcmd(peer_id, user_id, cmd, level, chat_id)
 
-            cmd = args[1]
-            level = args[2]
-            self.command_editcmd(peer_id, user_id, cmd, level, chat_id)
+    def route_pull(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 2:
+            self.send_message(peer_id, '❌ /pull [ключ объединения]')
+            return
 
-        elif command == 'pull':
-            if len(args) < 2:
-                self.send_message(peer_id, '❌ /pull [ключ объединения]')
-                return
+        union_key = args[1]
+        self.command_pull(peer_id, user_id, union_key, chat_id)
 
-            union_key = args[1]
-            self.command_pull(peer_id, user_id, union_key, chat_id)
+    def route_newpull(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 2:
+            self.send_message(peer_id, '❌ /newpull [название объединения]')
+            return
 
-        elif command == 'newpull':
-            if len(args) < 2:
-                self.send_message(peer_id, '❌ /newpull [название объединения]')
-                return
+        union_name = ' '.join(args[1:])
+        self.command_pull(peer_id, user_id, union_name, chat_id)
 
-            union_name = ' '.join(args[1:])
-            self.command_pull(peer_id, user_id, union_name, chat_id)
+    def route_pullinfo(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_pullinfo(peer_id, user_id, chat_id)
 
-        elif command == 'pullinfo':
-            self.command_pullinfo(peer_id, user_id, chat_id)
+    def route_pulldel(self, args, user_id, username, peer_id, chat_id, message):
+        self.command_pulldel(peer_id, user_id, chat_id)
 
-        elif command == 'pulldel':
-            self.command_pulldel(peer_id, user_id, chat_id)
+    def route_wipe(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 2:
+            self.send_message(peer_id, '❌ Использование: /wipe [bans|warn|nick|roles]')
+            return
 
-        elif command == 'wipe':
-            if len(args) < 2:
-                self.send_message(peer_id, '❌ Использование: /wipe [bans|warn|nick|roles]')
-                return
+        wipe_type = args[1].lower()
+        self.command_wipe(peer_id, user_id, wipe_type, chat_id)
 
-            wipe_type = args[1].lower()
-            self.command_wipe(peer_id, user_id, wipe_type, chat_id)
+    def route_ai(self, args, user_id, username, peer_id, chat_id, message):
+        question = ' '.join(args[1:])
+        self.command_ai(peer_id, user_id, question)
 
-        elif command == 'ai':
-            question = ' '.join(args[1:])
-            self.command_ai(peer_id, user_id, question)
+    def route_piar(self, args, user_id, username, peer_id, chat_id, message):
+        if len(args) < 2:
+            self.send_message(peer_id, '❌ Использование: /piar [текст] [минуты]\n💡 Или /piar стоп для остановки')
+            return
 
-        elif command == 'piar':
-            if len(args) < 2:
-                self.send_message(peer_id, '❌ Использование: /piar [текст] [минуты]\n💡 Или /piar стоп для остановки')
-                return
+        # Проверка на команду "стоп"
+        if args[1].lower() in ['стоп', 'stop', 'остановить']:
+            self.command_piar(peer_id, user_id, '', 0, chat_id)
+            return
 
-            # Проверка на команду "стоп"
-            if args[1].lower() in ['стоп', 'stop', 'остановить']:
-                self.command_piar(peer_id, user_id, '', 0, chat_id)
-                return
+        # Ищем число в конце аргументов
+        interval_minutes = 5  # По умолчанию 5 минут
+        text_parts = args[1:]
 
-            # Ищем число в конце аргументов
-            interval_minutes = 5  # По умолчанию 5 минут
-            text_parts = args[1:]
+        # Проверяем последний аргумент на число
+        if text_parts[-1].isdigit():
+            interval_minutes = int(text_parts[-1])
+            text = ' '.join(text_parts[:-1])
+        else:
+            text = ' '.join(text_parts)
 
-            # Проверяем последний аргумент на число
-            if text_parts[-1].isdigit():
-                interval_minutes = int(text_parts[-1])
-                text = ' '.join(text_parts[:-1])
-            else:
-                text = ' '.join(text_parts)
+        self.command_piar(peer_id, user_id, text, interval_minutes, chat_id)
 
-            self.command_piar(peer_id, user_id, text, interval_minutes, chat_id)
 
-        else:
-            # Ищем похожие команды
-            similar = self.get_similar_commands(original_command)
-            if similar:
-                similar_text = ', '.join(similar)
-                self.send_message(peer_id, f'🤔 Команда "/{original_command}" не найдена. Возможно, вы имели в виду: {similar_text}')
-            else:
-                self.send_message(peer_id, f'❌ Команда "/{original_command}" не найдена.')
+    def process_message(self, event):
+        """Обработчик события Long Poll; каждое событие — отдельная трасса (см. LatencyTracer).
 
+        Повторы VK-вызовов внутри обработчика ограничены vk_handler_retry_budget секундами,
+        чтобы чат под flood control не держал воркер, обслуживающий и другие чаты."""
+        with self.tracer.trace(event.get('type', 'unknown')), self.retry_budget(self.handler_retry_budget):
+            self.dispatch_event(event)
 
-    def process_message(self, event):
+    def dispatch_event(self, event):
         # Обработка callback-событий от inline-кнопок
         if event['type'] == 'message_event':
-            self.handle_callback(event)
+            with self.tracer.span('handle_callback'):
+                self.handle_callback(event)
             return
 
         # Обработка события добавления бота в беседу
@@ -7612,19 +10783,34 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                 chat_id = peer_id - 2000000000 if peer_id > 2000000000 else None
 
                 if chat_id:
+                    self.member_cache.invalidate(chat_id)
                     self.handle_bot_invited_to_chat(peer_id, chat_id)
                 return
 
             # Проверяем, был ли пользователь добавлен в беседу
-            if action.get('type') == 'chat_invite_user':
-                invited_user_id = action.get('member_id')
+            if action.get('type') in ('chat_invite_user', 'chat_invite_user_by_link'):
+                invited_user_id = action.get('member_id') or message.get('from_id')
                 peer_id = message.get('peer_id')
                 chat_id = peer_id - 2000000000 if peer_id > 2000000000 else None
 
+                if invited_user_id and chat_id:
+                    self.member_cache.add_member(chat_id, invited_user_id, message.get('from_id'))
                 if invited_user_id and invited_user_id > 0 and chat_id:
                     self.check_user_ban_on_invite(peer_id, chat_id, invited_user_id)
                 return
 
+            # Участник вышел или был исключен: правим кэш состава
+            if action.get('type') == 'chat_kick_user':
+                peer_id = message.get('peer_id')
+                chat_id = peer_id - 2000000000 if peer_id > 2000000000 else None
+
+                if chat_id:
+                    if action.get('member_id') == -self.group_id:
+                        self.member_cache.invalidate(chat_id)
+                    else:
+                        self.member_cache.remove_member(chat_id, action.get('member_id'))
+                return
+
         if event['type'] != 'message_new':
             return
 
@@ -7683,8 +10869,9 @@ def command_giveowner(self, peer_id, sender_id, target_id):
 
             # Проверка на запрещенные слова
             try:
-                filtered_word = self.db.check_message_for_filtered_words(chat_id, text)
-                if filtered_word:
+                filtered_words = self.db.find_filtered_words(chat_id, text)
+                if filtered_words:
+                    filtered_word = ', '.join(filtered_words)
                     # Сообщение содержит запрещенное слово, пытаемся удалить его
                     message_id = message.get('conversation_message_id')
                     if message_id:
@@ -7709,15 +10896,18 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                 self.log(f"Ошибка проверки фильтра слов: {e}")
 
         # Получаем информацию о пользователе
-        user_info = self.get_user_info(user_id)
+        with self.tracer.span('get_user_info'):
+            user_info = self.get_user_info(user_id)
         username = user_info['screen_name'] if user_info else str(user_id)
 
         # Обработка команд
         if text.startswith(('/', '!')):
-            self.handle_command(text, user_id, username, peer_id, chat_id, message)
+            with self.tracer.span('handle_command'):
+                self.handle_command(text, user_id, username, peer_id, chat_id, message)
         else:
             # Обработка команд без слэша (краш и ставка)
-            self.handle_commands_without_slash(text, user_id, username, peer_id, chat_id, message)
+            with self.tracer.span('commands_without_slash'):
+                self.handle_commands_without_slash(text, user_id, username, peer_id, chat_id, message)
 
 
     def handle_commands_without_slash(self, text, user_id, username, peer_id, chat_id, message):
@@ -7805,20 +10995,13 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                 self.send_message(peer_id, '❌ Игра уже началась или была отменена!')
                 return
 
-            # Отменяем игру
-            self.db.cancel_dice_game(game_id)
-
-            # Возвращаем ставки
-            players = self.db.get_dice_players(game_id)
-            self.db.update_user_balance(game['creator_id'], game['bet_amount'])
-            for player in players:
-                self.db.update_user_balance(player['user_id'], game['bet_amount'])
+            # Отменяем игру и возвращаем ставки одной транзакцией
+            if not self.db.refund_dice_game(game_id):
+                self.send_message(peer_id, '❌ Игра уже началась или была отменена!')
+                return
 
             # Отменяем таймер
-            global DICE_TIMERS
-            if game_id in DICE_TIMERS:
-                DICE_TIMERS[game_id].cancel()
-                del DICE_TIMERS[game_id]
+            self.scheduler.cancel(f"dice:{game_id}")
 
             amount_display = self.format_number(game['bet_amount'])
             self.send_message(peer_id, f'❌ Игра в кости №{game_id} отменена создателем. Ставки ({amount_display}$) возвращены всем участникам.')
@@ -7889,6 +11072,11 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                     })
                 })
 
+            elif action == 'list_page':
+                # Листание постраничных списков (banlist, nicknames, staff и др.)
+                self.handle_list_page(event_id, user_id, peer_id, chat_id,
+                                      event_data.get('conversation_message_id'), payload)
+
             elif action == 'ban_forever':
                 # Обработка бана навсегда
                 target_user_id = payload.get('user_id')
@@ -8048,7 +11236,7 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                     self.log("Сервер Long Poll не инициализирован")
                     break
 
-                response = requests.get(self.server, params=params, timeout=30)
+                response = self.http.get(self.server, params=params, timeout=30)
                 data = response.json()
 
                 if 'failed' in data:
@@ -8062,9 +11250,13 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                 if 'updates' in data:
                     if data['updates']:
                         self.log(f"Получено событий: {len(data['updates'])}")
+                    self.schedule_prefetch_user_infos(data['updates'])
+                    dropped_before = self.dispatcher.dropped
                     for update in data['updates']:
                         self.log(f"Обработка события: {update.get('type', 'unknown')}")
-                        threading.Thread(target=self.process_message, args=(update,)).start()
+                        self.dispatcher.submit(update)
+                    if self.dispatcher.dropped != dropped_before:
+                        self.log(f"Статистика диспетчера: {self.dispatcher.get_stats()}")
 
                 self.ts = data['ts']
 
@@ -8072,6 +11264,10 @@ def command_giveowner(self, peer_id, sender_id, target_id):
                 self.log(f"Ошибка в главном цикле: {e}")
                 time.sleep(5)
 
+    def run_async(self):
+        """Запуск бота в асинхронном режиме (нужен aiohttp)"""
+        asyncio.run(AsyncVKRuntime(self).run())
+
     def convert_number_to_short(self, number_str):
         """
         Конвертирует числовую строку в короткий формат (например, 1000000 -> 1кк).
@@ -8089,10 +11285,235 @@ def command_giveowner(self, peer_id, sender_id, target_id):
         except ValueError:
             return None
 
+class CasinoSimulator:
+    """Офлайн-модель экономики казино: RTP, разброс выплат, эмиссия бонусов и скорость расчета.
+
+    Распределения берутся из тех же таблиц, что и игры в боте, поэтому отчет не расходится
+    с реальными раундами. Запуск: python Rolekh.py simulate [число раундов]."""
+
+    CRASH_TARGETS = (1.01, 1.5, 2.0, 3.0, 5.0, 10.0, 50.0, 100.0, 500.0)
+    # Размеры игры, которые допускает command_dice: 2 по умолчанию, 3 или 4 по выбору создателя
+    DICE_PLAYERS = (2, 3, 4)
+
+    def __init__(self, rounds=1000000, seed=None, bonus_users=1000, bonus_days=30):
+        if np is None:
+            raise RuntimeError("Для симуляции установите пакет numpy")
+        self.rounds = int(rounds)
+        self.rng = np.random.default_rng(seed)
+        self.bonus_users = bonus_users
+        self.bonus_days = bonus_days
+
+    def sample_multipliers(self, tiers, size, decimals=None):
+        """Векторный аналог sample_multiplier: size множителей за один проход"""
+        thresholds = np.array([tier[0] for tier in tiers])
+        lows = np.array([tier[1] for tier in tiers])
+        highs = np.array([tier[2] for tier in tiers])
+        index = np.minimum(np.searchsorted(thresholds, self.rng.random(size), side='right'), len(tiers) - 1)
+        values = lows[index] + (highs[index] - lows[index]) * self.rng.random(size)
+        return values if decimals is None else np.round(values, decimals)
+
+    @staticmethod
+    def summarize(returns):
+        """Сводка по выплатам на единицу ставки"""
+        rtp = float(returns.mean())
+        return {
+            'rtp': rtp,
+            'house_edge': 1 - rtp,
+            'stddev': float(returns.std()),
+            'win_rate': float((returns > 0).mean()),
+        }
+
+    def roulette_returns(self, numbers):
+        """Выплаты на единицу ставки по каждому типу ставки (на число ставим 7, все числа равноценны)"""
+        red = np.isin(numbers, ROULETTE_RED_NUMBERS)
+        nonzero = numbers > 0
+        wins = {
+            'число': numbers == 7,
+            'чет': nonzero & (numbers % 2 == 0),
+            'нечет': nonzero & (numbers % 2 == 1),
+            'красное': red,
+            'черное': nonzero & ~red,
+        }
+        return {bet_type: np.where(won, ROULETTE_PAYOUTS[bet_type], 0) for bet_type, won in wins.items()}
+
+    def simulate_roulette(self):
+        numbers = self.rng.integers(0, 37, self.rounds)
+        return {bet_type: self.summarize(returns) for bet_type, returns in self.roulette_returns(numbers).items()}
+
+    def simulate_crash(self, tiers, decimals=None):
+        """Ставка с целевым множителем выигрывает, если краш не ниже цели (как в settle_crash_round)"""
+        crashes = self.sample_multipliers(tiers, self.rounds, decimals)
+        targets = {f'x{target:g}': self.summarize(np.where(crashes >= target, target, 0.0))
+                   for target in self.CRASH_TARGETS}
+        return {
+            'median': float(np.median(crashes)),
+            'p99': float(np.percentile(crashes, 99)),
+            'targets': targets,
+        }
+
+    def simulate_dice(self, players):
+        """Кости: все бросают, при ничьей переброс, победитель забирает весь банк"""
+        pending = np.arange(self.rounds)
+        throws = np.zeros(self.rounds, dtype=np.int64)
+        winners = np.empty(self.rounds, dtype=np.int64)
+        while pending.size:
+            rolls = self.rng.integers(1, 7, size=(pending.size, players))
+            throws[pending] += 1
+            top = rolls.max(axis=1)
+            decided = (rolls == top[:, None]).sum(axis=1) == 1
+            winners[pending[decided]] = rolls[decided].argmax(axis=1)
+            pending = pending[~decided]
+        # Создатель бросает последним; банк = ставка * число игроков
+        creator_returns = np.where(winners == players - 1, players, 0)
+        return {
+            'players': players,
+            'avg_throws': float(throws.mean()),
+            'max_throws': int(throws.max()),
+            **self.summarize(creator_returns),
+        }
+
+    def simulate_bonus(self, house_edges):
+        """Эмиссия бонусов против оборота, который казино должно забрать, чтобы ее погасить"""
+        low, high = BONUS_AMOUNT_RANGE
+        claims_per_day = 24 // BONUS_INTERVAL_HOURS
+        amounts = self.rng.integers(low, high + 1, size=(self.bonus_days * claims_per_day, self.bonus_users))
+        per_user_day = amounts.reshape(self.bonus_days, claims_per_day, self.bonus_users).sum(axis=1)
+        mean_bonus = float(amounts.mean())
+        return {
+            'mean_bonus': mean_bonus,
+            'stddev_bonus': float(amounts.std()),
+            'per_user_day': float(per_user_day.mean()),
+            'issued_total': int(amounts.sum()),
+            'users': self.bonus_users,
+            'days': self.bonus_days,
+            # Сколько нужно ставить в час, чтобы преимущество казино погасило бонус
+            'breakeven_wager_per_hour': {game: mean_bonus / BONUS_INTERVAL_HOURS / edge
+                                         for game, edge in house_edges.items() if 0 < edge < 1},
+        }
+
+    def benchmark(self, settle_rounds=20, bets_per_round=500):
+        """Пропускная способность: генерация множителей и расчет выплат"""
+        results = {}
+        count = min(self.rounds, 200000)
+
+        started = time.perf_counter()
+        for _ in range(count):
+            round(sample_multiplier(CRASH_MULTIPLIER_TIERS), 2)
+        results['crash_python_per_sec'] = count / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        self.sample_multipliers(CRASH_MULTIPLIER_TIERS, self.rounds, 2)
+        results['crash_numpy_per_sec'] = self.rounds / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        self.roulette_returns(self.rng.integers(0, 37, self.rounds))
+        results['roulette_numpy_per_sec'] = self.rounds / (time.perf_counter() - started)
+
+        # Настоящий SQL-расчет раунда на временной базе в памяти
+        db = Database(':memory:')
+        try:
+            bet_types = list(ROULETTE_PAYOUTS)
+            elapsed = 0.0
+            for _ in range(settle_rounds):
+                game_id = db.create_roulette_game(0)
+                with db.conn:
+                    db.conn.executemany(
+                        'INSERT INTO roulette_bets (game_id, user_id, username, bet_type, bet_target, bet_amount) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        [(game_id, user_id, f'user{user_id}', bet_types[user_id % len(bet_types)],
+                          str(user_id % 37), 1000) for user_id in range(1, bets_per_round + 1)]
+                    )
+                started = time.perf_counter()
+                db.settle_roulette_round(game_id, int(self.rng.integers(0, 37)))
+                elapsed += time.perf_counter() - started
+            results['roulette_sql_bets_per_sec'] = settle_rounds * bets_per_round / elapsed
+            results['roulette_sql_round_ms'] = elapsed / settle_rounds * 1000
+        finally:
+            db.close()
+        return results
+
+    def run(self):
+        roulette = self.simulate_roulette()
+        crash = self.simulate_crash(CRASH_MULTIPLIER_TIERS, decimals=2)
+        dream = self.simulate_crash(DREAM_MULTIPLIER_TIERS)
+        dice = [self.simulate_dice(players) for players in self.DICE_PLAYERS]
+        house_edges = {f'рулетка {bet_type}': stats['house_edge'] for bet_type, stats in roulette.items()}
+        house_edges.update({f'краш {target}': stats['house_edge'] for target, stats in crash['targets'].items()})
+        house_edges.update({f'дрим {target}': stats['house_edge'] for target, stats in dream['targets'].items()})
+        return {
+            'rounds': self.rounds,
+            'roulette': roulette,
+            'crash': crash,
+            'dream': dream,
+            'dice': dice,
+            'bonus': self.simulate_bonus(house_edges),
+            'benchmark': self.benchmark(),
+        }
+
+    def print_report(self, report=None):
+        report = report or self.run()
+
+        def row(name, stats):
+            print(f"  {name:<10} RTP {stats['rtp'] * 100:7.2f}%  преимущество {stats['house_edge'] * 100:+7.2f}%  "
+                  f"σ {stats['stddev']:8.3f}  выигрышей {stats['win_rate'] * 100:6.2f}%"
+                  f"{'  ⚠️ игрок в плюсе' if stats['house_edge'] < 0 else ''}")
+
+        print(f"🎰 Симуляция казино: {report['rounds']:,} раундов на игру")
+        print("\nРулетка:")
+        for bet_type, stats in report['roulette'].items():
+            row(bet_type, stats)
+        for game in ('crash', 'dream'):
+            data = report[game]
+            print(f"\n{'Краш' if game == 'crash' else 'Дрим'} (медиана x{data['median']:.2f}, 99% x{data['p99']:.2f}):")
+            for target, stats in data['targets'].items():
+                row(target, stats)
+        print("\nКости (ставка создателя):")
+        for stats in report['dice']:
+            row(f"{stats['players']} игр.", stats)
+            print(f"  {'':<10} бросков в среднем {stats['avg_throws']:.3f}, максимум {stats['max_throws']}")
+
+        bonus = report['bonus']
+        print(f"\nБонусы ({bonus['users']} игроков, {bonus['days']} дн.):")
+        print(f"  средний бонус {bonus['mean_bonus']:,.0f}$ (σ {bonus['stddev_bonus']:,.0f}$)")
+        print(f"  эмиссия на игрока в день {bonus['per_user_day']:,.0f}$, всего {bonus['issued_total']:,}$")
+        breakeven = sorted(bonus['breakeven_wager_per_hour'].items(), key=lambda item: item[1])
+        for game, wager in breakeven[:5]:
+            print(f"  чтобы погасить бонус через '{game}', нужно ставить {wager:,.0f}$ в час")
+
+        bench = report['benchmark']
+        print("\nПроизводительность:")
+        print(f"  краш, Python:       {bench['crash_python_per_sec']:>14,.0f} множителей/с")
+        print(f"  краш, numpy:        {bench['crash_numpy_per_sec']:>14,.0f} множителей/с")
+        print(f"  рулетка, numpy:     {bench['roulette_numpy_per_sec']:>14,.0f} раундов/с")
+        print(f"  рулетка, SQL-расчет {bench['roulette_sql_bets_per_sec']:>14,.0f} ставок/с "
+              f"({bench['roulette_sql_round_ms']:.2f} мс на раунд)")
+        return report
+
+
 if __name__ == "__main__":
+    # python Rolekh.py simulate [раундов] — офлайн-отчет по экономике казино, бот не запускается
+    if len(sys.argv) > 1 and sys.argv[1] == 'simulate':
+        CasinoSimulator(rounds=int(sys.argv[2]) if len(sys.argv) > 2 else 1000000).print_report()
+        sys.exit(0)
+
+    # python Rolekh.py checkplans — проверка планов горячих запросов на чистой схеме (код выхода 1 при регрессии)
+    if len(sys.argv) > 1 and sys.argv[1] == 'checkplans':
+        check_db = Database(':memory:')
+        try:
+            plan_problems = check_db.check_query_plans()
+        finally:
+            check_db.close()
+        for query_name, plan_detail in plan_problems:
+            print(f"❌ {query_name}: {plan_detail}")
+        print("✅ Планы запросов в порядке" if not plan_problems else f"Найдено проблем: {len(plan_problems)}")
+        sys.exit(1 if plan_problems else 0)
+
     try:
         bot = VKBot()
-        bot.run()
+        if CONFIG.get('async_runtime'):
+            bot.run_async()
+        else:
+            bot.run()
     except KeyboardInterrupt:
         print("\n🛑 Остановка по запросу пользователя...")
         if 'bot' in locals():
@@ -8146,7 +11567,10 @@ if __name__ == "__main__":
             except Exception as e:
                 bot.log(f"Ошибка назначения прав разработчика: {e}")
 
-        bot.run()
+        if CONFIG.get('async_runtime'):
+            bot.run_async()
+        else:
+            bot.run()
     except KeyboardInterrupt:
         print("\nБот остановлен пользователем")
     except Exception as e:
@@ -0,0 +1,182 @@
+"""Асинхронный рантайм против локального фейкового сервера VK (без сети)"""
+import asyncio
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+USER_ID = 555
+MESSAGE_EVENT = {
+    'type': 'message_new',
+    'group_id': 1,
+    'object': {'message': {'id': 1, 'conversation_message_id': 1, 'date': 0,
+                           'peer_id': USER_ID, 'from_id': USER_ID, 'text': '/help'}},
+}
+
+
+class FakeVKServer:
+    """Отвечает на методы API (/method/<name>) и на Long Poll (/poll), запоминая запросы"""
+
+    def __init__(self):
+        self.calls = []
+        self.polls = 0
+        self.sent = threading.Event()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                method = urlsplit(self.path).path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                params = {key: values[0] for key, values in parse_qs(body).items()}
+                server.calls.append((method, params, self.headers.get('User-Agent', '')))
+                self.reply(server.api_response(method, params))
+                if method == 'messages.send':
+                    server.sent.set()
+
+            def do_GET(self):
+                server.polls += 1
+                if server.polls == 1:
+                    self.reply({'ts': '2', 'updates': [MESSAGE_EVENT]})
+                else:
+                    time.sleep(0.05)
+                    self.reply({'ts': '2', 'updates': []})
+
+            def reply(self, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def api_response(self, method, params):
+        if method == 'groups.getLongPollServer':
+            return {'response': {'server': f'{self.url}/poll', 'key': 'key', 'ts': '1'}}
+        if method == 'users.get':
+            return {'response': [{'id': int(user_id), 'first_name': 'Test', 'last_name': 'User',
+                                  'screen_name': f'id{user_id}'}
+                                 for user_id in params.get('user_ids', '').split(',') if user_id]}
+        if method == 'execute':
+            return {'response': []}
+        return {'response': 1}
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class AsyncRuntimeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        for name in ('aiohttp', 'requests', 'dotenv', 'pylint'):
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                raise unittest.SkipTest(f'не установлен {name}')
+
+        cls.server = FakeVKServer()
+        cls.server.start()
+
+        # Модуль бота читает config.json из текущего каталога при импорте
+        cls.workdir = tempfile.TemporaryDirectory()
+        cls.cwd = os.getcwd()
+        os.chdir(cls.workdir.name)
+        with open('config.json', 'w', encoding='utf-8') as f:
+            json.dump({
+                'vk_token': 'token',
+                'group_id': 1,
+                'grand_developer': {'user_id': 1, 'username': 'dev'},
+                'commands': {},
+                'api_url': f'{cls.server.url}/method',
+            }, f)
+        sys.path.insert(0, ROOT)
+        cls.module = importlib.import_module('Rolekh')
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        sys.path.remove(ROOT)
+        cls.server.stop()
+        cls.workdir.cleanup()
+
+    def make_bot(self):
+        """VKBot без конструктора (он поднимает БД, планировщик и фоновые потоки) — только то, что
+        нужно рантайму: вызовы API, лимитер, трассировка и предзагрузка профилей"""
+        module = self.module
+        bot = module.VKBot.__new__(module.VKBot)
+        bot.token = 'token'
+        bot.group_id = 1
+        bot.api_version = '5.131'
+        bot.api_url = f'{self.server.url}/method'
+        bot.http = module.requests.Session()
+        bot.async_runtime = None
+        bot.server = bot.key = bot.ts = None
+        bot.running = True
+        bot.tracer = module.LatencyTracer(enabled=True, log=lambda message: None)
+        bot.rate_limiter = module.TokenBucketRateLimiter(rate=100)
+        bot.api_max_retries = 0
+        bot.retry_deadline = threading.local()
+        bot.user_cache = module.UserProfileCache(max_size=100, ttl=60)
+        bot.prefetch_pool = module.ThreadPoolExecutor(max_workers=1)
+        bot.log = lambda message: None
+
+        def process_message(event):
+            message = event['object']['message']
+            bot.api_request('messages.send', {'peer_id': message['peer_id'], 'message': 'ok', 'random_id': 0})
+
+        bot.process_message = process_message
+        return bot
+
+    def test_long_poll_cycle_and_send_go_through_aiohttp(self):
+        bot = self.make_bot()
+        # То же, что VKBot.run_async
+        runtime = self.module.AsyncVKRuntime(bot)
+        runner = threading.Thread(target=lambda: asyncio.run(runtime.run()), daemon=True)
+        runner.start()
+        try:
+            self.assertTrue(self.server.sent.wait(10), 'обработчик не отправил сообщение')
+        finally:
+            bot.running = False
+            runner.join(5)
+            bot.prefetch_pool.shutdown(wait=True)
+
+        self.assertFalse(runner.is_alive())
+        self.assertIsNone(bot.async_runtime)
+        self.assertGreaterEqual(self.server.polls, 1)
+        self.assertEqual(bot.ts, '2')
+        self.assertEqual(self.server.calls[0][0], 'groups.getLongPollServer')
+
+        sends = [(params, agent) for method, params, agent in self.server.calls if method == 'messages.send']
+        self.assertEqual(len(sends), 1)
+        params, agent = sends[0]
+        self.assertEqual(params['peer_id'], str(USER_ID))
+        self.assertEqual(params['access_token'], 'token')
+        # Вызов из потока обработчика ушел через пул соединений рантайма, а не через requests
+        self.assertIn('aiohttp', agent)
+
+        # Профиль автора предзагружен вне Long Poll тем же путем
+        self.assertTrue(all('aiohttp' in agent for _, _, agent in self.server.calls))
+        self.assertEqual(bot.user_cache.get(USER_ID)[1]['screen_name'], f'id{USER_ID}')
+
+if __name__ == '__main__':
+    unittest.main()